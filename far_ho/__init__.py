@@ -2,3 +2,9 @@ from far_ho.hyper_parameters import *
 from far_ho.hyper_gradients import *
 from far_ho.optimizer import *
 from far_ho.utils import GraphKeys, hyperparameters, hypergradients
+from far_ho.meta_graph import export_hyper_optimizer, import_hyper_optimizer
+from far_ho.planner import plan_hypergradient
+from far_ho.recorder import Recorder
+from far_ho.outer_optimizer import LBFGSOptimizer
+from far_ho.scheduler import SuccessiveHalving
+from far_ho.evaluation import MetaEvaluator
@@ -0,0 +1,69 @@
+"""
+Meta-test evaluation: adaptation of the inner models on batches of new episodes (tasks) with the inner dynamics
+already in the graph, and evaluation of some metrics on their test sets.
+"""
+from __future__ import absolute_import, print_function, division
+
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+from far_ho import utils
+from far_ho.hyper_parameters import HyperOptimizer
+
+
+class MetaEvaluator(object):
+    def __init__(self, hypergradient, metrics, T):
+        """
+        Evaluates the hyperparameters (e.g. a hyper-representation) on meta-batches of episodes: for each
+        meta-batch all the inner problems are initialized (`OptimizerDict.initialization`) and trained together
+        for T steps (`OptimizerDict.ts`), then the metrics are computed on the test sets of the episodes.
+        All the operations are created here, once, so that evaluating does not grow the graph. The tensors
+        hoisted in `hypergradient` (see `HyperGradient.hoist`) are computed once per meta-batch.
+
+        Note that the evaluation modifies the state of the inner problems (which is reinitialized at every
+        hyper-iteration unless the run is online).
+
+        :param hypergradient: `HyperGradient` (or `HyperOptimizer`) whose inner problems are the episodes of a
+                                meta-batch
+        :param metrics: dictionary (name, list of scalar tensors with one element for each episode, or a
+                        single scalar tensor)
+        :param T: number of adaptation steps
+        """
+        if isinstance(hypergradient, HyperOptimizer):
+            hypergradient = hypergradient.hypergradient
+        self.T = T
+        self._initialization = hypergradient.initialization
+        self._ts = hypergradient.ts
+        self._hoisted = list(hypergradient.hoisted)
+        self._metrics = OrderedDict([(name, tf.stack(utils.as_list(m), name=name.replace(' ', '_')))
+                                     for name, m in metrics.items()])
+
+    def evaluate(self, meta_batches, session=None, per_episode=False, training=False):
+        """
+        :param meta_batches: iterable of pairs (training feed dictionary, test feed dictionary), one for each
+                                meta-batch of episodes
+        :param session: optional session
+        :param per_episode: if `True` returns the values of the metrics on every episode, otherwise their means
+        :param training: if `True` evaluates the metrics also on the training sets (after adaptation)
+        :return: an OrderedDict (name, mean or array of values) of the metrics on the test sets or, if `training`,
+                    a pair of these dictionaries, on the training and on the test sets
+        """
+        ss = session or tf.get_default_session()
+        values_train, values_test = [], []
+        for train_fd, test_fd in meta_batches:
+            ss.run(self._initialization, train_fd)
+            adaptation_fd = utils.merge_dicts(train_fd, dict(zip(self._hoisted, ss.run(self._hoisted, train_fd)))
+                                              ) if self._hoisted else train_fd
+            for _ in range(self.T):
+                ss.run(self._ts, adaptation_fd)
+            if training:
+                values_train.append(ss.run(self._metrics, train_fd))
+            values_test.append(ss.run(self._metrics, test_fd))
+
+        def _reduce(values):
+            return OrderedDict([(name, np.concatenate([v[name] for v in values]) if per_episode else
+                                 np.mean([v[name] for v in values])) for name in self._metrics])
+
+        return (_reduce(values_train), _reduce(values_test)) if training else _reduce(values_test)
@@ -1,3 +1,4 @@
 from far_ho.examples.datasets import *
 from far_ho.examples.load import *
 from far_ho.examples.models import *
+from far_ho.examples.episodes import EpisodeSampler
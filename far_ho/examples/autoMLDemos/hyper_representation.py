@@ -62,24 +62,9 @@ def accuracy(y_true, logits):
             tf.float32))
 
 
-def meta_test(meta_batches, mbd, opt, n_steps):
-    ss = tf.get_default_session()
-    ss.run(tf.variables_initializer(tf.trainable_variables()))
-    sum_loss, sum_acc = 0., 0.
-    n_tasks = len(mbd['err'])*len(meta_batches)
-    for _tasks in meta_batches:
-        _train_fd, _valid_fd = make_feed_dicts(_tasks, mbd)
-        mb_err = tf.add_n(mbd['err'])
-        mb_acc = tf.add_n(mbd['acc'])
-        opt_step = opt.minimize(mb_err)
-        for i in range(n_steps):
-            ss.run(opt_step, feed_dict=_train_fd)
-
-        mb_loss, mb_acc = ss.run([mb_err, mb_acc], feed_dict=_valid_fd)
-        sum_loss += mb_loss
-        sum_acc += mb_acc
-
-    return sum_loss/n_tasks, sum_acc/n_tasks
+def meta_test(meta_batches, mbd, evaluator):
+    results = evaluator.evaluate([make_feed_dicts(_tasks, mbd) for _tasks in meta_batches])
+    return results['loss'], results['acc']
 
 
 meta_batch_size = 16  # meta-batch size
@@ -92,6 +77,7 @@ for _ in range(meta_batch_size):
     mb_dict['x'].append(x)
     mb_dict['y'].append(y)
     hyper_repr = build_hyper_representation(x, auto_reuse=True)
+    mb_dict['repr'].append(hyper_repr)
     logits = classifier(hyper_repr, y)
     ce = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(
         labels=y, logits=logits))
@@ -105,20 +91,25 @@ mean_acc = tf.add_n(mb_dict['acc'])/meta_batch_size
 inner_opt = far.GradientDescentOptimizer(learning_rate=0.1)
 outer_opt = tf.train.AdamOptimizer()
 
-hyper_step = far.HyperOptimizer().minimize(
+farho = far.HyperOptimizer()
+# the representation does not change during the inner iterations: computed once per hyper-iteration
+farho.hoist(mb_dict['repr'])
+hyper_step = farho.minimize(
     E, outer_opt, L, inner_opt)
 
+T = 3
+# adaptation on the test episodes with the inner dynamics (built once)
+evaluator = far.MetaEvaluator(farho, {'loss': mb_dict['err'], 'acc': mb_dict['acc']}, T)
+
 sess = tf.Session()
 n_hyper_steps = 100
 with sess.as_default():
     tf.global_variables_initializer().run()
-    T = 3
     for meta_batch in meta_dataset.train.generate(n_hyper_steps, batch_size=meta_batch_size):
         train_fd, valid_fd = make_feed_dicts(meta_batch, mb_dict)
         hyper_step(T, train_fd, valid_fd)
 
-        test_optim = tf.train.GradientDescentOptimizer(0.1)
         test_mbs = [mb for mb in meta_dataset.test.generate(n_episodes_testing, batch_size=meta_batch_size, rand=0)]
 
         print('train_test (loss, acc)', sess.run([E, mean_acc], feed_dict=valid_fd))
-        print('test_test (loss, acc)', meta_test(test_mbs, mb_dict, test_optim, T))
+        print('test_test (loss, acc)', meta_test(test_mbs, mb_dict, evaluator))
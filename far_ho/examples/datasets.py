@@ -56,6 +56,123 @@ class Datasets:
 NAMED_SUPPLIER = {}
 
 
+def _as_index_array(indices, n):
+    """
+    :return: the indices (None, slice or array) as an array of integers in [0, n)
+    """
+    if indices is None: return np.arange(n)
+    if isinstance(indices, slice): return np.arange(*indices.indices(n))
+    return np.asarray(indices)
+
+
+def _num_selected(indices, n):
+    if indices is None: return n
+    if isinstance(indices, slice): return len(range(*indices.indices(n)))
+    return len(indices)
+
+
+class SampleInfo:
+    """
+    Columnar per-example information: a dictionary of columns (arrays with one entry for each example of a
+    backing storage) and a dictionary of values shared by all the examples, seen through optional indices.
+    Indexing with an integer returns the dictionary of the information of that example (as the array of
+    dictionaries used before); indexing with a slice or an array returns a view.
+    """
+
+    def __init__(self, columns=None, constants=None, num_examples=0, indices=None):
+        self.columns = columns or {}  # entries of examples without the key are `_MISSING`
+        self.constants = constants or {}
+        self._n = num_examples  # size of the backing columns
+        self._indices = indices
+
+    @staticmethod
+    def build(sample_info, num_examples):
+        """
+        :param sample_info: `None`, a `SampleInfo`, a dictionary (shared by all the examples) or a sequence of
+                            dictionaries (one for each example), which is converted into columns
+        """
+        if sample_info is None: return SampleInfo(num_examples=num_examples)
+        if isinstance(sample_info, SampleInfo): return sample_info
+        if isinstance(sample_info, dict): return SampleInfo(constants=sample_info, num_examples=num_examples)
+        keys = sorted(set(k for dct in sample_info for k in dct))
+        return SampleInfo({k: _column([dct.get(k, _MISSING) for dct in sample_info]) for k in keys},
+                          num_examples=len(sample_info))
+
+    def __len__(self):
+        return _num_selected(self._indices, self._n)
+
+    def _raw_column(self, name):
+        if name in self.constants or name not in self.columns:
+            column = np.empty(len(self), object)
+            column.fill(self.constants.get(name, _MISSING))
+            return column
+        column = self.columns[name]
+        return column if self._indices is None else column[self._indices]
+
+    def column(self, name):
+        """
+        :return: the values of `name` for all the examples (a view if possible), `None` for the examples that
+                    do not have it
+        """
+        column = self._raw_column(name)
+        if column.dtype == object:
+            column = _object_column([None if v is _MISSING else v for v in column])
+        return column
+
+    def take(self, selection):
+        indices = _as_index_array(self._indices, self._n)[selection] if not (
+            self._indices is None and isinstance(selection, slice)) else selection
+        return SampleInfo(self.columns, self.constants, self._n, indices)
+
+    def __getitem__(self, item):
+        if isinstance(item, (slice, np.ndarray, list)):
+            return self.take(item)
+        if self._indices is None: k = item
+        elif isinstance(self._indices, slice): k = range(*self._indices.indices(self._n))[item]
+        else: k = self._indices[item]
+        return utils.merge_dicts(self.constants, {n: c[k] for n, c in self.columns.items() if c[k] is not _MISSING})
+
+    @staticmethod
+    def concatenate(infos):
+        """
+        Concatenates the information of several datasets (only the columns are copied).
+        """
+        if len(infos) == 1: return infos[0]
+        keys = set(k for info in infos for k in list(info.columns) + list(info.constants))
+        constants, columns = {}, {}
+        for k in keys:
+            values = [info.constants.get(k, _MISSING) for info in infos]
+            if all(v is not _MISSING and _equal(v, values[0]) for v in values):
+                constants[k] = values[0]
+            else:
+                columns[k] = np.concatenate([info._raw_column(k) for info in infos])
+        return SampleInfo(columns, constants, sum(len(info) for info in infos))
+
+
+_MISSING = object()  # entry of a column for an example without that information
+
+
+def _equal(a, b):
+    try:
+        return bool(a == b)
+    except ValueError:  # arrays
+        return False
+
+
+def _object_column(values):
+    column = np.empty(len(values), object)
+    for k, v in enumerate(values):  # (assigning a list could create more dimensions)
+        column[k] = v
+    return column
+
+
+def _column(values):
+    column = np.array(values) if all(v is not _MISSING for v in values) else None
+    if column is None or column.ndim != 1:  # missing entries, or lists or arrays as values
+        column = _object_column(values)
+    return column
+
+
 class Dataset:
     """
     Class for managing a single dataset, includes data and target fields and has some utility functions.
@@ -63,28 +180,31 @@ class Dataset:
      per-example basis and general infos.
     """
 
-    def __init__(self, data, target, sample_info=None, info=None, name=None):
+    def __init__(self, data, target, sample_info=None, info=None, name=None, indices=None):
         """
 
-        :param data: Numpy array containing data
+        :param data: Numpy array containing data (can be memory-mapped)
         :param target: Numpy array containing targets
-        :param sample_info: either an array of dicts or a single dict, in which case it is cast to array of
-                                  dicts.
+        :param sample_info: either a sequence of dicts (one for each example) or a single dict (shared by all
+                                the examples) or a `SampleInfo`. It is stored by columns (see `SampleInfo`).
         :param info: (optional) dictionary with further info about the dataset
+        :param indices: (optional) slice or array of indices of the examples of this dataset in `data` and
+                            `target`, which can be shared by other datasets: the dataset is then a view and
+                            does not copy them (if `indices` is an array the examples are gathered at the first
+                            access of `data` or `target`, once)
         """
         self._tensor_mode = False
         # self._name = name
 
         self._data = data
         self._target = target
+        self._indices = indices
+        self._gathered = {}  # data and target of a view with an array of indices (gathered once)
         if self._data is not None:  # in meta-dataset data and target can be unspecified
-            if sample_info is None:
-                sample_info = {}
-            self.sample_info = np.array([sample_info] * self.num_examples) \
-                if isinstance(sample_info, dict) else sample_info
+            self.sample_info = SampleInfo.build(sample_info, self.num_examples)
 
             assert self.num_examples == len(self.sample_info), str(self.num_examples) + ' ' + str(len(self.sample_info))
-            assert self.num_examples == self._shape(self._target)[0]
+            if indices is None: assert self.num_examples == self._shape(self._target)[0]
 
         self.info = info or {}
         self.info.setdefault('_name', name)
@@ -109,13 +229,41 @@ class Dataset:
             'info': self.info
         }
 
+    def _select(self, name, what):
+        if self._indices is None: return what
+        if isinstance(self._indices, slice): return what[self._indices]  # a view
+        if name not in self._gathered:
+            self._gathered[name] = what[self._indices]
+        return self._gathered[name]
+
     @property
     def data(self):
-        return self._data
+        """
+        :return: the data (a view if the indices are a slice, otherwise a copy of the selected examples, made at
+                    the first access)
+        """
+        return self._select('data', self._data)
 
     @property
     def target(self):
-        return self._target
+        return self._select('target', self._target)
+
+    def absolute_indices(self, selection=None):
+        """
+        :return: the indices, in the backing arrays, of the examples of this dataset (or of `selection`)
+        """
+        indices = _as_index_array(self._indices, self._shape(self._data)[0])
+        return indices if selection is None else indices[selection]
+
+    def take(self, selection):
+        """
+        Gathers some examples directly from the backing arrays (only the selected examples are copied).
+
+        :param selection: indices of the examples (relative to this dataset)
+        :return: a pair (data, target)
+        """
+        indices = self.absolute_indices(selection)
+        return self._data[indices], self._target[indices]
 
     @property
     def num_examples(self):
@@ -123,7 +271,7 @@ class Dataset:
 
         :return: Number of examples in this dataset
         """
-        return self._shape(self.data)[0]
+        return _num_selected(self._indices, self._shape(self._data)[0])
 
     @property
     def dim_data(self):
@@ -131,7 +279,7 @@ class Dataset:
 
         :return: The data dimensionality as an integer, if input are vectors, or a tuple in the general case
         """
-        return maybe_cast_to_scalar(self._shape(self.data)[1:])
+        return maybe_cast_to_scalar(self._shape(self._data)[1:])
 
     @property
     def dim_target(self):
@@ -139,7 +287,7 @@ class Dataset:
 
         :return: The target dimensionality as an integer, if targets are vectors, or a tuple in the general case
         """
-        shape = self._shape(self.target)
+        shape = self._shape(self._target)
         return 1 if len(shape) == 1 else maybe_cast_to_scalar(shape[1:])
 
     def create_supplier(self, x, y, batch_size=None, other_feeds=None, name=None):
@@ -251,8 +399,7 @@ class SamplingWithoutReplacement:
             nb = self.training_schedule[step * self.batch_size: min(
                 (step + 1) * self.batch_size, len(self.training_schedule))]
 
-            bx = self.dataset.data[nb, :]
-            by = self.dataset.target[nb, :]
+            bx, by = self.dataset.take(nb)
 
             # if lambda_feeds:  # this was previous implementation... dunno for what it was used for
             #     lambda_processed_feeds = {k: v(nb) for k, v in lambda_feeds.items()}  previous implementation...
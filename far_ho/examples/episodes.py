@@ -0,0 +1,163 @@
+"""
+Multi-process sampler of meta-batches of episodes (few-shot classification tasks) for meta-learning experiments
+(e.g. `far_ho.examples.hyper_representation`). The pool of examples is copied once in shared memory; worker
+processes build the meta-batches directly in a ring of shared buffers, and the training loop receives views
+of these buffers (no copies), so that it never waits for the data.
+
+The workers are started with the 'spawn' method (where available): forking a process that has already created
+a tensorflow session is not safe. Hence the scripts that create a sampler must be guarded by
+`if __name__ == '__main__'`.
+"""
+from __future__ import absolute_import, print_function, division
+
+import ctypes
+import multiprocessing
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+_POLL_SECONDS = 1.  # interval between the checks of the workers while waiting for a meta-batch
+
+# python 2 has no start methods (processes are forked)
+_CONTEXT = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+
+def _shared_array(shape, dtype):
+    dtype = np.dtype(dtype)
+    buffer = _CONTEXT.RawArray(ctypes.c_char, max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return buffer, (tuple(shape), dtype.str)
+
+
+def _view(buffer, spec):
+    shape, dtype = spec
+    return np.frombuffer(buffer, np.dtype(dtype), int(np.prod(shape))).reshape(shape)
+
+
+def _episodes_worker(pool, labels_by_class, slots, free_slots, ready_slots, n_classes, n_train, n_test, seed):
+    """
+    Fills free slots with meta-batches until it receives `None`.
+    """
+    rnd = np.random.RandomState(seed)
+    data = _view(*pool)
+    views = [[_view(*buf) for buf in slot] for slot in slots]
+    one_hot = np.eye(n_classes, dtype=views[0][1].dtype)
+    while True:
+        slot = free_slots.get()
+        if slot is None: break
+        x_train, y_train, x_test, y_test = views[slot]
+        for task in range(x_train.shape[0]):
+            for c, cls in enumerate(rnd.choice(len(labels_by_class), n_classes, replace=False)):
+                examples = rnd.choice(labels_by_class[cls], n_train + n_test, replace=False)
+                # writes directly in the shared buffer (with mode='clip' np.take does not use a temporary buffer)
+                np.take(data, examples[:n_train], 0, x_train[task, c * n_train:(c + 1) * n_train], 'clip')
+                np.take(data, examples[n_train:], 0, x_test[task, c * n_test:(c + 1) * n_test], 'clip')
+                y_train[task, c * n_train:(c + 1) * n_train] = one_hot[c]
+                y_test[task, c * n_test:(c + 1) * n_test] = one_hot[c]
+        ready_slots.put(slot)
+
+
+class EpisodeSampler(object):
+    def __init__(self, data, labels, n_classes, n_train, n_test, meta_batch_size, n_workers=2, queue_size=4,
+                 seed=0, target_dtype=np.float32):
+        """
+        Samples meta-batches of `meta_batch_size` episodes. Each episode has `n_classes` classes drawn from the
+        pool, with `n_train` training and `n_test` test examples per class, and one-hot targets relative to the
+        classes of the episode. The worker processes run until `close` is called; the sampler can be used as a
+        context manager that closes it, e.g.
+
+            with EpisodeSampler(data, labels, 5, 1, 15, 4) as sampler:
+                hyper_representation.train(..., sampler=sampler)
+
+        :param data: numpy array with all the examples (first axis), copied once in shared memory
+        :param labels: integer class of each example (or one-hot targets)
+        :param n_classes: number of classes of each episode (ways)
+        :param n_train: training examples per class (shots)
+        :param n_test: test examples per class
+        :param meta_batch_size: number of episodes of a meta-batch
+        :param n_workers: number of worker processes
+        :param queue_size: number of meta-batches (buffers) that can be ready or in preparation at the same time
+        :param seed: seed of the random states of the workers (worker k uses seed + k)
+        :param target_dtype: data type of the targets
+        """
+        assert queue_size >= 2, 'At least two buffers are needed (one is in use in the training loop)'
+        labels = np.asarray(labels)
+        if labels.ndim > 1: labels = np.argmax(labels, 1)
+        self._pool = _shared_array(data.shape, data.dtype)
+        _view(*self._pool)[...] = data
+        labels_by_class = [np.where(labels == c)[0] for c in np.unique(labels)]
+
+        shape = data.shape[1:]
+        self._slots = [[_shared_array((meta_batch_size, n_classes * n) + s, dt) for n, s, dt in [
+            (n_train, shape, data.dtype), (n_train, (n_classes,), target_dtype),
+            (n_test, shape, data.dtype), (n_test, (n_classes,), target_dtype)]] for _ in range(queue_size)]
+        self._views = [[_view(*buf) for buf in slot] for slot in self._slots]
+
+        self._free, self._ready = _CONTEXT.Queue(), _CONTEXT.Queue()
+        [self._free.put(k) for k in range(queue_size)]
+        self._in_use = None
+        self._workers = [_CONTEXT.Process(target=_episodes_worker, args=(
+            self._pool, labels_by_class, self._slots, self._free, self._ready, n_classes, n_train, n_test,
+            seed + k)) for k in range(n_workers)]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
+
+    def next_meta_batch(self):
+        """
+        :return: a list of four arrays (training data, training targets, test data, test targets), whose first
+                    axis is the episode. These are views of a shared buffer, valid until the next call (copy them
+                    to keep them).
+        """
+        assert self._workers, 'The EpisodeSampler has been closed'
+        if self._in_use is not None:
+            self._free.put(self._in_use)  # the previous buffer can be filled again
+        self._in_use = None
+        while self._in_use is None:
+            try:
+                self._in_use = self._ready.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                dead = [w.exitcode for w in self._workers if not w.is_alive()]
+                assert not dead, 'Some workers of the EpisodeSampler terminated (exit codes {})'.format(dead)
+        return self._views[self._in_use]
+
+    def feed_dicts(self, xs, ys):
+        """
+        Feed dictionaries of the next meta-batch for a list of (placeholder of the data, placeholder of the
+        targets) pairs, one for each episode (e.g. of the experiments in `far_ho.examples.hyper_representation`).
+
+        :return: a pair (training feed dictionary, test feed dictionary)
+        """
+        x_train, y_train, x_test, y_test = self._views[0]
+        assert len(xs) == len(ys) == x_train.shape[0], \
+            'The meta-batches have {} episodes, found {} data and {} target placeholders'.format(
+                x_train.shape[0], len(xs), len(ys))
+        for x, y in zip(xs, ys):
+            assert x.get_shape().is_compatible_with(x_train.shape[1:]), \
+                'Shape of {} not compatible with the episodes {}'.format(x, x_train.shape[1:])
+            assert y.get_shape().is_compatible_with(y_train.shape[1:]), \
+                'Shape of {} not compatible with the targets {}'.format(y, y_train.shape[1:])
+        x_train, y_train, x_test, y_test = self.next_meta_batch()
+        return ({_v: a for k, (x, y) in enumerate(zip(xs, ys)) for _v, a in ((x, x_train[k]), (y, y_train[k]))},
+                {_v: a for k, (x, y) in enumerate(zip(xs, ys)) for _v, a in ((x, x_test[k]), (y, y_test[k]))})
+
+    def __iter__(self):
+        while True:
+            yield self.next_meta_batch()
+
+    def close(self):
+        """
+        Stops the worker processes (further calls have no effect).
+        """
+        [self._free.put(None) for _ in self._workers]
+        [w.join() for w in self._workers]
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
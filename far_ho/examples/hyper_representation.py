@@ -102,6 +102,9 @@ def _optimizers(lr, mlr0, mlr_decay, learn_lr=True):
 
 
 def _helper_function(exs, n_episodes_testing, MBS, ss, farho, T):
+    evaluator = far.MetaEvaluator(farho, {'accuracy': [_ex.scores['accuracy'] for _ex in exs],
+                                          'error': [_ex.errors['validation'] for _ex in exs]}, T[-1])
+
     def feed_dicts(dat_lst):
         dat_lst = em.as_list(dat_lst)
         tr_fd = em.utils.merge_dicts(
@@ -113,29 +116,15 @@ def _helper_function(exs, n_episodes_testing, MBS, ss, farho, T):
 
         return tr_fd, val_fd
 
-    def just_train_on_dataset(dat):
-        """
-        :return: list of accuracies or errors on training and test set (pair)
-        """
-        _trfd, _vfd = feed_dicts(dat)
-        ss.run(farho.hypergradient.initialization)
-        for _ in range(T[-1]):
-            ss.run(farho.hypergradient.ts, _trfd)
-        return (ss.run([_ex.scores['accuracy'] for _ex in exs], _trfd),
-                ss.run([_ex.scores['accuracy'] for _ex in exs], _vfd),
-                ss.run([_ex.errors['validation'] for _ex in exs], _trfd),
-                ss.run([_ex.errors['validation'] for _ex in exs], _vfd))
-
     def accs_and_errs(metasets):
         results = []
         for meta_dataset, name in zip(metasets, ['train', 'valid', 'test']):
-            ac_tr, ac_tst, err_tr, err_ts = [], [], [], []
-            for _d in meta_dataset.generate(n_episodes_testing, batch_size=MBS, rand=0):
-                jt = just_train_on_dataset(_d)
-                ac_tr.extend(jt[0])
-                ac_tst.extend(jt[1])
-                err_tr.extend(jt[2])
-                err_ts.extend(jt[3])
+            # all the episodes of a meta-batch are adapted together
+            on_train, on_test = evaluator.evaluate(
+                (feed_dicts(_d) for _d in meta_dataset.generate(n_episodes_testing, batch_size=MBS, rand=0)),
+                ss, per_episode=True, training=True)
+            ac_tr, ac_tst = list(on_train['accuracy']), list(on_test['accuracy'])
+            err_tr, err_ts = list(on_train['error']), list(on_test['error'])
 
             results.append((
                 ('mean accuracy on training set::{}'.format(name), np.mean(ac_tr)),
@@ -146,7 +135,7 @@ def _helper_function(exs, n_episodes_testing, MBS, ss, farho, T):
             ))
         return results
 
-    return feed_dicts, just_train_on_dataset, accs_and_errs, em.rec.COS('mean accuracy on test set::valid')
+    return feed_dicts, accs_and_errs, em.rec.COS('mean accuracy on test set::valid')
 
 
 def _records(metasets, saver, model, cond, ss, accs_and_errs, ex_name, meta_lr):
@@ -170,11 +159,42 @@ SAVER_EXP = em.Saver.std('L2BRIDGE', 'HYPER_REPR',
                          description='standard experiment for learning meta-representations')
 
 
+def _build_episodes(exs, hyper_repr_model, classifier_builder, farho, io_optim, oo_optim, global_step,
+                    available_devices=('/gpu:0',), hoist_representation=True):
+    """
+    Builds the classifiers of the episodes on top of the hyper-representation and sets the inner and outer
+    problems. The representations of all the episodes are built (and hoisted) before setting any problem, since
+    `HyperOptimizer.hoist` must be called before `inner_problem` and `outer_problem`. The hoisted values are fed
+    only to the inner iterations: the validation errors, evaluated with the validation feed dictionaries,
+    recompute the representations of the validation examples.
+    """
+    devices = [available_devices[k % len(available_devices)] for k in range(len(exs))]
+    representations = []
+    for ex, device in zip(exs, devices):
+        with tf.device(device):
+            representations.append(hyper_repr_model.for_input(ex.x).out)
+    if hoist_representation: farho.hoist(representations)
+
+    for k, (ex, representation, device) in enumerate(zip(exs, representations, devices)):
+        with tf.device(device):
+            ex.model = classifier_builder(representation, 'Classifier_%s' % k)
+            ex.errors['training'] = tf.reduce_mean(
+                tf.nn.softmax_cross_entropy_with_logits(labels=ex.y, logits=ex.model.out)
+            )
+            ex.errors['validation'] = ex.errors['training']
+            ex.scores['accuracy'] = tf.reduce_mean(tf.cast(
+                tf.equal(tf.argmax(ex.y, 1), tf.argmax(ex.model.out, 1)), tf.float32),
+                name='accuracy')
+
+            optim_dict = farho.inner_problem(ex.errors['training'], io_optim, var_list=ex.model.var_list)
+            farho.outer_problem(ex.errors['validation'], optim_dict, oo_optim, global_step=global_step)
+
+
 def train(metasets, ex_name, hyper_repr_model_builder, classifier_builder=None, saver=None, seed=0, MBS=4,
           available_devices=('/gpu:0',),
           mlr0=.001, mlr_decay=1.e-5, T=4, n_episodes_testing=600,
           print_every=1000, patience=40, restore_model=False,
-          lr=0.1, learn_lr=True, process_fn=None):
+          lr=0.1, learn_lr=True, process_fn=None, sampler=None, hoist_representation=True):
     """
     Function for training an hyper-representation network.
 
@@ -197,6 +217,12 @@ def train(metasets, ex_name, hyper_repr_model_builder, classifier_builder=None,
     :param lr: initial ground models learning rate
     :param learn_lr: True for optimizing the ground models learning rate
     :param process_fn: optinal hypergradient process function (like gradient clipping)
+    :param sampler: optional `far_ho.examples.episodes.EpisodeSampler` of training meta-batches (of size MBS),
+                        that prepares them in background processes (by default the meta-batches are generated
+                        with `metasets.train.generate_batch`). The caller owns the sampler and should close it
+                        (e.g. by creating it in a `with` statement)
+    :param hoist_representation: if `True` the representations of the episodes are computed once per
+                                    hyper-iteration instead of at every inner iteration (see `HyperOptimizer.hoist`)
 
     :return: tuple: the saver object, the hyper-representation model and the list of experiments objects
     """
@@ -212,23 +238,12 @@ def train(metasets, ex_name, hyper_repr_model_builder, classifier_builder=None,
 
     io_optim, gs, meta_lr, oo_optim, farho = _optimizers(lr, mlr0, mlr_decay, learn_lr)
 
-    for k, ex in enumerate(exs):
-        with tf.device(available_devices[k % len(available_devices)]):
-            ex.model = classifier_builder(hyper_repr_model.for_input(ex.x).out, 'Classifier_%s' % k)
-            ex.errors['training'] = tf.reduce_mean(
-                tf.nn.softmax_cross_entropy_with_logits(labels=ex.y, logits=ex.model.out)
-            )
-            ex.errors['validation'] = ex.errors['training']
-            ex.scores['accuracy'] = tf.reduce_mean(tf.cast(
-                tf.equal(tf.argmax(ex.y, 1), tf.argmax(ex.model.out, 1)), tf.float32),
-                name='accuracy')
-
-            optim_dict = farho.inner_problem(ex.errors['training'], io_optim, var_list=ex.model.var_list)
-            farho.outer_problem(ex.errors['validation'], optim_dict, oo_optim, global_step=gs)
+    _build_episodes(exs, hyper_repr_model, classifier_builder, farho, io_optim, oo_optim, gs, available_devices,
+                    hoist_representation)
 
     farho.finalize(process_fn=process_fn)
 
-    feed_dicts, just_train_on_dataset, mean_acc_on, cond = _helper_function(
+    feed_dicts, mean_acc_on, cond = _helper_function(
         exs, n_episodes_testing, MBS, ss, farho, T)
 
     rand = em.get_rand_state(0)
@@ -240,7 +255,10 @@ def train(metasets, ex_name, hyper_repr_model_builder, classifier_builder=None,
             saver.restore_model(hyper_repr_model)
         # ADD ONLY TESTING
         for _ in cond.early_stopping_sv(saver, patience):
-            trfd, vfd = feed_dicts(metasets.train.generate_batch(MBS, rand=rand))
+            if sampler is None:
+                trfd, vfd = feed_dicts(metasets.train.generate_batch(MBS, rand=rand))
+            else:
+                trfd, vfd = sampler.feed_dicts([ex.x for ex in exs], [ex.y for ex in exs])
 
             farho.run(T[0], trfd, vfd)  # one iteration of optimization of representation variables (hyperparameters)
 
@@ -4,9 +4,12 @@ Just MNIST.  Loaders for other datasets can be found at https://github.com/lucfr
 from __future__ import absolute_import, print_function, division
 
 from far_ho.examples.datasets import Datasets, Dataset
-from far_ho.examples.utils import redivide_data, experiment_manager_not_available, datapackage_not_available
+from far_ho.examples.utils import redivide_data, experiment_manager_not_available, datapackage_not_available, \
+    save_cache, load_cache
 from tensorflow.examples.tutorials.mnist.input_data import read_data_sets
 
+import hashlib
+import json
 import os, sys
 
 try:
@@ -21,10 +24,14 @@ except ImportError as e:
     em = experiment_manager_not_available('NOT ALL DATASETS AVAILABLE')
 
 
-def mnist(data_root_folder=None, one_hot=True, partitions=(0.8, .1,), shuffle=False, seed=None):
+def mnist(data_root_folder=None, one_hot=True, partitions=(0.8, .1,), shuffle=False, seed=None, cache=True):
     """
     Loads (download if necessary) Mnist dataset, and optionally splits it to form different training, validation
     and test sets (use partitions parameters for that)
+
+    :param cache: if `True` the (partitioned) datasets are saved in a binary cache in the data folder and the
+                    next calls with the same parameters load them from there, memory-mapped (see
+                    `far_ho.examples.utils.load_cache`). Not used when shuffling without a seed.
     """
     data_folder_name = 'mnist'
 
@@ -34,6 +41,16 @@ def mnist(data_root_folder=None, one_hot=True, partitions=(0.8, .1,), shuffle=Fa
             os.mkdir(data_root_folder)
     data_folder = os.path.join(data_root_folder, data_folder_name)
 
+    cache = cache and not (shuffle and partitions and seed is None)
+    parameters = {'one_hot': one_hot, 'partitions': partitions, 'shuffle': shuffle, 'seed': seed}
+    # one cache for each set of parameters
+    cache_folder = os.path.join(data_folder, 'cache_' + hashlib.md5(
+        json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:10])
+    if cache:
+        res = load_cache(cache_folder, parameters)
+        if res is not None:
+            return Datasets.from_list(res)
+
     datasets = read_data_sets(data_folder, one_hot=one_hot)
     train = Dataset(datasets.train.images, datasets.train.labels, name='MNIST')
     validation = Dataset(datasets.validation.images, datasets.validation.labels, name='MNIST')
@@ -41,6 +58,8 @@ def mnist(data_root_folder=None, one_hot=True, partitions=(0.8, .1,), shuffle=Fa
     res = [train, validation, test]
     if partitions:
         res = redivide_data(res, partition_proportions=partitions, shuffle=shuffle, seed=seed)
+    if cache:
+        save_cache(res, cache_folder, parameters)
     return Datasets.from_list(res)
 
 
@@ -2,9 +2,11 @@ from __future__ import absolute_import, print_function, division
 
 
 from functools import reduce
+import json
+import os
 import numpy as np
 
-from far_ho.examples.datasets import Dataset
+from far_ho.examples.datasets import Dataset, SampleInfo, _as_index_array
 from far_ho.utils import merge_dicts
 
 import sys
@@ -29,10 +31,44 @@ def get_targets(d_set):
         raise ValueError("something wrong with the dataset %s" % d_set)
 
 
-def redivide_data(datasets, partition_proportions=None, shuffle=False, seed=None):
+def _backing_arrays(datasets, memmap_path=None):
+    """
+    :return: a triple (data, targets, indices of the examples of each dataset in data and targets: `None` for all
+                the examples, a slice or an array). Datasets that are views of the same arrays (e.g. produced by
+                `redivide_data`) share them without copies; otherwise the examples are concatenated once (in a
+                memory-mapped file if `memmap_path` is given).
+    """
+    # noinspection PyProtectedMember
+    if all(isinstance(d, Dataset) for d in datasets) and all(
+            d._data is datasets[0]._data and d._target is datasets[0]._target for d in datasets):
+        return datasets[0]._data, datasets[0]._target, [d._indices for d in datasets]
+    if len(datasets) == 1 and memmap_path is None:
+        return get_data(datasets[0]), get_targets(datasets[0]), [None]
+
+    parts = [(get_data(d), get_targets(d)) for d in datasets]
+    n = sum(x.shape[0] for x, _ in parts)
+    x0, y0 = parts[0]
+    if memmap_path is not None:
+        all_data = np.lib.format.open_memmap(memmap_path, 'w+', x0.dtype, (n,) + x0.shape[1:])
+    else:
+        all_data = np.empty((n,) + x0.shape[1:], x0.dtype)
+    all_labels = np.empty((n,) + y0.shape[1:], y0.dtype)
+    offset, indices = 0, []
+    for x, y in parts:
+        all_data[offset:offset + x.shape[0]] = x
+        all_labels[offset:offset + x.shape[0]] = y
+        indices.append(slice(offset, offset + x.shape[0]))
+        offset += x.shape[0]
+    return all_data, all_labels, indices
+
+
+def redivide_data(datasets, partition_proportions=None, shuffle=False, seed=None, memmap_path=None):
     """
     Function that redivides datasets. Can be use also to shuffle or filter or map examples.
 
+    The new datasets are views (see the `indices` of `Dataset`) of a single pair of arrays: no copy is made if the
+    datasets already share them, otherwise the examples are concatenated once. Shuffling only permutes indices.
+
     :param datasets: original datasets, instances of class Dataset (works with get_data and get_targets for
                         compatibility with mnist datasets
     :param partition_proportions: (optional, default None)  list of fractions that can either sum up to 1 or less
@@ -40,15 +76,16 @@ def redivide_data(datasets, partition_proportions=None, shuffle=False, seed=None
                                     proportion 1 - sum(partition proportions).
                                     If None it will retain the same proportion of samples found in datasets
     :param shuffle: (optional, default False) if True shuffles the examples
+    :param memmap_path: (optional) file (.npy) in which the concatenated data is stored, memory-mapped, when
+                            the datasets do not already share their arrays
     :return: a list of datasets of length equal to the (possibly augmented) partition_proportion
     """
     rnd = np.random.RandomState(seed)
-    all_data = np.vstack([get_data(d) for d in datasets])
-    all_labels = np.vstack([get_targets(d) for d in datasets])
-
-    all_infos = np.concatenate([d.sample_info for d in datasets])
+    all_data, all_labels, indices = _backing_arrays(datasets, memmap_path)
+    all_infos = SampleInfo.concatenate([d.sample_info if isinstance(d, Dataset) else
+                                        SampleInfo(num_examples=get_data(d).shape[0]) for d in datasets])
 
-    N = all_data.shape[0]
+    N = len(all_infos)
 
     if partition_proportions:  # argument check
         partition_proportions = list([partition_proportions] if isinstance(partition_proportions, float)
@@ -61,17 +98,18 @@ def redivide_data(datasets, partition_proportions=None, shuffle=False, seed=None
             if sum(partition_proportions) < N:
                 partition_proportions += [N - sum(partition_proportions)]
     else:
-        partition_proportions = [1. * get_data(d).shape[0] / N for d in datasets]
+        partition_proportions = [1. * len(d.sample_info if isinstance(d, Dataset) else get_data(d)) / N
+                                 for d in datasets]
 
+    # positions of the examples in the concatenation of the datasets
+    positions = None
     if shuffle:
-        permutation = np.arange(all_data.shape[0])
-        rnd.shuffle(permutation)
+        positions = np.arange(N)
+        rnd.shuffle(positions)
 
-        all_data = all_data[permutation]
-        all_labels = np.array(all_labels[permutation])
-        all_infos = np.array(all_infos[permutation])
-
-    assert N == all_labels.shape[0]
+    all_indices = np.concatenate([_as_index_array(ind, all_data.shape[0]) for ind in indices])
+    if np.array_equal(all_indices, np.arange(all_data.shape[0])): all_indices = None  # all the examples, in order
+    assert N == (all_labels.shape[0] if all_indices is None else len(all_indices))
 
     calculated_partitions = reduce(
         lambda v1, v2: v1 + [v1[-1] + v2],
@@ -85,16 +123,104 @@ def redivide_data(datasets, partition_proportions=None, shuffle=False, seed=None
 
     new_general_info_dict = merge_dicts(*[d.info for d in datasets])
 
-    new_datasets = [
-        Dataset(data=all_data[d1:d2], target=all_labels[d1:d2], sample_info=all_infos[d1:d2],
-                info=new_general_info_dict)
-        for d1, d2 in zip(calculated_partitions, calculated_partitions[1:])
-        ]
+    def _partition(d1, d2):
+        pos = slice(d1, d2) if positions is None else positions[d1:d2]
+        return Dataset(data=all_data, target=all_labels, sample_info=all_infos.take(pos),
+                       info=new_general_info_dict, indices=pos if all_indices is None else all_indices[pos])
+
+    new_datasets = [_partition(d1, d2) for d1, d2 in zip(calculated_partitions, calculated_partitions[1:])]
 
     print('DONE')
     return new_datasets
 
 
+CACHE_VERSION = 2
+CACHE_MANIFEST = 'manifest.json'
+
+
+def _contiguous(indices, n):
+    """
+    :return: a slice equivalent to the indices (`None`, slice or array) of the examples of a dataset, if they are
+                contiguous, otherwise the array of indices
+    """
+    if indices is None: return slice(0, n)
+    if isinstance(indices, slice):
+        start, stop, step = indices.indices(n)
+        if step == 1: return slice(start, max(start, stop))
+        indices = np.arange(start, stop, step)
+    indices = np.asarray(indices)
+    if len(indices) and indices[-1] - indices[0] == len(indices) - 1 and np.all(np.diff(indices) == 1):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+
+def save_cache(datasets, cache_folder, parameters=None):
+    """
+    Saves datasets in a binary cache (see `load_cache`): the data and the targets of all the datasets as .npy
+    files (a single copy, shared by datasets that are views of the same arrays, e.g. computed by
+    `redivide_data`), the examples of each dataset (a range, or an array of indices if not contiguous) and a
+    small json manifest. The manifest is removed first and written last, so an interrupted save leaves no valid
+    cache. Per-example information (`sample_info`) is not saved.
+
+    :param datasets: list of instances of `Dataset`
+    :param cache_folder: folder of the cache (created if necessary)
+    :param parameters: (optional) json serializable dictionary of the parameters that produced the datasets
+                        (e.g. the partitions and the seed): the cache is valid only for the same parameters
+    """
+    manifest_path = os.path.join(cache_folder, CACHE_MANIFEST)
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    all_data, all_labels, indices = _backing_arrays(datasets)
+    indices = [_contiguous(ind, all_data.shape[0]) for ind in indices]
+    np.save(os.path.join(cache_folder, 'data.npy'), all_data)
+    np.save(os.path.join(cache_folder, 'target.npy'), all_labels)
+    np.savez(os.path.join(cache_folder, 'indices.npz'),
+             **{'dataset_%d' % k: ind for k, ind in enumerate(indices) if not isinstance(ind, slice)})
+    manifest = {
+        'version': CACHE_VERSION,
+        'parameters': parameters or {},
+        'data': {'shape': list(all_data.shape), 'dtype': all_data.dtype.str},
+        'target': {'shape': list(all_labels.shape), 'dtype': all_labels.dtype.str},
+        'datasets': [merge_dicts({'info': d.info}, {'start': ind.start, 'stop': ind.stop}
+                                 if isinstance(ind, slice) else {'indices': 'dataset_%d' % k})
+                     for k, (d, ind) in enumerate(zip(datasets, indices))]
+    }
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp, manifest_path)
+
+
+def load_cache(cache_folder, parameters=None, mmap_mode='r'):
+    """
+    Loads datasets saved by `save_cache`, as views of (memory-mapped) arrays: no parsing and no copies (contiguous
+    datasets are slices of the arrays).
+
+    :param cache_folder: folder of the cache
+    :param parameters: (optional) parameters that the cache must have been saved with
+    :param mmap_mode: memory-map mode of the arrays (see `numpy.load`), `None` to read them in memory
+    :return: a list of instances of `Dataset`, or `None` if there is no valid cache for these parameters
+    """
+    manifest_path = os.path.join(cache_folder, CACHE_MANIFEST)
+    if not os.path.exists(manifest_path): return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != CACHE_VERSION or manifest['parameters'] != json.loads(
+            json.dumps(parameters or {})):  # compares the json representations (e.g. tuples are lists)
+        return None
+
+    all_data = np.load(os.path.join(cache_folder, 'data.npy'), mmap_mode=mmap_mode)
+    all_labels = np.load(os.path.join(cache_folder, 'target.npy'), mmap_mode=mmap_mode)
+    assert list(all_data.shape) == manifest['data']['shape'], 'corrupted cache at %s' % cache_folder
+    assert list(all_labels.shape) == manifest['target']['shape'], 'corrupted cache at %s' % cache_folder
+    with np.load(os.path.join(cache_folder, 'indices.npz')) as indices:
+        return [Dataset(all_data, all_labels, info=d['info'],
+                        indices=indices[d['indices']] if 'indices' in d else slice(d['start'], d['stop']))
+                for d in manifest['datasets']]
+
+
 def experiment_manager_not_available(message=None):
     if message: print(message, file=sys.stderr)
     print('PLEASE INSTALL experiment_manager package', file=sys.stderr)
@@ -1,22 +1,32 @@
 from __future__ import absolute_import, print_function, division
 
 import sys
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.training import slot_creator
 from tensorflow.contrib.opt import ScipyOptimizerInterface
 
 from far_ho import utils
-from far_ho.optimizer import OptimizerDict
+from far_ho.optimizer import OptimizerDict, MicroBatchOptimizerDict, assign_dynamics
 from far_ho.utils import dot, maybe_add, reduce_all_sums
 
 RAISE_ERROR_ON_DETACHED = False
 
 
 class HyperGradient(object):
-    def __init__(self, name):
-        self._optimizer_dicts = set()
+    def __init__(self, name, dtype=None, loss_scale=None):
+        """
+        :param name: a name for the operations and variables that will be created
+        :param dtype: optional data type (e.g. `tf.float32`) of the variables that accumulate the hypergradient
+                        (Lagrange multipliers, tangents and hypergradients), for inner dynamics that run in
+                        reduced precision (`tf.float16` or `tf.bfloat16`). By default the data type of the state.
+        :param loss_scale: optional (python float) scaling factor applied to the multipliers (or tangents) before the
+                            second-order products are computed in the data type of the state, and removed after
+                            casting back to `dtype`. Prevents underflows in `tf.float16`.
+        """
+        self._optimizer_dicts = OrderedDict()  # registered `OptimizerDict` objects (as keys, in order of registration)
         self._inner_objectives = None
         self._hypergrad_dictionary = defaultdict(list)  # dictionary (hyperparameter, list of hypergradients)
         self._ts = None
@@ -24,7 +34,17 @@ class HyperGradient(object):
         self._initialization = None
         self._iteration = None
         self._state = None
+        self._stop_condition = None
         self._name = name
+        self._dtype = dtype
+        self._loss_scale = loss_scale
+        self._inner_step = None  # number of inner iterations performed so far by `run` (during the forward pass)
+        self._resume_step = None  # inner iteration from which the next `run` resumes (see `HyperOptimizer.restore`)
+        self._forward_recorders = []
+        self._reverse_recorders = []
+        self._hoisted = []  # loop-invariant tensors (see `hoist`)
+        self._hoisted_values = None  # their values in the current hyper-iteration
+        self._hoisting_feed_dict = None  # the feed dictionary with which they have been computed
 
     _ERROR_NOT_OPTIMIZER_DICT = """
     Looks like {} is not an `OptimizerDict`. Use optimizers in far_ho.optimizers for obtaining an OptimizerDict.
@@ -47,41 +67,233 @@ class HyperGradient(object):
         :return: list of hyperparameters involved in the computation
         """
         assert isinstance(optimizer_dict, OptimizerDict), HyperGradient._ERROR_NOT_OPTIMIZER_DICT.format(optimizer_dict)
-        self._optimizer_dicts.add(optimizer_dict)
+        self._optimizer_dicts.setdefault(optimizer_dict)  # registered once
 
         if hyper_list is None:  # get default hyperparameters
             hyper_list = utils.hyperparameters(tf.get_variable_scope().name)
         return hyper_list
 
+    @property
+    def optimizer_dicts(self):
+        """
+        :return: The list of `OptimizerDict` objects registered so far, in order of registration. The order is the
+                    same of `state`, `initialization` and `iteration`.
+        """
+        return list(self._optimizer_dicts)
+
     @property
     def initialization(self):
         if self._initialization is None:
-            self._initialization = [opt_dict.initialization for opt_dict in sorted(self._optimizer_dicts)]
+            self._initialization = [opt_dict.initialization for opt_dict in self.optimizer_dicts]
         return self._initialization
 
     @property
     def iteration(self):
         if self._iteration is None:
-            self._iteration = [opt_dict.iteration for opt_dict in sorted(self._optimizer_dicts)]
+            self._iteration = [opt_dict.iteration for opt_dict in self.optimizer_dicts]
         return self._iteration
 
     @property
     def state(self):
-        for opt_dict in sorted(self._optimizer_dicts):
+        for opt_dict in self.optimizer_dicts:
             for v in opt_dict.state:
                 yield v
 
+    @property
+    def stop_condition(self):
+        """
+        :return: A scalar boolean tensor that is `True` when all the inner dynamics that have stopping criteria
+                    (see `OptimizerDict.add_stopping_criterion`) have converged, or `None` if there are no criteria.
+        """
+        if self._stop_condition is None:
+            conditions = [opt_dict.stop_condition for opt_dict in self.optimizer_dicts
+                          if opt_dict.stop_condition is not None]
+            if conditions:
+                self._stop_condition = tf.reduce_all(tf.stack(conditions))
+        return self._stop_condition
+
+    def _iteration_step(self, ss, fd, step=None):
+        """
+        Performs one iteration of the inner dynamics, fetching in the same call the stopping condition (if any)
+        and the tensors of the recorders that are due at the iteration `step`.
+
+        :return: a pair (values of the state after the iteration, boolean that is True if the dynamics should stop)
+        """
+        fd = self._accumulation_sub_steps(ss, fd, step)[0]
+        if self.stop_condition is None:
+            return self._run_recorded(ss, self.iteration, fd, step), False
+        return self._run_recorded(ss, [self.iteration, self.stop_condition], fd, step)
+
+    def _accumulation_sub_steps(self, ss, fd, step=None, state_feed_dict=None):
+        """
+        If `fd` is a list, with one entry (feed dictionary, or callable step -> feed dictionary) per micro-batch,
+        runs the sub-steps that accumulate the gradients of the micro-batched inner problems
+        (see `MicroBatchOptimizerDict`), one micro-batch at a time.
+
+        :param state_feed_dict: optional feed dictionary of a past state (for replaying the sub-steps)
+        :return: a pair (feed dictionary for the step, that is the one of the last micro-batch if `fd` is a list,
+                    list of the feed dictionaries of the micro-batches or `None`)
+        """
+        if not isinstance(fd, (list, tuple)):
+            return utils.merge_dicts(state_feed_dict, fd), None
+        micro_dicts = [od for od in self.optimizer_dicts if isinstance(od, MicroBatchOptimizerDict)]
+        assert micro_dicts, 'A list of feed dictionaries is given, but no inner problem accumulates micro-batches'
+        micro_fds = [utils.merge_dicts(state_feed_dict, utils.maybe_call(mfd, step)) for mfd in fd]
+        ss.run([od.accumulation_reset for od in micro_dicts])
+        for micro_fd in micro_fds:
+            ss.run([od.accumulation_step for od in micro_dicts], feed_dict=micro_fd)
+        return micro_fds[-1], micro_fds
+
+    def add_recorder(self, recorder, reverse=False):
+        """
+        Registers a `far_ho.Recorder`, whose tensors are fetched along with the inner iterations (or, if `reverse`,
+        with the reverse iterations of `ReverseHG`), avoiding the additional `Session.run` of a callback.
+
+        :return: the recorder
+        """
+        (self._reverse_recorders if reverse else self._forward_recorders).append(recorder)
+        return recorder
+
+    def _run_recorded(self, ss, fetches, fd, step, reverse=False):
+        """
+        Runs `fetches` together with the tensors of the recorders that are due at the iteration `step`.
+        """
+        due = [r for r in (self._reverse_recorders if reverse else self._forward_recorders) if r.due(step)]
+        if not due:
+            return ss.run(fetches, feed_dict=fd)
+        results = ss.run([fetches] + [r.tensors for r in due], feed_dict=fd)
+        [r.record(step, values) for r, values in zip(due, results[1:])]
+        return results[0]
+
+    def outer_feed_dict_from_stream(self, outer_objective_feed_dicts, session=None):
+        """
+        Feed dictionary for evaluating the hypergradients when the outer objective is evaluated on a stream of
+        (validation) minibatches (see `run`). Used by `HyperOptimizer.run` for the hyperparameter update.
+
+        :param outer_objective_feed_dicts: iterable of feed dictionaries for the outer objective
+        :param session: optional session
+        :return: a feed dictionary. Here empty, since the hypergradients are accumulated during `run`.
+        """
+        return {}
+
+    @property
+    def checkpoint_variables(self):
+        """
+        :return: the variables of this object that are needed to resume a run (also those that are not
+                    GLOBAL_VARIABLES, as the hypergradients of `ReverseHG`)
+        """
+        return [v for v in utils.flatten_list(self._hypergrad_dictionary.values()) if isinstance(v, tf.Variable)]
+
+    def _checkpoint_arrays(self):
+        """
+        :return: a dictionary of numpy arrays, other than the values of the variables, that is needed to resume
+                    the current run (see `HyperOptimizer.save`)
+        """
+        return {'inner_step': np.array(-1 if self._inner_step is None else self._inner_step, np.int64)}
+
+    def _restore_checkpoint_arrays(self, arrays):
+        """
+        Restores the result of `_checkpoint_arrays`. If the checkpoint was saved during the forward pass, the next
+        call of `run` skips the initialization and resumes from the saved inner iteration.
+
+        :return: the inner iteration from which the next run resumes, or `None`
+        """
+        step = int(arrays['inner_step'])
+        self._resume_step = None if step < 0 else step
+        return self._resume_step
+
+    def hoist(self, tensors):
+        """
+        Marks some tensors as invariant along the inner dynamics: they depend only on the hyperparameters and
+        on data that does not change during a hyper-iteration (e.g. the hyper-representation of the training
+        examples of the episodes, in meta-learning). Their values are computed once per hyper-iteration, with the
+        feed dictionary of the first inner iteration, and fed to all the other inner iterations, so that the
+        subgraphs that compute them are not run again.
+
+        With `ReverseHG` the contributions to the hypergradient that flow through these tensors are accumulated
+        during the reverse pass and propagated to the hyperparameters once, at its end. Must be called before
+        `compute_gradients`. Hoisting a tensor that changes from one inner iteration to the next (e.g. with
+        stochastic mini-batches) gives wrong results. The values are fed only to the inner iterations: the outer
+        objective recomputes the hoisted tensors from its own feed dictionaries (e.g. on validation examples).
+
+        :param tensors: a tensor or a list of tensors
+        """
+        assert not self._optimizer_dicts, 'Tensors must be hoisted before computing the hypergradients'
+        self._hoisted += [t for t in utils.as_list(tensors) if t not in self._hoisted]
+
+    @property
+    def hoisted(self):
+        """
+        :return: the list of hoisted tensors (see `hoist`)
+        """
+        return self._hoisted
+
+    def _hoisting_feed_dicts(self, ss, inner_objective_feed_dicts):
+        """
+        :return: the inner feed dictionaries (as a function of the step) extended with the values of the hoisted
+                    tensors, computed at the first call (or the original ones if nothing is hoisted)
+        """
+        self._hoisted_values = self._hoisting_feed_dict = None
+        if not self._hoisted: return inner_objective_feed_dicts
+
+        def _feed_dicts(step):
+            fd = utils.maybe_call(inner_objective_feed_dicts, step)
+            assert not isinstance(fd, (list, tuple)), 'Hoisting is not supported with micro-batches'
+            if self._hoisted_values is None:
+                self._hoisting_feed_dict = fd
+                self._hoisted_values = dict(zip(self._hoisted, ss.run(self._hoisted, fd)))
+            return utils.merge_dicts(fd, self._hoisted_values)
+
+        return _feed_dicts
+
+    def _pop_resume_step(self):
+        step, self._resume_step = self._resume_step, None
+        return step
+
+    def _accumulation_dtype(self, like):
+        """
+        :return: the data type in which the quantities related to `like` (a state variable or a hyperparameter)
+                    are accumulated
+        """
+        return self._dtype or like.dtype.base_dtype
+
+    def _accumulation_value(self, tensor, like):
+        """
+        Casts `tensor` (or a tensor of zeros with the shape of `like`, if `tensor` is `None`) to the accumulation
+        data type.
+        """
+        return tf.cast(utils.val_or_zero(tensor, like), self._accumulation_dtype(like))
+
+    def _to_inner(self, acc, like):
+        """
+        Brings the accumulator `acc` into the data type of `like` (a state variable or a dynamics), applying the loss
+        scale (if any).
+        """
+        if self._loss_scale is not None:
+            acc = acc * tf.cast(self._loss_scale, acc.dtype.base_dtype)
+        return tf.cast(acc, like.dtype.base_dtype)
+
+    def _from_inner(self, tensor, dtype):
+        """
+        Inverse of `_to_inner`: casts `tensor` to `dtype` and removes the loss scale (`None` is passed through).
+        """
+        if tensor is None: return None
+        tensor = tf.cast(tensor, dtype)
+        if self._loss_scale is not None:
+            tensor = tensor / tf.cast(self._loss_scale, dtype)
+        return tensor
+
     @property
     def inner_objectives(self):
         if self._inner_objectives is None:
             self._inner_objectives = [opt.objective if hasattr(opt, 'objective') else tf.constant(False)
-                                      for opt in sorted(self._optimizer_dicts)]
+                                      for opt in self.optimizer_dicts]
         return self._inner_objectives
 
     @property
     def ts(self):
         if self._ts is None:
-            self._ts = tf.group(*[opt_dict.ts for opt_dict in sorted(self._optimizer_dicts)])
+            self._ts = tf.group(*[opt_dict.ts for opt_dict in self.optimizer_dicts])
         return self._ts
 
     def run(self, T_or_generator, inner_objective_feed_dicts=None, outer_objective_feed_dicts=None,
@@ -92,11 +304,18 @@ class HyperGradient(object):
 
         :param T_or_generator: integer or generator that should yield a step. Express either a total number of
                                 iterations of inner objective optimization dynamics, or could implement a stopping
-                                condition, or variables number of steps.
-        :param inner_objective_feed_dicts: Optional feed dictionary for the inner objective
+                                condition, or variables number of steps. If stopping criteria have been added to the
+                                inner problems (see `OptimizerDict.add_stopping_criterion`) the dynamics may
+                                terminate before.
+        :param inner_objective_feed_dicts: Optional feed dictionary for the inner objective. For the inner problems
+                                            that accumulate micro-batches (see `MicroBatchOptimizerDict`) the
+                                            feed dictionary of a step is a list, with one feed dictionary (or
+                                            callable step -> feed dictionary) per micro-batch.
         :param outer_objective_feed_dicts: Optional feed dictionary for the outer objective
                                             (note that this is not used in ForwardHG since hypergradients are not
-                                            variables)
+                                            variables). It may also be (or return) an iterable of feed
+                                            dictionaries, e.g. validation minibatches of the same size: in this
+                                            case the gradient of the outer objective is averaged over the stream.
         :param initializer_feed_dict: Optional feed dictionary for the inner objective
         :param global_step: Optional global step for the
         :param session: Optional session (otherwise will take the default session)
@@ -107,6 +326,18 @@ class HyperGradient(object):
         """
         raise NotImplementedError()
 
+    def run_multi_horizon(self, horizons, inner_objective_feed_dicts=None, outer_objective_feed_dicts=None,
+                          initializer_feed_dict=None, global_step=None, session=None, callback=None):
+        """
+        Computes the hypergradients for several horizons (numbers of iterations) from a single trajectory of the
+        inner dynamics. Parameters as in `run`; since the outer objective is evaluated once per horizon, a stream
+        of outer feed dictionaries should be given as a function that returns a new iterable at each call.
+
+        :param horizons: list of integers
+        :return: an `OrderedDict` horizon -> dictionary (hyperparameter, list of hypergradient values)
+        """
+        raise NotImplementedError()
+
     def hgrads_hvars(self, hyper_list=None, aggregation_fn=None, process_fn=None):
         """
         Method for getting hypergradient and hyperparameters as required by apply_gradient methods from tensorflow 
@@ -139,7 +370,8 @@ class HyperGradient(object):
             tf.add_to_collection(utils.GraphKeys.HYPERGRADIENTS, aggr)
             return aggr
 
-        return [(_aggregate_process_manage_collection(self._hypergrad_dictionary[h]),
+        # hypergradients accumulated in a different precision are casted back for the outer optimizer
+        return [(tf.cast(_aggregate_process_manage_collection(self._hypergrad_dictionary[h]), h.dtype.base_dtype),
                  h) for h in hyper_list]
 
     @property
@@ -169,10 +401,16 @@ class HyperGradient(object):
 
 class ReverseHG(HyperGradient):
 
-    def __init__(self, history=None, name='ReverseHG'):
-        super(ReverseHG, self).__init__(name)
+    def __init__(self, history=None, name='ReverseHG', dtype=None, loss_scale=None):
+        super(ReverseHG, self).__init__(name, dtype, loss_scale)
         self._alpha_iter = tf.no_op()
         self._reverse_initializer = tf.no_op()
+        self._outer_accumulate = tf.no_op()
+        self._outer_rescale = tf.no_op()
+        self._outer_scale = tf.placeholder_with_default(1., (), name='outer_scale')
+        self._micro_batch_reverse_step = tf.no_op()
+        self._hoisting_initializer = tf.no_op()
+        self._hoisting_chain = tf.no_op()
         self._history = history if history is not None else []
 
     @staticmethod
@@ -210,57 +448,143 @@ class ReverseHG(HyperGradient):
         with tf.variable_scope(outer_objective.op.name):  # for some reason without this there is a cathastrofic
             # failure...
             doo_ds = tf.gradients(outer_objective, list(optimizer_dict.state))
+            doo_dh = [tf.gradients(outer_objective, hyper)[0] for hyper in hyper_list]
 
             alphas = self._create_lagrangian_multipliers(optimizer_dict, doo_ds)
+            # the Lagrangian is computed in the precision of the dynamics (multipliers are casted and scaled)
+            inner_alphas = [self._to_inner(a, d) for a, d in zip(alphas, optimizer_dict.dynamics)]
 
-            alpha_vec = utils.vectorize_all(alphas)
-            dyn_vec = utils.vectorize_all(list(optimizer_dict.dynamics))
-            lag_phi_t = utils.dot(alpha_vec, dyn_vec, name='iter_wise_lagrangian_part1')
+            # per-tensor contractions (avoids concatenating state and dynamics into two flat vectors)
+            lag_phi_t = reduce_all_sums(inner_alphas, list(optimizer_dict.dynamics),
+                                        name='iter_wise_lagrangian_part1')
             # TODO outer_objective might be a list... handle this case
 
-            # iterative computation of hypergradients
-            alpha_dot_B = tf.gradients(lag_phi_t, hyper_list)
+            # iterative computation of hypergradients (without the paths through the hoisted tensors)
+            alpha_dot_B = [self._from_inner(g, self._accumulation_dtype(h)) for g, h
+                           in zip(tf.gradients(lag_phi_t, hyper_list, stop_gradients=self._hoisted or None),
+                                  hyper_list)]
+            hoisting_accumulators, through_hoisted = self._hoisted_contributions(lag_phi_t, hyper_list)
+            micro_batch_us, store_us, through_micro_ds, through_micro_dh = self._micro_batch_contributions(
+                optimizer_dict, lag_phi_t, hyper_list)
             # check that optimizer_dict has initial ops (phi_0)
             if optimizer_dict.init_dynamics is not None:
-                lag_phi0 = utils.dot(alpha_vec, utils.vectorize_all([d for (s, d) in optimizer_dict.init_dynamics]))
-                alpha_dot_B0 = tf.gradients(lag_phi0, hyper_list)
+                lag_phi0 = reduce_all_sums(inner_alphas, [d for (s, d) in optimizer_dict.init_dynamics])
+                alpha_dot_B0 = [self._from_inner(g, self._accumulation_dtype(h)) for g, h
+                                in zip(tf.gradients(lag_phi0, hyper_list), hyper_list)]
             else:
                 alpha_dot_B0 = [None] * len(hyper_list)
 
             # here, if some of this is None it may mean that the hyperparameter compares inside phi_0: check that and
             # if it is not the case raise error...
-            hyper_grad_vars, hyper_grad_step = [], tf.no_op()
-            for dl_dh, a_d_b0, hyper in zip(alpha_dot_B, alpha_dot_B0, hyper_list):
-                assert dl_dh is not None or a_d_b0 is not None, HyperGradient._ERROR_HYPER_DETACHED.format(hyper)
+            hyper_grad_vars, hyper_grad_step, hoisting_chain, micro_batch_steps = [], store_us, [], []
+            # the initial values of alphas and hypergradients (derivatives of the outer objective) that can be
+            # accumulated over several minibatches and then rescaled
+            outer_accumulators = [(alpha, self._accumulation_value(der, v)) for alpha, der, v
+                                  in zip(alphas, doo_ds, optimizer_dict.state) if der is not None]
+            for dl_dh, a_d_b0, hyper, d_oo_dh, dl_dh_hoisted, dl_dh_micro in zip(
+                    alpha_dot_B, alpha_dot_B0, hyper_list, doo_dh, through_hoisted, through_micro_dh):
+                assert dl_dh is not None or a_d_b0 is not None or dl_dh_hoisted is not None or \
+                    dl_dh_micro is not None, HyperGradient._ERROR_HYPER_DETACHED.format(hyper)
                 hgv = None
-                if dl_dh is not None:  # "normal hyperparameter"
-                    hgv = self._create_hypergradient(outer_objective, hyper)
-
-                    hyper_grad_step = tf.group(hyper_grad_step, hgv.assign_add(dl_dh))
+                if dl_dh is not None or dl_dh_hoisted is not None or dl_dh_micro is not None:  # "normal hyperparameter"
+                    hgv = self._create_hypergradient_from_dodh(hyper, self._accumulation_value(d_oo_dh, hyper))
+                    if d_oo_dh is not None:
+                        outer_accumulators.append((hgv, self._accumulation_value(d_oo_dh, hyper)))
+
+                    if dl_dh is not None:
+                        hyper_grad_step = tf.group(hyper_grad_step, hgv.assign_add(dl_dh))
+                    if dl_dh_hoisted is not None:
+                        hoisting_chain.append(hgv.assign_add(dl_dh_hoisted))
+                    if dl_dh_micro is not None:
+                        micro_batch_steps.append(hgv.assign_add(dl_dh_micro))
                 if a_d_b0 is not None:
                     hgv = hgv + a_d_b0 if hgv is not None else a_d_b0
                     # here hyper_grad_step has nothing to do...
                 hyper_grad_vars.append(hgv)  # save these...
 
+            hyper_grad_step = tf.group(hyper_grad_step, *[acc.assign_add(der) for acc, der in hoisting_accumulators])
             with tf.control_dependencies([hyper_grad_step]):  # first update hypergradinet then alphas.
-                _alpha_iter = tf.group(*[alpha.assign(dl_ds) for alpha, dl_ds
+                _alpha_iter = tf.group(*[alpha.assign(self._from_inner(dl_ds, alpha.dtype.base_dtype))
+                                         for alpha, dl_ds
                                          in zip(alphas, tf.gradients(lag_phi_t, list(optimizer_dict.state)))])
             self._alpha_iter = tf.group(self._alpha_iter, _alpha_iter)  # put all the backward iterations toghether
+            self._micro_batch_reverse_step = tf.group(self._micro_batch_reverse_step, *micro_batch_steps + [
+                alpha.assign_add(d) for alpha, d in zip(alphas, through_micro_ds) if d is not None])
+
+            self._hoisting_initializer = tf.group(self._hoisting_initializer, tf.variables_initializer(
+                [acc for acc, _ in hoisting_accumulators]))
+            self._hoisting_chain = tf.group(self._hoisting_chain, *hoisting_chain)
+
+            self._outer_accumulate = tf.group(self._outer_accumulate, *[
+                var.assign_add(der) for var, der in outer_accumulators])
+            self._outer_rescale = tf.group(self._outer_rescale, *[
+                var.assign(var * tf.cast(self._outer_scale, var.dtype.base_dtype)) for var, _ in outer_accumulators])
 
             [self._hypergrad_dictionary[h].append(hg) for h, hg in zip(hyper_list, hyper_grad_vars)]
 
             self._reverse_initializer = tf.group(self._reverse_initializer,
-                                                 tf.variables_initializer(alphas),
+                                                 tf.variables_initializer(alphas + micro_batch_us),
                                                  tf.variables_initializer([h for h in hyper_grad_vars
                                                                            if hasattr(h, 'initializer')]))  # some ->
             # hypergradients (those coming form initial dynamics) might be just tensors and not variables...
 
             return hyper_list
 
-    @staticmethod
-    def _create_lagrangian_multipliers(optimizer_dict, doo_ds):
-        lag_mul = [slot_creator.create_slot(v.initialized_value(), utils.val_or_zero(der, v), 'alpha') for v, der
-                   in zip(optimizer_dict.state, doo_ds)]
+    def _hoisted_contributions(self, lag_phi_t, hyper_list):
+        """
+        Creates the variables that accumulate, along the reverse pass, the derivatives of the Lagrangian w.r.t. the
+        hoisted tensors on which it depends (see `HyperGradient.hoist`).
+
+        :return: a pair (list of pairs (accumulator, derivative of the Lagrangian), list of the contributions
+                    of the accumulators to the hypergradients, one for each hyperparameter or `None`)
+        """
+        hoisted = [(t, g) for t, g in zip(self._hoisted, tf.gradients(lag_phi_t, self._hoisted))
+                   if g is not None] if self._hoisted else []
+        if not hoisted: return [], [None] * len(hyper_list)
+        accumulators, grad_ys = [], []
+        for t, g in hoisted:
+            dtype = self._accumulation_dtype(t)
+            # the shape of the hoisted tensor may depend on the feed (e.g. number of examples)
+            acc = tf.Variable(tf.zeros_like(t, dtype=dtype), trainable=False, collections=[], validate_shape=False,
+                              name=t.op.name.split('/')[-1] + '_hoisted_alpha')
+            accumulators.append((acc, self._from_inner(g, dtype)))
+            acc_value = tf.identity(acc)
+            acc_value.set_shape(t.get_shape())
+            grad_ys.append(self._to_inner(acc_value, t))
+        through_hoisted = tf.gradients([t for t, _ in hoisted], hyper_list, grad_ys=grad_ys)
+        return accumulators, [self._from_inner(g, self._accumulation_dtype(h))
+                              for g, h in zip(through_hoisted, hyper_list)]
+
+    def _micro_batch_contributions(self, optimizer_dict, lag_phi_t, hyper_list):
+        """
+        When the dynamics is computed from gradients accumulated over micro-batches (see `MicroBatchOptimizerDict`)
+        the Lagrangian depends on the state and on the hyperparameters also through the accumulated gradients, that
+        are not differentiable (they are read from variables). Creates the variables that store the derivatives of
+        the Lagrangian w.r.t. the accumulated gradients, computed by the reverse iteration, and their products
+        with the Jacobians of the gradient on the fed micro-batch, that are added to the Lagrange multipliers and
+        to the hypergradients by one sub-step per micro-batch (see `_reverse_pass`).
+
+        :return: a quadruple (list of variables, operation that stores the derivatives into them, list of
+                    contributions to the multipliers, one for each state variable or `None`, list of contributions
+                    to the hypergradients, one for each hyperparameter or `None`)
+        """
+        state = list(optimizer_dict.state)
+        if not isinstance(optimizer_dict, MicroBatchOptimizerDict):
+            return [], tf.no_op(), [None] * len(state), [None] * len(hyper_list)
+        assert not self._hoisted, 'Hoisting is not supported with micro-batches'
+        accumulated = [g for g, _ in optimizer_dict.grads_and_vars]
+        us = [slot_creator.create_zeros_slot(v, 'micro_batch_alpha') for _, v in optimizer_dict.grads_and_vars]
+        utils.remove_from_collection(utils.GraphKeys.GLOBAL_VARIABLES, *us)
+        store_us = tf.group(*[u.assign(d) for u, d in zip(us, tf.gradients(lag_phi_t, accumulated))
+                              if d is not None])
+        ders = tf.gradients([g for g, _ in optimizer_dict.micro_grads_and_vars], state + hyper_list,
+                            grad_ys=[u.read_value() for u in us])
+        return us, store_us, [self._from_inner(d, self._accumulation_dtype(v)) for d, v in zip(ders, state)], [
+            self._from_inner(d, self._accumulation_dtype(h)) for d, h in zip(ders[len(state):], hyper_list)]
+
+    def _create_lagrangian_multipliers(self, optimizer_dict, doo_ds):
+        lag_mul = [slot_creator.create_slot(v.initialized_value(), self._accumulation_value(der, v), 'alpha')
+                   for v, der in zip(optimizer_dict.state, doo_ds)]
         [tf.add_to_collection(utils.GraphKeys.LAGRANGIAN_MULTIPLIERS, lm) for lm in lag_mul]
         utils.remove_from_collection(utils.GraphKeys.GLOBAL_VARIABLES, *lag_mul)
         # this prevents the 'automatic' initialization with tf.global_variables_initializer.
@@ -280,11 +604,12 @@ class ReverseHG(HyperGradient):
     def _create_hypergradient(outer_obj, hyper):
         return ReverseHG._create_hypergradient_from_dodh(hyper, tf.gradients(outer_obj, hyper)[0])
 
+    def _state_feed_dict(self, his):
+        return utils.merge_dicts(*[od.state_feed_dict(h) for od, h in zip(self.optimizer_dicts, his)])
+
     def _state_feed_dict_generator(self, history, T_or_generator):
         for t, his in zip(utils.solve_int_or_generator(T_or_generator), history):
-            yield t, utils.merge_dicts(
-                *[od.state_feed_dict(h) for od, h in zip(sorted(self._optimizer_dicts), his)]
-            )
+            yield t, self._state_feed_dict(his)
 
     def run(self, T_or_generator, inner_objective_feed_dicts=None, outer_objective_feed_dicts=None,
             initializer_feed_dict=None, global_step=None, session=None, online=False, callback=None):
@@ -294,8 +619,8 @@ class ReverseHG(HyperGradient):
         T_or_generator = utils.as_tuple_or_list(T_or_generator)
 
         ss = session or tf.get_default_session()
-
-        self._history.clear()
+        resume_step = self._pop_resume_step()
+        inner_objective_feed_dicts = self._hoisting_feed_dicts(ss, inner_objective_feed_dicts)
 
         def _adjust_step(_t):
             if online:
@@ -307,23 +632,50 @@ class ReverseHG(HyperGradient):
                 return int(_t + tot_t*_T)
             else: return _t
 
-        if not online:
-            _fd = utils.maybe_call(initializer_feed_dict, utils.maybe_eval(global_step, ss))
-            self._save_history(ss.run(self.initialization, feed_dict=_fd))
+        if resume_step is None:
+            self._history.clear()
+            if not online:
+                _fd = utils.maybe_call(initializer_feed_dict, utils.maybe_eval(global_step, ss))
+                self._save_history(ss.run(self.initialization, feed_dict=_fd))
 
         # else:  # not totally clear if i should add this
         #     self._save_history(ss.run(list(self.state)))
 
-        T = 0  # this is useful if T_or_generator is indeed a generator...
-        for t in utils.solve_int_or_generator(T_or_generator[0]):
-            # nonlocal t  # with nonlocal would not be necessary the variable T... not compatible with 2.7
+        T = resume_step or 0  # number of performed iterations (useful if T_or_generator is indeed a generator...)
+        try:  # the step is reset also if the forward pass is interrupted (see `_checkpoint_arrays`)
+            for t in utils.solve_int_or_generator(T_or_generator[0]):
+                # nonlocal t  # with nonlocal would not be necessary the variable T... not compatible with 2.7
+                if t < T: continue  # resuming from a checkpoint (the history is restored)
+
+                _fd = utils.maybe_call(inner_objective_feed_dicts, _adjust_step(t))
+                state, stop = self._iteration_step(ss, _fd, _adjust_step(t))
+                self._save_history(state)
+                T = self._inner_step = t + 1
+
+                utils.maybe_call(callback[0], _adjust_step(t), _fd, ss)  # callback
+                if stop: break
+        finally:
+            self._inner_step = None
 
-            _fd = utils.maybe_call(inner_objective_feed_dicts, _adjust_step(t))
-            self._save_history(ss.run(self.iteration, feed_dict=_fd))
-            T = t
+        del self._history[-1]  # do not consider last point (the current state)
 
-            utils.maybe_call(callback[0], _adjust_step(t), _fd, ss)  # callback
+        self._reverse_pass(ss, self._history, T, T_or_generator[-1], inner_objective_feed_dicts,
+                           outer_objective_feed_dicts, initializer_feed_dict, global_step, _adjust_step,
+                           callback[1] if len(callback) == 2 else None)
 
+    def _reverse_pass(self, ss, history, T, T_or_generator, inner_objective_feed_dicts, outer_objective_feed_dicts,
+                      initializer_feed_dict, global_step, adjust_step, callback, final_state_feed_dict=None):
+        """
+        Initializes the Lagrange multipliers and the hypergradients with the derivatives of the outer objective
+        and runs the reverse iterations.
+
+        :param history: states from which the iterations have been performed (the last one is the state before
+                            the iteration `T - 1`)
+        :param T: number of iterations of the forward pass
+        :param T_or_generator: number of reverse iterations (or generator)
+        :param final_state_feed_dict: optional feed dictionary of the state at which the outer objective is
+                                        evaluated (by default the current state)
+        """
         # initialization of support variables (supports stochastic evaluation of outer objective via global_step ->
         # variable)
         # TODO (maybe tf bug or oddity) for some strange reason, if some variable's initializer depends on
@@ -331,26 +683,110 @@ class ReverseHG(HyperGradient):
         # as if the primary variable should be reinitialized as well, but, I've checked, the primary variable is NOT
         # actually reinitialized. This doesn't make sense since the primary variable is already initialized
         # and Tensorflow seems not to care... should maybe look better into this issue
-        reverse_init_fd = utils.maybe_call(outer_objective_feed_dicts, utils.maybe_eval(global_step, ss))
+        outer_fds = utils.feed_dicts_stream(
+            utils.maybe_call(outer_objective_feed_dicts, utils.maybe_eval(global_step, ss)))
         # now adding also the initializer_feed_dict because of tf quirk...
-        maybe_init_fd = utils.maybe_call(initializer_feed_dict, utils.maybe_eval(global_step, ss))
-        reverse_init_fd = utils.merge_dicts(reverse_init_fd, maybe_init_fd)
+        maybe_init_fd = utils.merge_dicts(
+            utils.maybe_call(initializer_feed_dict, utils.maybe_eval(global_step, ss)), final_state_feed_dict)
+        reverse_init_fd = utils.merge_dicts(next(outer_fds, None), maybe_init_fd)
         ss.run(self._reverse_initializer, feed_dict=reverse_init_fd)
+        # stream of outer feed dictionaries: accumulates the derivatives of the outer objective and takes the mean
+        n_outer = 1
+        for outer_fd in outer_fds:
+            ss.run(self._outer_accumulate, feed_dict=utils.merge_dicts(outer_fd, maybe_init_fd))
+            n_outer += 1
+        if n_outer > 1:
+            ss.run(self._outer_rescale, feed_dict={self._outer_scale: 1. / n_outer})
+
+        if self._hoisted_values is not None:
+            ss.run(self._hoisting_initializer, feed_dict=self._hoisted_values)
+        for pt, state_feed_dict in self._state_feed_dict_generator(reversed(history), T_or_generator):
+            t = T - pt - 1  # index of the iteration performed from this state (this should be fine also for
+            # truncated reverse)
+            # replays the accumulation of the micro-batches at this state, if any
+            _fd, micro_fds = self._accumulation_sub_steps(
+                ss, utils.maybe_call(inner_objective_feed_dicts, adjust_step(t)), adjust_step(t), state_feed_dict)
+            self._run_recorded(ss, self._alpha_iter, _fd, adjust_step(t), reverse=True)
+            for micro_fd in micro_fds or []:  # second order terms through the gradients on each micro-batch
+                ss.run(self._micro_batch_reverse_step, feed_dict=micro_fd)
+            utils.maybe_call(callback, adjust_step(t), _fd, ss)
+        if self._hoisted_values is not None:
+            # the hoisted tensors are computed (from the data) once more, to propagate the accumulated derivatives
+            ss.run(self._hoisting_chain, feed_dict=self._hoisting_feed_dict)
+
+    def run_multi_horizon(self, horizons, inner_objective_feed_dicts=None, outer_objective_feed_dicts=None,
+                          initializer_feed_dict=None, global_step=None, session=None, callback=None):
+        """
+        Computes the hypergradients for several horizons T1 < T2 < ... < Tn with a single forward pass of Tn
+        iterations: the trajectory is stored once and, for each horizon, the Lagrange multipliers are
+        initialized with the derivative of the outer objective at the state of that horizon and a reverse pass
+        is run from there. Replaces n full runs with one forward pass and n reverse passes.
+
+        Only the forward pass is shared: the reverse passes cost T1 + ... + Tn reverse iterations, that is
+        O(n Tn). They cannot be merged into a single sweep from Tn to 0 that injects the derivative of the outer
+        objective at each horizon, since the multipliers are linear in the injected derivatives and such a sweep
+        only yields the sum of the hypergradients of all the horizons, not each of them.
+
+        :param horizons: list of integers (numbers of iterations)
+        :param callback: callback for the forward iterations (or pair of callbacks: forward, reverse)
+        :return: an `OrderedDict` horizon -> dictionary (hyperparameter, list of hypergradient values), for the
+                    horizons reached by the dynamics (that may stop before Tn if stopping criteria are set)
+
+        See `run` for the other parameters.
+        """
+        callback = utils.as_tuple_or_list(callback)
+        horizons = sorted(horizons)
+        ss = session or tf.get_default_session()
+        assert getattr(self._history, 'maxlen', None) is None, 'Multi-horizon requires the full trajectory'
+        self._history.clear()
+        inner_objective_feed_dicts = self._hoisting_feed_dicts(ss, inner_objective_feed_dicts)
 
-        del self._history[-1]  # do not consider last point
-
-        for pt, state_feed_dict in self._state_feed_dict_generator(reversed(self._history), T_or_generator[-1]):
-            # this should be fine also for truncated reverse... but check again the index t
-            t = T - pt - 1  # if T is int then len(self.history) is T + 1 and this numerator
-            # shall start at T-1
-            _fd = utils.merge_dicts(state_feed_dict, utils.maybe_call(inner_objective_feed_dicts,
-                                                                      _adjust_step(t)))
-            ss.run(self._alpha_iter, _fd)
-            if len(callback) == 2: utils.maybe_call(callback[1], _adjust_step(t), _fd, ss)
+        _fd = utils.maybe_call(initializer_feed_dict, utils.maybe_eval(global_step, ss))
+        self._save_history(ss.run(self.initialization, feed_dict=_fd))
+        for t in range(horizons[-1]):
+            _fd = utils.maybe_call(inner_objective_feed_dicts, t)
+            state, stop = self._iteration_step(ss, _fd, t)
+            self._save_history(state)
+            utils.maybe_call(callback[0], t, _fd, ss)
+            if stop: break
+
+        history = list(self._history)
+        hypergradients = OrderedDict()
+        for T in [_T for _T in horizons if _T < len(history)]:
+            final_state_fd = self._state_feed_dict(history[T])
+            self._reverse_pass(ss, history[:T], T, T, inner_objective_feed_dicts, outer_objective_feed_dicts,
+                               initializer_feed_dict, global_step, lambda _t: _t,
+                               callback[1] if len(callback) == 2 else None, final_state_fd)
+            hypergradients[T] = ss.run(dict(self._hypergrad_dictionary), final_state_fd)
+        return hypergradients
 
     def _save_history(self, weights):
         self._history.append(weights)
 
+    def _checkpoint_arrays(self):
+        arrays = super(ReverseHG, self)._checkpoint_arrays()
+        if self._inner_step is not None:  # the trajectory is needed only during the forward pass
+            for k in range(len(self.optimizer_dicts)):
+                # the states of an optimizer may have different lengths (e.g. BackTrackingGD); stacks them by entry
+                lengths = [len(his[k]) for his in self._history]
+                arrays['history_len_{}'.format(k)] = np.array(lengths, np.int64)
+                for j in range(max(lengths)):
+                    arrays['history_{}_{}'.format(k, j)] = np.stack([his[k][j] for his in self._history
+                                                                     if len(his[k]) > j])
+        return arrays
+
+    def _restore_checkpoint_arrays(self, arrays):
+        step = super(ReverseHG, self)._restore_checkpoint_arrays(arrays)
+        self._history.clear()
+        if step is not None:
+            per_optimizer = []
+            for k in range(len(self.optimizer_dicts)):
+                lengths = arrays['history_len_{}'.format(k)]
+                entries = [iter(arrays['history_{}_{}'.format(k, j)]) for j in range(max(lengths))]
+                per_optimizer.append([[next(entries[j]) for j in range(n)] for n in lengths])
+            self._history.extend([list(his) for his in zip(*per_optimizer)])  # keeps the maxlen of a deque
+        return step
+
     def hypergrad_callback(self, hyperparameter=None, flatten=True):
         """callback that records the partial hypergradients on the reverse pass"""
         values = []
@@ -373,12 +809,13 @@ class ReverseHg(ReverseHG):
 
 
 class ForwardHG(HyperGradient):
-    def __init__(self, name='ForwardHG'):
-        super(ForwardHG, self).__init__(name)
+    def __init__(self, name='ForwardHG', dtype=None, loss_scale=None):
+        super(ForwardHG, self).__init__(name, dtype, loss_scale)
         self._forward_initializer = tf.no_op()
         self._zs = {}  # hyperparameter - zs dictionary
         self._z_iter = tf.no_op()
         self._iteration = None
+        self._fused_step = None
         self.A_dot_zs = {}
 
     _HYPER_RANK_ERROR_MESSAGE = """
@@ -389,6 +826,8 @@ class ForwardHG(HyperGradient):
 
     def compute_gradients(self, outer_objective, optimizer_dict, hyper_list=None):
         hyper_list = super(ForwardHG, self).compute_gradients(outer_objective, optimizer_dict, hyper_list)
+        assert not isinstance(optimizer_dict, MicroBatchOptimizerDict), \
+            'The accumulation of micro-batches is supported only by ReverseHG'
 
         # scalar_hyper_list
 
@@ -411,8 +850,17 @@ class ForwardHG(HyperGradient):
                     init_dynamics_dot_aux_v = reduce_all_sums(
                         optimizer_dict.init_dynamics, aux_vs)
 
+            # structural dependencies of the dynamics on the state and on the hyperparameters, used to avoid
+            # allocating and updating tangents that are always zero
+            state = list(optimizer_dict.state)
+            dynamics_deps = utils.structural_dependencies(list(optimizer_dict.dynamics), state + hyper_list)
+            init_dynamics_deps = utils.structural_dependencies(
+                [d for _, d in optimizer_dict.init_dynamics], hyper_list) if optimizer_dict.init_dynamics else []
+            hyper_indices = {h: k for k, h in enumerate(hyper_list)}
+
             for hyp in hyper_list:
-                assert hyp.shape.ndims == 0, ForwardHG._HYPER_RANK_ERROR_MESSAGE.format(hyp, hyp.shape.ndims)
+                assert not self.need_scalar_hyperparameters() or hyp.shape.ndims == 0, \
+                    ForwardHG._HYPER_RANK_ERROR_MESSAGE.format(hyp, hyp.shape.ndims)
 
                 d_init_dyn_d_hyp = None if init_dynamics_dot_aux_v is None else \
                     tf.gradients(init_dynamics_dot_aux_v, hyp)[0]
@@ -433,40 +881,110 @@ class ForwardHG(HyperGradient):
                 # -------------------------------------------------------------
 
                 # UPDATE OF TOTAL DERIVATIVE OF STATE W.R.T. HYPERPARAMETER
-                zs = ForwardHG._create_zs(
-                    optimizer_dict, hyp, None if d_init_dyn_d_hyp is None else tf.gradients(d_init_dyn_d_hyp, aux_vs)
-                )  # this is one z for each variable
+                support = ForwardHG._tangent_support(dynamics_deps, init_dynamics_deps, len(state),
+                                                     hyper_indices[hyp])
+                zs, d_E_T = self._create_tangents(optimizer_dict, hyp, state, aux_vs, der_dynamics_dot_aux_v,
+                                                  d_init_dyn_d_hyp, d_dyn_d_hyp, d_oo_d_state, support)
                 self._zs[hyp] = zs  # store a reference for the total derivatives for easy access
-                Bs = tf.gradients(d_dyn_d_hyp, aux_vs)
+                self._forward_initializer = tf.group(self._forward_initializer,
+                                                     tf.variables_initializer([z for z in zs if z is not None]))
 
-                A_dot_zs = tf.gradients(reduce_all_sums(der_dynamics_dot_aux_v, zs), aux_vs)
+                # -- HYPERGRADIENT -----
+                hg = maybe_add(d_E_T, None if d_oo_d_hyp is None else self._accumulation_value(
+                    d_oo_d_hyp, hyp))  # adds the ''direct derivative'' term d(E( . , \lambda))/d \lambda
+                self._hypergrad_dictionary[hyp].append(hg if hg is not None else self._accumulation_value(None, hyp))
+        return hyper_list
 
-                self.A_dot_zs[hyp] = A_dot_zs
+    def _create_tangents(self, optimizer_dict, hyper, state, aux_vs, der_dynamics_dot_aux_v, d_init_dyn_d_hyp,
+                         d_dyn_d_hyp, d_oo_d_state, support):
+        """
+        Creates the tangents (total derivatives of the state w.r.t. the scalar hyperparameter `hyper`) and their
+        update, that is added to `_z_iter`. Overridden by `RandomizedForwardHG`.
+
+        :param d_init_dyn_d_hyp: derivative w.r.t. `hyper` of the dot product between the initial dynamics and
+                                    `aux_vs`, or `None`
+        :param d_dyn_d_hyp: derivative w.r.t. `hyper` of the dot product between the dynamics and `aux_vs`, or `None`
+        :param d_oo_d_state: derivatives of the outer objective w.r.t. the state variables
+        :param support: indices of the tangents that are not structurally zero (see `_tangent_support`)
+        :return: a pair (list of tangents, one for each state variable, `None` for structurally zero tangents;
+                    part of the hypergradient that flows through the state, or `None`)
+        """
+        zs = self._create_zs(optimizer_dict, hyper, None if d_init_dyn_d_hyp is None else tf.gradients(
+            d_init_dyn_d_hyp, aux_vs), support)
+        self.A_dot_zs[hyper] = self._build_tangent_iteration(state, aux_vs, der_dynamics_dot_aux_v, d_dyn_d_hyp, zs,
+                                                             support)
+        return zs, tf.reduce_sum(self._state_contributions(d_oo_d_state, zs))
 
-                _z_iter = tf.group(*[
-                    z.assign(maybe_add(A_dot_z, B)) for z, A_dot_z, B
-                    in zip(zs, A_dot_zs, Bs)
-                ])
-                self._z_iter = tf.group(self._z_iter, _z_iter)
+    def _state_contributions(self, d_oo_d_state, zs):
+        """
+        :return: the list of dot products between the derivatives of the outer objective w.r.t. the state
+                    variables and the tangents `zs` (skipping those that are `None`)
+        """
+        return [dot(self._accumulation_value(d_oo_d_s, z), z) for d_oo_d_s, z in zip(d_oo_d_state, zs)
+                if d_oo_d_s is not None and z is not None]
 
-                # -- HYPERGRADIENT -----
-                d_E_T = [dot(d_oo_d_s, z) for d_oo_d_s, z in zip(d_oo_d_state, zs)
-                         if d_oo_d_s is not None and z is not None]  # list of dot products
-                hg = maybe_add(tf.reduce_sum(d_E_T), d_oo_d_hyp)  # sum the partial dot products and possibly ->
-                # adds the ''direct derivative'' term d(E( . , \lambda))/d \lambda
+    def _build_tangent_iteration(self, state, aux_vs, der_dynamics_dot_aux_v, d_dyn_d_hyp, zs, support):
+        """
+        Builds the update z <- A z + B of the tangents `zs` and adds it to `_z_iter`.
 
-                self._hypergrad_dictionary[hyp].append(hg)
-                self._forward_initializer = tf.group(self._forward_initializer,
-                                                     tf.variables_initializer(zs))
-        return hyper_list
+        :param d_dyn_d_hyp: scalar tensor, derivative w.r.t. the (scalar) hyperparameter of the dot product between
+                                the dynamics and `aux_vs`, or `None`
+        :param support: indices of the tangents that are not structurally zero (see `_tangent_support`)
+        :return: the list of Jacobian-vector products A z
+        """
+        # Jacobian-vector products are computed in the precision of the dynamics (tangents are casted
+        # and scaled) and accumulated in the precision of the tangents. Only the blocks in the support of
+        # the tangents are computed.
+        support_aux_vs = [aux_vs[k] for k in support]
+        Bs = [None] * len(state)
+        if d_dyn_d_hyp is not None and support:
+            for k, B in zip(support, tf.gradients(
+                    d_dyn_d_hyp if self._loss_scale is None else d_dyn_d_hyp * self._loss_scale, support_aux_vs)):
+                Bs[k] = self._from_inner(B, zs[k].dtype.base_dtype)
+
+        A_dot_zs = [None] * len(state)
+        jvp_terms = [(der_dynamics_dot_aux_v[k], self._to_inner(zs[k], state[k])) for k in support
+                     if der_dynamics_dot_aux_v[k] is not None]
+        if jvp_terms:
+            for k, A_dot_z in zip(support, tf.gradients(
+                    reduce_all_sums(*[list(lst) for lst in zip(*jvp_terms)]), support_aux_vs)):
+                A_dot_zs[k] = self._from_inner(A_dot_z, zs[k].dtype.base_dtype)
+
+        _z_iter = tf.group(*[
+            z.assign(utils.val_or_zero(maybe_add(A_dot_z, B), z)) for z, A_dot_z, B
+            in zip(zs, A_dot_zs, Bs) if z is not None
+        ])
+        self._z_iter = tf.group(self._z_iter, _z_iter)
+        return A_dot_zs
 
     @staticmethod
-    def _create_zs(optimizer_dict, hyper, d_init_dynamics_d_hyper):
+    def _tangent_support(dynamics_deps, init_dynamics_deps, n_state, hyper_index):
+        """
+        Indices of the state variables whose tangent (total derivative w.r.t. the hyperparameter) is not
+        structurally zero: those whose (initial) dynamics depends on the hyperparameter, and, recursively, those
+        whose dynamics depends on a state variable in the support.
+
+        :param dynamics_deps: for each state variable, the set of indices of state variables (from 0 to
+                                n_state - 1) and of hyperparameters (from n_state) on which its dynamics depends
+        :param init_dynamics_deps: for each state variable, the set of indices of hyperparameters on which its
+                                    initial dynamics depends (or empty list)
+        """
+        support = {k for k, deps in enumerate(dynamics_deps) if n_state + hyper_index in deps} | {
+            k for k, deps in enumerate(init_dynamics_deps) if hyper_index in deps}
+        added = support
+        while added:
+            added = {k for k, deps in enumerate(dynamics_deps) if k not in support and deps & added}
+            support |= added
+        return sorted(support)
+
+    def _create_zs(self, optimizer_dict, hyper, d_init_dynamics_d_hyper, support=None, name=None):
         if d_init_dynamics_d_hyper is None: d_init_dynamics_d_hyper = [None] * len(optimizer_dict)
+        if support is None: support = range(len(optimizer_dict))
         with tf.variable_scope('Z'):
-            z = [slot_creator.create_slot(v, utils.val_or_zero(der, v), hyper.op.name) for v, der
-                 in zip(optimizer_dict.state, d_init_dynamics_d_hyper)]
-            [tf.add_to_collection(utils.GraphKeys.ZS, lm) for lm in z]
+            z = [slot_creator.create_slot(v, self._accumulation_value(der, v), name or hyper.op.name)
+                 if k in support
+                 else None for k, (v, der) in enumerate(zip(optimizer_dict.state, d_init_dynamics_d_hyper))]
+            [tf.add_to_collection(utils.GraphKeys.ZS, lm) for lm in z if lm is not None]
             # in this case it is completely fine to keep zs into the global variable...
             return z
 
@@ -474,19 +992,91 @@ class ForwardHG(HyperGradient):
             initializer_feed_dict=None, global_step=None, session=None, online=False, callback=None):
 
         ss = session or tf.get_default_session()
+        resume_step = self._pop_resume_step()
+        inner_objective_feed_dicts = self._hoisting_feed_dicts(ss, inner_objective_feed_dicts)
 
-        if not online:
+        if not online and resume_step is None:
             self._run_batch_initialization(ss, utils.maybe_call(
                 initializer_feed_dict, utils.maybe_eval(global_step, ss)))
 
-        for t in utils.solve_int_or_generator(T_or_generator):
+        try:
+            for t in utils.solve_int_or_generator(T_or_generator):
+                if resume_step and t < resume_step: continue  # resuming from a checkpoint
+                _fd = utils.maybe_call(inner_objective_feed_dicts, t)
+                stop = self._forward_step(ss, _fd, t)
+                self._inner_step = t + 1
+                utils.maybe_call(callback, t, _fd, ss)
+                if stop: break
+        finally:
+            self._inner_step = None
+
+    def run_multi_horizon(self, horizons, inner_objective_feed_dicts=None, outer_objective_feed_dicts=None,
+                          initializer_feed_dict=None, global_step=None, session=None, callback=None):
+        """
+        Computes the hypergradients for several horizons T1 < T2 < ... < Tn during a single forward pass of Tn
+        iterations, by reading the hypergradients when each horizon is reached. See `HyperGradient.run` for the
+        parameters.
+
+        :return: an `OrderedDict` horizon -> dictionary (hyperparameter, list of hypergradient values), for the
+                    horizons reached by the dynamics (that may stop before Tn if stopping criteria are set)
+        """
+        horizons = sorted(horizons)
+        ss = session or tf.get_default_session()
+        inner_objective_feed_dicts = self._hoisting_feed_dicts(ss, inner_objective_feed_dicts)
+        self._run_batch_initialization(ss, utils.maybe_call(initializer_feed_dict, utils.maybe_eval(global_step, ss)))
+
+        def _read_hypergradients():
+            _oo_fd = utils.maybe_call(outer_objective_feed_dicts, utils.maybe_eval(global_step, ss))
+            if not isinstance(_oo_fd, dict) and _oo_fd is not None:  # stream of outer feed dictionaries
+                _oo_fd = self.outer_feed_dict_from_stream(_oo_fd, ss)
+            return ss.run(dict(self._hypergrad_dictionary), _oo_fd)
+
+        hypergradients = OrderedDict()
+        if horizons[0] == 0: hypergradients[0] = _read_hypergradients()
+        for t in range(horizons[-1]):
             _fd = utils.maybe_call(inner_objective_feed_dicts, t)
-            self._forward_step(ss, _fd)
+            stop = self._forward_step(ss, _fd, t)
             utils.maybe_call(callback, t, _fd, ss)
+            if t + 1 in horizons: hypergradients[t + 1] = _read_hypergradients()
+            if stop: break
+        return hypergradients
 
-    def _forward_step(self, ss, _fd):
+    def _forward_step(self, ss, _fd, step=None):
         ss.run(self._z_iter, _fd)
-        ss.run(self.iteration, _fd)
+        return self._iteration_step(ss, _fd, step)[1]
+
+    def outer_feed_dict_from_stream(self, outer_objective_feed_dicts, session=None):
+        """
+        Averages the hypergradients over a stream of feed dictionaries for the outer objective (e.g. validation
+        minibatches of the same size). Only the (small) hypergradients are kept in memory.
+
+        :param outer_objective_feed_dicts: iterable of feed dictionaries for the outer objective
+        :param session: optional session
+        :return: a feed dictionary that maps the hypergradient tensors to their averages, to be used when the
+                    hypergradients are read or applied (e.g. `HyperOptimizer.run`)
+        """
+        ss = session or tf.get_default_session()
+        hgs = utils.flatten_list(self._hypergrad_dictionary.values())
+        sums, n = None, 0
+        for fd in utils.feed_dicts_stream(outer_objective_feed_dicts):
+            values = ss.run(hgs, fd)
+            sums = values if sums is None else [s + v for s, v in zip(sums, values)]
+            n += 1
+        return {} if n == 0 else {hg: s / n for hg, s in zip(hgs, sums)}
+
+    @property
+    def fused_step(self):
+        """
+        A single operation that performs the update of the tangents (`_z_iter`) and then a step of all the inner
+        dynamics, obtained by assigning the dynamics to the state (see `far_ho.optimizer.assign_dynamics`).
+        Runs with one `Session.run` the work that `_forward_step` does with two, and is used for streaming
+        (real-time) hyperparameter optimization (see `HyperOptimizer.stream`, that also builds the step followed by
+        the update of the hyperparameters).
+        """
+        if self._fused_step is None:
+            self._fused_step = tf.group(*[assign_dynamics(opt_dict.dynamics_dict, control_inputs=[self._z_iter])
+                                          for opt_dict in self.optimizer_dicts], name='fused_step')
+        return self._fused_step
 
     def _run_batch_initialization(self, ss, fd):
         ss.run(self.initialization, feed_dict=fd)
@@ -503,7 +1093,8 @@ class ForwardHG(HyperGradient):
 
     def z_callback(self, hyperparameter=None, flatten=True):
         zs_values = []
-        zs = list(self._zs.values()) if hyperparameter is None else self._zs[hyperparameter]
+        zs = utils.flatten_list(self._zs.values()) if hyperparameter is None else self._zs[hyperparameter]
+        zs = [z for z in zs if z is not None]  # structurally zero tangents are not allocated
         if flatten: zs = utils.vectorize_all(zs)
 
         # noinspection PyUnusedLocal
@@ -513,11 +1104,94 @@ class ForwardHG(HyperGradient):
         return zs_values, _callback
 
 
+class RandomizedForwardHG(ForwardHG):
+    """
+    Randomized forward-mode hypergradient: instead of one tangent for each scalar hyperparameter, propagates the
+    directional derivatives of the state along `n_probes` random (Rademacher) directions v in the space of each
+    hyperparameter, and returns the unbiased estimate
+
+        d E / d lambda + 1/n_probes sum_v (d E / d w . dw/d lambda v) v
+
+    of the hypergradient. Cost and memory (O(n_probes * |state|)) do not depend on the size of the
+    hyperparameters, which do not need to be scalars. The probes are sampled again at every (batch) run.
+    """
+
+    def __init__(self, n_probes=1, name='RandomizedForwardHG', dtype=None, loss_scale=None):
+        super(RandomizedForwardHG, self).__init__(name, dtype, loss_scale)
+        self.n_probes = n_probes
+        self._probes = defaultdict(list)  # hyperparameter - list of probe directions
+        self._probe_zs = defaultdict(list)  # hyperparameter - list (one for each probe) of lists of tangents
+        self._probe_sampler = tf.no_op()
+
+    def _create_tangents(self, optimizer_dict, hyper, state, aux_vs, der_dynamics_dot_aux_v, d_init_dyn_d_hyp,
+                         d_dyn_d_hyp, d_oo_d_state, support):
+        """
+        Creates `n_probes` lists of tangents, the directional derivatives of the state along random probes in the
+        space of `hyper` (see `ForwardHG._create_tangents` for the parameters).
+
+        :return: a pair (the tangents of all the probes, one list after the other; estimate of the part of the
+                    hypergradient that flows through the state, or `None`)
+        """
+        all_zs, estimates = [], []
+        for p in range(self.n_probes):
+            probe = self._create_probe(hyper, p)
+            # directional derivatives (along the probe) of the (initial) dynamics w.r.t. the hyperparameter
+            zs = self._create_zs(optimizer_dict, hyper, None if d_init_dyn_d_hyp is None else tf.gradients(
+                tf.reduce_sum(d_init_dyn_d_hyp * probe), aux_vs), support, '{}_{}'.format(hyper.op.name, p))
+            self._probe_zs[hyper].append(zs)
+            self._build_tangent_iteration(state, aux_vs, der_dynamics_dot_aux_v, None if d_dyn_d_hyp is None
+                                          else tf.reduce_sum(d_dyn_d_hyp * probe), zs, support)
+            d_E_T = self._state_contributions(d_oo_d_state, zs)
+            if d_E_T:
+                estimates.append(tf.add_n(d_E_T) * self._accumulation_value(probe, probe))
+            all_zs += zs
+        return all_zs, tf.add_n(estimates) / self.n_probes if estimates else None
+
+    @property
+    def w_dots(self):
+        """
+        :return: for each probe, the projected tangents in the format of `ForwardHG.w_dots`
+        """
+        return [[{h: self._probe_zs[h][p][k] for h in self._probe_zs} for k, _ in enumerate(self.state)]
+                for p in range(self.n_probes)]
+
+    @staticmethod
+    def _rademacher(like):
+        return tf.cast(2 * tf.random_uniform(like.shape, 0, 2, dtype=tf.int32) - 1, like.dtype.base_dtype)
+
+    def _create_probe(self, hyper, p):
+        probe = slot_creator.create_slot(hyper, RandomizedForwardHG._rademacher(hyper), 'probe_{}'.format(p))
+        # not initialized with the global variables: the probes are assigned by `_probe_sampler` at every batch run
+        utils.remove_from_collection(utils.GraphKeys.GLOBAL_VARIABLES, probe)
+        self._probes[hyper].append(probe)
+        self._probe_sampler = tf.group(self._probe_sampler, probe.assign(RandomizedForwardHG._rademacher(hyper)))
+        return probe
+
+    @property
+    def checkpoint_variables(self):
+        # the probes are not global variables and a resumed run does not sample them again
+        return super(RandomizedForwardHG, self).checkpoint_variables + utils.flatten_list(self._probes.values())
+
+    def _run_batch_initialization(self, ss, fd):
+        ss.run(self._probe_sampler)  # new directions, before the tangents are initialized
+        super(RandomizedForwardHG, self)._run_batch_initialization(ss, fd)
+
+    @staticmethod
+    def need_scalar_hyperparameters():
+        return False
+
+
 class ImplicitHG(HyperGradient):
     """
-    Implementation follows Pedregosa's algorithm HOAG
+    Implementation follows Pedregosa's algorithm HOAG.
+
+    The outer objective must be given a single feed dictionary: the linear systems are solved for the gradient of
+    the outer objective on that feed, so streams of outer feed dictionaries (see `HyperGradient.run`) are not
+    supported.
     """
 
+    _ERROR_OUTER_STREAM = 'ImplicitHG needs a single feed dictionary for the outer objective, found {}'
+
     def __init__(self, linear_system_solver_gen=None, tolerance=None, name='ImplicitHG'):
         super(ImplicitHG, self).__init__(name)
         if linear_system_solver_gen is None:
@@ -534,6 +1208,8 @@ class ImplicitHG(HyperGradient):
 
     def compute_gradients(self, outer_objective, optimizer_dict, hyper_list=None):
         hyper_list = super(ImplicitHG, self).compute_gradients(outer_objective, optimizer_dict, hyper_list)
+        assert not isinstance(optimizer_dict, MicroBatchOptimizerDict), \
+            'The accumulation of micro-batches is supported only by ReverseHG'
         state = list(optimizer_dict.state)
 
         with tf.variable_scope(outer_objective.op.name):
@@ -561,6 +1237,10 @@ class ImplicitHG(HyperGradient):
 
             return hyper_list
 
+    @property
+    def checkpoint_variables(self):
+        return super(ImplicitHG, self).checkpoint_variables + self._qs  # warm starts of the linear systems
+
     def _create_q(self, d_oo_d_state):
         self._qs.append(slot_creator.create_zeros_slot(d_oo_d_state, 'q'))
         return self._qs[-1]
@@ -568,29 +1248,41 @@ class ImplicitHG(HyperGradient):
     def run(self, T_or_generator, inner_objective_feed_dicts=None, outer_objective_feed_dicts=None,
             initializer_feed_dict=None, global_step=None, session=None, online=False, callback=None):
         ss = session or tf.get_default_session()
+        resume_step = self._pop_resume_step()
 
         inner_objective_feed_dicts = utils.as_tuple_or_list(inner_objective_feed_dicts)
-        if not online:
+        if not online and resume_step is None:
             self._run_batch_initialization(ss, utils.maybe_call(
                 initializer_feed_dict, utils.maybe_eval(global_step, ss)))
 
-        for t in utils.solve_int_or_generator(T_or_generator):
-            _fd = utils.maybe_call(inner_objective_feed_dicts[0], t)
-            self._forward_step(ss, _fd)
-            utils.maybe_call(callback, t, _fd, ss)
+        try:
+            for t in utils.solve_int_or_generator(T_or_generator):
+                if resume_step and t < resume_step: continue  # resuming from a checkpoint
+                _fd = utils.maybe_call(inner_objective_feed_dicts[0], t)
+                stop = self._forward_step(ss, _fd, t)
+                self._inner_step = t + 1
+                utils.maybe_call(callback, t, _fd, ss)
+                if stop: break
+        finally:
+            self._inner_step = None
 
         # end of optimization. Solve linear systems.
         tol_val = utils.maybe_call(self.tolerance, utils.maybe_eval(global_step, ss))  # decreasing tolerance (seq.)
         # feed dictionaries (could...in theory, implement stochastic solution of this linear system...)
         _fd = utils.maybe_call(inner_objective_feed_dicts[-1], -1)
         _fd_outer = utils.maybe_call(outer_objective_feed_dicts, utils.maybe_eval(global_step, ss))
+        assert _fd_outer is None or isinstance(_fd_outer, dict), ImplicitHG._ERROR_OUTER_STREAM.format(_fd_outer)
         _fd = utils.merge_dicts(_fd, _fd_outer)
 
         for lin_sys in self._lin_sys:
             lin_sys(tol_val).minimize(ss, _fd)  # implicitly warm restarts with previously found q
 
-    def _forward_step(self, ss, _fd):
-        ss.run(self.iteration, _fd)
+    def outer_feed_dict_from_stream(self, outer_objective_feed_dicts, session=None):
+        """Not supported: the linear systems need a single outer feed dictionary (see class docstring)"""
+        raise AssertionError(ImplicitHG._ERROR_OUTER_STREAM.format(outer_objective_feed_dicts))
+
+    def _forward_step(self, ss, _fd, step=None):
+        return self._iteration_step(ss, _fd, step)[1]
 
     def _run_batch_initialization(self, ss, fd):
         ss.run(self.initialization, feed_dict=fd)
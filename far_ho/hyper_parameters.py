@@ -1,27 +1,26 @@
 from __future__ import absolute_import, print_function, division
 
 
-from collections import defaultdict
+from collections import OrderedDict
 # from functools import reduce
 
 import tensorflow as tf
 import numpy as np
 # import sys
 
+from far_ho import utils
 from far_ho.utils import maybe_call, maybe_eval, merge_dicts, as_list
 
-try:
-    from ordered_set import OrderedSet
-except ImportError:
-    print('ordered-set package not found..')
-    OrderedSet = set
-
 from far_ho.optimizer import Optimizer
-from far_ho.hyper_gradients import ReverseHG, HyperGradient
+from far_ho.hyper_gradients import ReverseHG, ForwardHG, HyperGradient
+from far_ho.planner import plan_hypergradient
+from far_ho.recorder import Recorder
 from far_ho.utils import GraphKeys
 
 HYPERPARAMETERS_COLLECTIONS = [GraphKeys.HYPERPARAMETERS, GraphKeys.GLOBAL_VARIABLES]
 
+CHECKPOINT_ARRAYS_SUFFIX = '.far_ho.npz'  # file (next to the tensorflow checkpoint) for the state of the run
+
 
 # noinspection PyArgumentList,PyTypeChecker
 def get_hyperparameter(name, initializer=None, shape=None, dtype=None, collections=None,
@@ -75,46 +74,57 @@ class HyperOptimizer(object):
     Wrapper for performing gradient-based hyperparameter optimization
     """
 
-    def __init__(self, hypergradient=None):
+    def __init__(self, hypergradient=None, xla=False):
+        """
+        :param hypergradient: optional `HyperGradient` object (default `ReverseHG`)
+        :param xla: if `True` the inner optimization step (built by `inner_problem`) and the tangent or reverse
+                        steps (built by `outer_problem`) are compiled with XLA (see `far_ho.utils.jit_scope`)
+        """
         assert hypergradient is None or isinstance(hypergradient, HyperGradient)
         self._hypergradient = hypergradient or ReverseHG()
+        self._xla = xla
         self._fin_hts = None
         self._global_step = None
-        self._h_optim_dict = defaultdict(lambda: OrderedSet())
+        self._h_optim_dict = OrderedDict()  # outer optimizer -> hyperparameters (as keys, in order of registration)
+        self._saver = None
+        self._hyper_grads_and_vars = None  # list of pairs (outer optimizer, list of (hypergradient, hyperparameter))
+        self._stream_hyperit = None  # hyperparameter update in the same run of the streaming step (see `stream`)
 
-        self._inner_objective = None
-        # self.inner_objectives = []
+        self._inner_objectives = []
 
     # noinspection PyMethodMayBeStatic
     def inner_problem(self, inner_objective, inner_objective_optimizer, var_list=None, init_dynamics_dict=None,
-                      **minimize_kwargs):
+                      stopping_criteria=None, **minimize_kwargs):
         """
         Set the dynamics Phi: a descent procedure on some inner_objective, can be called multiple times, for instance
         for batching inner optimization problems.
 
-        :param inner_objective: a loss function for the inner optimization problem
+        :param inner_objective: a loss function for the inner optimization problem, or a list of losses on
+                                    micro-batches (see `far_ho.Optimizer.compute_micro_batch_gradients`)
         :param inner_objective_optimizer: an instance of some `far.Optimizer` (optimizers from Tensorflow must be
                                             extended to include tensors for the dynamics)
         :param var_list: optional list of variables (of the inner optimization problem)from
         :param init_dynamics_dict: optional dictrionary that defines Phi_0 (see `OptimizerDict.set_init_dynamics`)
-        :param minimize_kwargs: optional arguments to pass to `optimizer.minimize`
+        :param stopping_criteria: optional (list of) stopping criteria for the inner dynamics
+                                    (see `OptimizerDict.add_stopping_criterion`), evaluated along with each step
+        :param minimize_kwargs: optional arguments to pass to `optimizer.minimize` (e.g. `ts_from_dynamics=True`
+                                    for driving the training step with the dynamics, or `accumulate=True` for
+                                    feeding and running the micro-batches of a step one at a time,
+                                    see `Optimizer.minimize`)
         :return: `OptimizerDict` from optimizer.
         """
         assert isinstance(inner_objective_optimizer, Optimizer), 'Must use an optimizer that extends ' \
                                                                  'the class far_ho.optimizer.Optimizer' \
                                                                  'found {} instead' \
                                                                  ''.format(type(inner_objective_optimizer))
-        optim_dict = inner_objective_optimizer.minimize(
-            inner_objective,
-            var_list=var_list,
-            **minimize_kwargs
-        )
+        with utils.jit_scope(self._xla):
+            optim_dict = inner_objective_optimizer.minimize(
+                inner_objective,
+                var_list=var_list,
+                **minimize_kwargs
+            )
         if hasattr(optim_dict, 'objective'):
-            inner_objective = optim_dict.objective
-            if self._inner_objective is None:
-                self._inner_objective = [inner_objective]
-            else:
-                self._inner_objective = tf.concat((self._inner_objective, [inner_objective]), axis=0)
+            self._inner_objectives.append(optim_dict.objective)
         else:
             pass  # otherwise assume that your inner objective is not a tensor (perhaps a dictionary or some other
         # structure for "non-standard" optimizers) so has not to be tracked
@@ -122,8 +132,42 @@ class HyperOptimizer(object):
         # part is true for BacktrackingGD
         if init_dynamics_dict:
             optim_dict.set_init_dynamics(init_dynamics_dict)
+        if stopping_criteria:
+            for criterion in as_list(stopping_criteria):
+                optim_dict.add_stopping_criterion(criterion)
         return optim_dict
 
+    def plan_hypergradient(self, optim_dict, T, memory_budget, hyper_list=None, verbose=True, **planner_kwargs):
+        """
+        Chooses the hypergradient method for this object with `far_ho.planner.plan_hypergradient`, by estimating
+        time and memory of the available methods. To be called after `inner_problem` and before `outer_problem`.
+
+        :param optim_dict: `OptimizerDict` (or list) returned by `inner_problem`
+        :param T: number of iterations of the inner dynamics
+        :param memory_budget: memory budget in bytes
+        :param hyper_list: optional list of hyperparameters
+        :param verbose: if `True` prints the explanation of the choice
+        :param planner_kwargs: other arguments for `far_ho.planner.plan_hypergradient`
+        :return: the `HypergradientPlan`
+        """
+        assert not self._h_optim_dict, 'The hypergradient method must be chosen before calling outer_problem'
+        plan = plan_hypergradient(optim_dict, T, memory_budget, hyper_list, **planner_kwargs)
+        if verbose: print(plan.explanation)
+        self._hypergradient = plan.hypergradient
+        return plan
+
+    def hoist(self, tensors):
+        """
+        Marks some tensors (e.g. a hyper-representation of the training data) as invariant along the inner
+        dynamics, so that they are computed once per hyper-iteration (see `HyperGradient.hoist`). To be called
+        before `outer_problem` (and after `plan_hypergradient`, if used).
+
+        :param tensors: a tensor or a list of tensors
+        :return: itself
+        """
+        self._hypergradient.hoist(tensors)
+        return self
+
     def outer_problem(self, outer_objective, optim_dict, outer_objective_optimizer,
                       hyper_list=None, global_step=None):
         """
@@ -139,8 +183,9 @@ class HyperOptimizer(object):
                                 use the last variable in the collection GLOBAL_STEP
         :return: itself
         """
-        hyper_list = self._hypergradient.compute_gradients(outer_objective, optim_dict, hyper_list=hyper_list)
-        self._h_optim_dict[outer_objective_optimizer].update(hyper_list)
+        with utils.jit_scope(self._xla):
+            hyper_list = self._hypergradient.compute_gradients(outer_objective, optim_dict, hyper_list=hyper_list)
+        self._h_optim_dict.setdefault(outer_objective_optimizer, OrderedDict()).update((h, None) for h in hyper_list)
         if global_step is None:
             global_step = tf.get_collection(tf.GraphKeys.GLOBAL_STEP)[-1] if \
                 len(tf.get_collection(tf.GraphKeys.GLOBAL_STEP)) > 0 else None
@@ -173,22 +218,43 @@ class HyperOptimizer(object):
         :return: the run method of this object.
         """
         if self._fin_hts is None:
-            # in this way also far.optimizer can be used
-            _maybe_first_arg = lambda _v: _v[0] if isinstance(_v, tuple) else _v
             # apply updates to each optimizer for outer objective minimization.
             # each optimizer might have more than one group of hyperparameters to optimize
             # and conversely different hyperparameters might be optimized with different optimizers.
-            self._fin_hts = tf.group(*[_maybe_first_arg(opt.apply_gradients(
-                self.hypergradient.hgrads_hvars(hyper_list=hll, aggregation_fn=aggregation_fn, process_fn=process_fn)))
-                for opt, hll in self._h_optim_dict.items()])
-            if self._global_step:
-                with tf.control_dependencies([self._fin_hts]):
-                    self._fin_hts = self._global_step.assign_add(1).op
+            self._hyper_grads_and_vars = [(opt, self.hypergradient.hgrads_hvars(
+                hyper_list=list(hll), aggregation_fn=aggregation_fn, process_fn=process_fn))
+                for opt, hll in self._h_optim_dict.items()]
+            self._fin_hts = self._apply_hypergradients(self._hyper_grads_and_vars)
         else:
             raise ValueError('HyperOptimizer.finalize has already been called on ' +
                              'this object, further calls have no effect')
         return self.run
 
+    def _apply_hypergradients(self, hyper_grads_and_vars):
+        """
+        :param hyper_grads_and_vars: list of pairs (outer optimizer, list of (hypergradient, hyperparameter))
+        :return: an operation that applies the hypergradients and increments the global step (if any)
+        """
+        # in this way also far.optimizer can be used
+        _maybe_first_arg = lambda _v: _v[0] if isinstance(_v, tuple) else _v
+        hts = tf.group(*[_maybe_first_arg(opt.apply_gradients(gvs)) for opt, gvs in hyper_grads_and_vars])
+        if self._global_step:
+            with tf.control_dependencies([hts]):
+                hts = self._global_step.assign_add(1).op
+        return hts
+
+    def _hyperit_after(self, op):
+        """
+        Operation that runs `op` and then, in the same `Session.run`, the update of the hyperparameters
+        (`_hyperit`). The hypergradients are computed by copies of their subgraphs that read the variables
+        after `op` (see `far_ho.utils.read_after`).
+        """
+        assert self._hyper_grads_and_vars is not None, \
+            'Must call HyperOptimizer.finalize (on this object) before performing optimization.'
+        hypergradients = iter(utils.read_after([g for _, gvs in self._hyper_grads_and_vars for g, _ in gvs], op))
+        return tf.group(op, self._apply_hypergradients([(opt, [(next(hypergradients), h) for _, h in gvs])
+                                                        for opt, gvs in self._hyper_grads_and_vars]))
+
     @property
     def hypergradient(self):
         """
@@ -206,7 +272,10 @@ class HyperOptimizer(object):
 
     @property
     def inner_objectives(self):
-        return self._hypergradient.inner_objectives
+        """
+        :return: the list of the objectives of the inner problems, in order of registration (see `inner_problem`)
+        """
+        return self._inner_objectives
 
     def run(self, T_or_generator, inner_objective_feed_dicts=None, outer_objective_feed_dicts=None,
             initializer_feed_dict=None, optimization_step_feed_dict=None, session=None, online=False,
@@ -217,11 +286,16 @@ class HyperOptimizer(object):
         :param T_or_generator: int or generator (that yields an int), number of iteration (or stopping condition)
                                 for the inner optimization (training) dynamics
         :param inner_objective_feed_dicts: an optional feed dictionary for the inner problem. Can be a function of
-                                            step, which accounts for, e.g. stochastic gradient descent.
+                                            step, which accounts for, e.g. stochastic gradient descent. Can also
+                                            be (or return) a list of feed dictionaries, one per micro-batch
+                                            (see `far_ho.MicroBatchOptimizerDict`).
         :param outer_objective_feed_dicts: an optional feed dictionary for the outer optimization problem
                                             (passed to the evaluation of outer objective). Can be a function of
                                             hyper-iterations steps (i.e. global variable), which may account for, e.g.
-                                            stochastic evaluation of outer objective.
+                                            stochastic evaluation of outer objective. Can also be (or return) an
+                                            iterable of feed dictionaries (e.g. a generator of validation
+                                            minibatches), in which case the outer objective gradient is averaged
+                                            over the stream.
         :param initializer_feed_dict:  an optional feed dictionary for the initialization of inner problems variables.
                                             Can be a function of
                                             hyper-iterations steps (i.e. global variable), which may account for, e.g.
@@ -253,12 +327,153 @@ class HyperOptimizer(object):
                 _oo_fd = maybe_call(outer_objective_feed_dicts, maybe_eval(self._global_step)) \
                     if outer_objective_feed_dicts else {}  # this is used in ForwardHG. In ReverseHG should't be needed
                 # but it doesn't matter
+                if not isinstance(_oo_fd, dict):  # stream of outer feed dictionaries
+                    _oo_fd = self._hypergradient.outer_feed_dict_from_stream(_oo_fd, ss)
                 return merge_dicts(_od, _oo_fd)
 
             ss.run(self._hyperit, _opt_fd())
 
+    def stream(self, feed_dicts, hyper_update_every=1, initializer_feed_dict=None, optimization_step_feed_dict=None,
+               session=None, initialize=True, callback=None):
+        """
+        Streaming real-time hyperparameter optimization (RTHO): runs the inner dynamics on a (possibly unbounded)
+        stream of feed dictionaries, updating the tangents along the way, and performs a step of the outer
+        optimizer every `hyper_update_every` inner steps, without ever restarting the inner dynamics.
+
+        Each step is a single `Session.run`: of `ForwardHG.fused_step` or, every `hyper_update_every` steps, of an
+        operation that also updates the hyperparameters after the inner step, with hypergradients computed on the
+        updated state and tangents (see `far_ho.utils.read_after`). Requires `ForwardHG`.
+
+        :param feed_dicts: iterable (e.g. a generator) of feed dictionaries, or of pairs (inner objective feed
+                            dictionary, outer objective feed dictionary). If a single dictionary is given, it is
+                            used for both. The outer feed dictionary is used only at the steps where the
+                            hyperparameters are updated, in the same call of the inner step, so the two
+                            dictionaries can share only the values of their common keys. The stream ends when the
+                            iterable is exhausted.
+        :param hyper_update_every: number of inner steps between two hyperparameter updates
+        :param initializer_feed_dict: optional feed dictionary for the initialization of the inner dynamics
+        :param optimization_step_feed_dict: an optional feed dict for the iteration of the hyperparameter optimizer.
+                                            Can be a function of the number of the performed inner steps.
+        :param session: optional session
+        :param initialize: if `False` continues from the current state and tangents (e.g. to resume a stream)
+        :param callback: optional callback function of signature (step (int), feed_dictionary, tf.Session) -> None
+                                called after every inner step.
+        :return: the number of inner steps performed
+        """
+        assert isinstance(self._hypergradient, ForwardHG), 'Streaming RTHO requires ForwardHG, found {}'.format(
+            self._hypergradient)
+        ss = session or tf.get_default_session()
+        with utils.jit_scope(self._xla):
+            step = self._hypergradient.fused_step
+            if self._stream_hyperit is None:
+                self._stream_hyperit = self._hyperit_after(step)
+
+        if initialize:
+            # noinspection PyProtectedMember
+            self._hypergradient._run_batch_initialization(ss, maybe_call(initializer_feed_dict, 0))
+
+        t = 0
+        for t, fds in enumerate(feed_dicts, 1):
+            inner_fd, outer_fd = fds if isinstance(fds, (tuple, list)) else (fds, fds)
+            if t % hyper_update_every == 0:
+                assert all(inner_fd[k] is outer_fd[k] for k in set(inner_fd or {}) & set(outer_fd or {})), \
+                    'Inner and outer feed dictionaries give different values to the same tensors'
+                # noinspection PyProtectedMember
+                self._hypergradient._run_recorded(ss, self._stream_hyperit, merge_dicts(
+                    inner_fd, outer_fd, maybe_call(optimization_step_feed_dict, t)), t - 1)
+            else:
+                # noinspection PyProtectedMember
+                self._hypergradient._run_recorded(ss, step, inner_fd, t - 1)
+            utils.maybe_call(callback, t - 1, inner_fd, ss)
+        return t
+
+    def record(self, tensors, every=1, reverse=False, capacity=1000, filename=None):
+        """
+        Records the values of `tensors` every `every` inner iterations (or reverse iterations, if `reverse`)
+        fetching them in the same `Session.run` calls of the iterations, e.g.
+        `farho.record(farho.inner_objectives, every=10)` in place of `track_inner_objectives_fc`.
+        See `far_ho.Recorder` for the other parameters.
+
+        :return: the `far_ho.Recorder`, which holds the records
+        """
+        return self._hypergradient.add_recorder(Recorder(tensors, every, capacity, filename), reverse)
+
+    @property
+    def checkpoint_variables(self):
+        """
+        :return: all the variables needed to resume the hyperparameter optimization: GLOBAL_VARIABLES (model,
+                    hyperparameters, tangents, slots of the optimizers), Lagrange multipliers and the variables
+                    of the hypergradient object (e.g. hypergradients, that are not global variables)
+        """
+        return list(OrderedDict.fromkeys(tf.global_variables() +
+                                         tf.get_collection(GraphKeys.LAGRANGIAN_MULTIPLIERS) +
+                                         tf.get_collection(GraphKeys.ZS) +
+                                         self._hypergradient.checkpoint_variables))
+
+    @property
+    def saver(self):
+        """
+        :return: a `tf.train.Saver` for `checkpoint_variables`, created at the first access (access it before
+                    finalizing the graph)
+        """
+        if self._saver is None:
+            self._saver = tf.train.Saver(self.checkpoint_variables, max_to_keep=2)
+        return self._saver
+
+    def save(self, save_path, session=None, global_step=None):
+        """
+        Saves a checkpoint of the whole state of the hyperparameter optimization: the variables in
+        `checkpoint_variables` with `saver` and, in the file `<checkpoint prefix>.far_ho.npz`, the number of
+        inner iterations performed by the current `run` and, for `ReverseHG`, the stored trajectory. Can be
+        called between hyper-iterations or during the forward pass of `run` (see `checkpoint_fc`).
+
+        :param save_path: path prefix of the checkpoint (see `tf.train.Saver.save`)
+        :param session: optional session
+        :param global_step: optional global step (number or tensor) appended to the prefix
+        :return: the prefix of the written checkpoint
+        """
+        ss = session or tf.get_default_session()
+        prefix = self.saver.save(ss, save_path, global_step=global_step, write_meta_graph=False)
+        # noinspection PyProtectedMember
+        np.savez(prefix + CHECKPOINT_ARRAYS_SUFFIX, **self._hypergradient._checkpoint_arrays())
+        return prefix
+
+    def restore(self, save_path, session=None):
+        """
+        Restores a checkpoint written by `save` into the same graph (or an identical one, e.g. built by the same
+        code or imported with `far_ho.import_hyper_optimizer`). If the checkpoint was saved during the forward
+        pass of `run`, the next call of `run` (with the same arguments) resumes the hyper-iteration from there.
+
+        :param save_path: prefix of the checkpoint (e.g. as returned by `save` or `tf.train.latest_checkpoint`)
+        :param session: optional session
+        :return: the inner iteration from which the next `run` resumes, or `None` if it starts a new
+                    hyper-iteration
+        """
+        ss = session or tf.get_default_session()
+        self.saver.restore(ss, save_path)
+        with np.load(save_path + CHECKPOINT_ARRAYS_SUFFIX) as arrays:
+            # noinspection PyProtectedMember
+            return self._hypergradient._restore_checkpoint_arrays(arrays)
+
     # SOME USEFUL FORWARD CALLBACK FUNCTION --------
 
+    def checkpoint_fc(self, save_path, every=100):
+        """
+        Helper method for saving checkpoints (see `save`) during the forward pass of `run`.
+
+        :param save_path: path prefix of the checkpoints
+        :param every: number of inner iterations between two checkpoints
+        :return: callback function (to be passed to run)
+        """
+
+        def _forward_callback(_, __, ss):
+            # noinspection PyProtectedMember
+            step = self._hypergradient._inner_step
+            if step is not None and step % every == 0:
+                self.save(save_path, ss)
+
+        return _forward_callback
+
     def track_inner_objectives_fc(self):
         """
         Helper method for tracking inner objectives,
@@ -0,0 +1,215 @@
+"""
+Export and import of the (finalized) graph of a `HyperOptimizer` as a tensorflow MetaGraph, so that the
+hypergradient computation does not need to be derived again (e.g. when restarting a job).
+"""
+from __future__ import absolute_import, print_function, division
+
+import json
+from collections import OrderedDict, deque
+
+import tensorflow as tf
+from tensorflow.core.framework import variable_pb2
+from tensorflow.python.framework import ops
+from tensorflow.python.ops import variables
+
+from far_ho import utils
+from far_ho.hyper_gradients import HyperGradient, ReverseHG, ForwardHG
+from far_ho.hyper_parameters import HyperOptimizer
+from far_ho.optimizer import OptimizerDict
+
+BOOKKEEPING = 'far_ho_bookkeeping'  # collection that holds the (json) description of the HyperOptimizer
+
+# FAR-HO collections of variables are exported as variables (and not as tensors), as tensorflow does for its own
+# collections of variables.
+# noinspection PyProtectedMember
+[ops.register_proto_function(_key, proto_type=variable_pb2.VariableDef, to_proto=variables._to_proto_fn,
+                             from_proto=variables._from_proto_fn)
+ for _key in (utils.GraphKeys.HYPERPARAMETERS, utils.GraphKeys.LAGRANGIAN_MULTIPLIERS, utils.GraphKeys.ZS)]
+
+_HYPERGRADIENT_CLASSES = {c.__name__: c for c in (ReverseHG, ForwardHG)}
+
+
+def _name(obj):
+    return None if obj is None else obj.name
+
+
+def _names(lst):
+    return [_name(e) for e in lst]
+
+
+def _cached_names(lst):
+    return None if lst is None else _names(lst)
+
+
+# noinspection PyProtectedMember
+def _describe_optimizer_dict(opt_dict):
+    assert type(opt_dict) is OptimizerDict, 'Export not supported for {}'.format(type(opt_dict))
+    # the descriptions read the private caches and not the (lazy) properties, that would add operations to the graph
+    return {
+        'ts': _name(opt_dict._ts),
+        'dynamics': [[_name(v), _name(d)] for v, d in opt_dict.dynamics_dict.items()],
+        'objective': _name(opt_dict.objective),
+        'iteration': _cached_names(opt_dict._iteration),
+        'initialization': _cached_names(opt_dict._initialization),
+        'stopping_conditions': _names(opt_dict._stopping_conditions),
+        'stopping_variables': _names(opt_dict._stopping_variables),
+        'stop_condition': _name(opt_dict._stop_condition),
+        'init_dynamics': None if opt_dict.init_dynamics is None else [
+            [_name(v), _name(d)] for v, d in opt_dict.init_dynamics]
+    }
+
+
+def _describe_hypergradient(hypergradient):
+    assert type(hypergradient) in _HYPERGRADIENT_CLASSES.values(), 'Export not supported for {}'.format(
+        type(hypergradient))
+    # noinspection PyProtectedMember
+    desc = {
+        'class': type(hypergradient).__name__,
+        'name': hypergradient.name,
+        'dtype': None if hypergradient._dtype is None else tf.as_dtype(hypergradient._dtype).name,
+        'loss_scale': hypergradient._loss_scale,
+        'optimizer_dicts': [_describe_optimizer_dict(od) for od in hypergradient.optimizer_dicts],
+        'hypergradients': [[_name(h), _names(hgs)] for h, hgs in hypergradient._hypergrad_dictionary.items()],
+        'ts': _name(hypergradient._ts),
+        'stop_condition': _name(hypergradient._stop_condition),
+        'hoisted': _names(hypergradient._hoisted),
+    }
+    # noinspection PyProtectedMember
+    if isinstance(hypergradient, ReverseHG):
+        desc.update({
+            'alpha_iter': _name(hypergradient._alpha_iter),
+            'reverse_initializer': _name(hypergradient._reverse_initializer),
+            'outer_accumulate': _name(hypergradient._outer_accumulate),
+            'outer_rescale': _name(hypergradient._outer_rescale),
+            'outer_scale': _name(hypergradient._outer_scale),
+            'hoisting_initializer': _name(hypergradient._hoisting_initializer),
+            'hoisting_chain': _name(hypergradient._hoisting_chain),
+            'history_maxlen': getattr(hypergradient._history, 'maxlen', None)
+        })
+    else:
+        desc.update({
+            'forward_initializer': _name(hypergradient._forward_initializer),
+            'z_iter': _name(hypergradient._z_iter),
+            'fused_step': _name(hypergradient._fused_step),
+            'zs': [[_name(h), _names(zs)] for h, zs in hypergradient._zs.items()]
+        })
+    return desc
+
+
+def export_hyper_optimizer(hyper_optimizer, filename=None, **kwargs):
+    """
+    Exports the graph of a finalized `HyperOptimizer` as a MetaGraph. Together with the graph and the collections
+    (including HYPERPARAMETERS, LAGRANGIAN_MULTIPLIERS, HYPERGRADIENTS and ZS), saves in the collection
+    `BOOKKEEPING` a description of the `HyperOptimizer` and of its `HyperGradient` object, so that
+    `import_hyper_optimizer` can restore them without recomputing any gradient. Only `ReverseHG` and `ForwardHG`
+    with (non-backtracking) `far_ho.optimizer` dynamics are supported. Exporting does not add operations to the
+    graph: the operations that are built lazily (e.g. `ForwardHG.fused_step`) are exported only if they already
+    exist, otherwise they are built after the import, when first needed.
+
+    :param hyper_optimizer: a `HyperOptimizer` on which `finalize` has been called
+    :param filename: optional file name, see `tf.train.export_meta_graph`
+    :param kwargs: other arguments for `tf.train.export_meta_graph`
+    :return: the `MetaGraphDef` proto
+    """
+    # noinspection PyProtectedMember
+    desc = {
+        'hypergradient': _describe_hypergradient(hyper_optimizer.hypergradient),
+        'hyperit': _name(hyper_optimizer._hyperit),
+        'global_step': _name(hyper_optimizer._global_step),
+        'inner_objectives': _names(hyper_optimizer._inner_objectives),
+        'xla': hyper_optimizer._xla
+    }
+    graph = tf.get_default_graph()
+    graph.clear_collection(BOOKKEEPING)
+    graph.add_to_collection(BOOKKEEPING, json.dumps(desc))
+    return tf.train.export_meta_graph(filename, **kwargs)
+
+
+def _graph_element_getter(graph):
+    _variables = {v.name: v for key in (tf.GraphKeys.GLOBAL_VARIABLES, tf.GraphKeys.LOCAL_VARIABLES,
+                                        utils.GraphKeys.HYPERPARAMETERS, utils.GraphKeys.LAGRANGIAN_MULTIPLIERS,
+                                        utils.GraphKeys.ZS) for v in graph.get_collection(key)}
+
+    def _get(name):
+        if name is None: return None
+        return _variables[name] if name in _variables else graph.as_graph_element(name)
+
+    return _get
+
+
+def _get_list(names, _get):
+    return None if names is None else [_get(n) for n in names]
+
+
+# noinspection PyProtectedMember
+def _restore_optimizer_dict(desc, _get):
+    opt_dict = OptimizerDict(_get(desc['ts']), OrderedDict([(_get(v), _get(d)) for v, d in desc['dynamics']]),
+                             _get(desc['objective']))
+    opt_dict._iteration = _get_list(desc['iteration'], _get)
+    opt_dict._initialization = _get_list(desc['initialization'], _get)
+    opt_dict._stopping_conditions = [_get(n) for n in desc['stopping_conditions']]
+    opt_dict._stopping_variables = [_get(n) for n in desc['stopping_variables']]
+    opt_dict._stop_condition = _get(desc['stop_condition'])
+    if desc['init_dynamics'] is not None:
+        opt_dict._init_dyn = OrderedDict([(_get(v), _get(d)) for v, d in desc['init_dynamics']])
+    return opt_dict
+
+
+# noinspection PyProtectedMember
+def _restore_hypergradient(desc, _get):
+    cls = _HYPERGRADIENT_CLASSES[desc['class']]
+    # the constructors of the subclasses are not called, since they add to the graph operations (no_op,
+    # placeholders) that would be orphans: all their attributes are set below
+    hypergradient = cls.__new__(cls)
+    HyperGradient.__init__(hypergradient, desc['name'], None if desc['dtype'] is None else tf.as_dtype(desc['dtype']),
+                           desc['loss_scale'])
+    hypergradient._optimizer_dicts = OrderedDict([(_restore_optimizer_dict(od, _get), None)
+                                                  for od in desc['optimizer_dicts']])
+    for h, hgs in desc['hypergradients']:
+        hypergradient._hypergrad_dictionary[_get(h)] = [_get(n) for n in hgs]
+    hypergradient._ts = _get(desc['ts'])
+    hypergradient._stop_condition = _get(desc['stop_condition'])
+    hypergradient._hoisted = [_get(n) for n in desc['hoisted']]
+    if cls is ReverseHG:
+        hypergradient._alpha_iter = _get(desc['alpha_iter'])
+        hypergradient._reverse_initializer = _get(desc['reverse_initializer'])
+        hypergradient._outer_accumulate = _get(desc['outer_accumulate'])
+        hypergradient._outer_rescale = _get(desc['outer_rescale'])
+        hypergradient._outer_scale = _get(desc['outer_scale'])
+        hypergradient._hoisting_initializer = _get(desc['hoisting_initializer'])
+        hypergradient._hoisting_chain = _get(desc['hoisting_chain'])
+        hypergradient._micro_batch_reverse_step = None  # dynamics that accumulate micro-batches are not exported
+        hypergradient._history = [] if desc['history_maxlen'] is None else deque(maxlen=desc['history_maxlen'])
+    else:
+        hypergradient._forward_initializer = _get(desc['forward_initializer'])
+        hypergradient._z_iter = _get(desc['z_iter'])
+        hypergradient._fused_step = _get(desc['fused_step'])
+        hypergradient.A_dot_zs = {}
+        hypergradient._zs = OrderedDict([(_get(h), [_get(n) for n in zs]) for h, zs in desc['zs']])
+    return hypergradient
+
+
+def import_hyper_optimizer(meta_graph_or_file, **kwargs):
+    """
+    Imports in the default graph a MetaGraph exported with `export_hyper_optimizer`, and restores a working
+    `HyperOptimizer` (the hypergradient object is in `HyperOptimizer.hypergradient`). The values of the
+    variables are not restored (initialize them, or restore them with the returned saver).
+
+    :param meta_graph_or_file: `MetaGraphDef` proto or file name, see `tf.train.import_meta_graph`
+    :param kwargs: other arguments for `tf.train.import_meta_graph`, except `import_scope` (the bookkeeping
+                    refers to the names of the exported graph)
+    :return: a pair (`HyperOptimizer`, `tf.train.Saver` returned by `tf.train.import_meta_graph`)
+    """
+    assert 'import_scope' not in kwargs, 'import_scope is not supported by import_hyper_optimizer'
+    saver = tf.train.import_meta_graph(meta_graph_or_file, **kwargs)
+    graph = tf.get_default_graph()
+    bookkeeping = graph.get_collection(BOOKKEEPING)
+    assert len(bookkeeping) == 1, 'The MetaGraph has not been exported with far_ho.export_hyper_optimizer'
+    desc = json.loads(bookkeeping[0].decode() if isinstance(bookkeeping[0], bytes) else bookkeeping[0])
+    _get = _graph_element_getter(graph)
+
+    hyper_optimizer = HyperOptimizer(_restore_hypergradient(desc['hypergradient'], _get), xla=desc['xla'])
+    hyper_optimizer._fin_hts = _get(desc['hyperit'])
+    hyper_optimizer._global_step = _get(desc['global_step'])
+    hyper_optimizer._inner_objectives = [_get(n) for n in desc['inner_objectives']]
+    return hyper_optimizer, saver
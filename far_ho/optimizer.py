@@ -3,7 +3,9 @@ from __future__ import print_function, absolute_import, division
 # import numpy as np
 
 import tensorflow as tf
+from tensorflow.python.training import slot_creator
 from collections import OrderedDict
+from itertools import count
 
 from far_ho import utils
 
@@ -14,13 +16,20 @@ GRADIENT_NONE_MESSAGE = 'WARNING: the gradient w.r.t.the tf.Variable\n {}\n is N
 
 
 class OptimizerDict(object):
-    def __init__(self, ts, dynamics, objective):
+    _counter = count()  # registration index, gives a deterministic ordering of OptimizerDict objects
+
+    def __init__(self, ts, dynamics, objective, grads_and_vars=None):
+        self._index = next(OptimizerDict._counter)
         self._ts = ts
         self._dynamics = dynamics
         self._iteration = None
         self._initialization = None
         self._init_dyn = None  # for phi_0 (will be a dictionary (state-variable, phi_0 op)
         self.objective = objective
+        self._grads_and_vars = grads_and_vars
+        self._stopping_conditions = []  # boolean tensors, one for each stopping criterion
+        self._stopping_variables = []  # auxiliary variables used by the stopping criteria
+        self._stop_condition = None
 
     @property
     def ts(self):
@@ -54,7 +63,7 @@ class OptimizerDict(object):
                     an initial dynamics is set, then it also executed.
         """
         if self._initialization is None:
-            with tf.control_dependencies([tf.variables_initializer(self.state)]):
+            with tf.control_dependencies([tf.variables_initializer(list(self.state) + self._stopping_variables)]):
                 if self._init_dyn is not None:  # create assign operation for initialization
                     self._initialization = [k.assign(v) for k, v in self._init_dyn.items()]
                     # return these new initialized values (and ignore variable initializers)
@@ -64,6 +73,40 @@ class OptimizerDict(object):
 
         return self._initialization
 
+    @property
+    def grads_and_vars(self):
+        """
+        :return: The list of (gradient, variable) pairs used to build the descent step and the dynamics, or `None`
+                    if not available.
+        """
+        return self._grads_and_vars
+
+    def add_stopping_criterion(self, criterion):
+        """
+        Adds a convergence test for the inner optimization dynamics. The test is built on the tensors that are
+        computed anyway by a descent step (gradients, objective) and is evaluated in the same `Session.run` call of
+        `iteration`, so that `HyperGradient.run` can stop early without additional round-trips.
+
+        :param criterion: a callable (OptimizerDict) -> scalar boolean tensor, `True` when the dynamics has
+                            converged. See e.g. `gradient_norm_criterion` and `relative_change_criterion`.
+        :return: the boolean tensor returned by the criterion
+        """
+        assert self._stop_condition is None, 'Stopping condition already in use, add criteria before running.'
+        condition = criterion(self)
+        self._stopping_conditions.append(condition)
+        return condition
+
+    @property
+    def stop_condition(self):
+        """
+        :return: A scalar boolean tensor that is `True` when any of the stopping criteria is met, or `None` if no
+                    criterion has been added.
+        """
+        if self._stop_condition is None and self._stopping_conditions:
+            self._stop_condition = self._stopping_conditions[0] if len(self._stopping_conditions) == 1 else \
+                tf.reduce_any(tf.stack(self._stopping_conditions))
+        return self._stop_condition
+
     @property
     def dynamics(self):
         """
@@ -116,19 +159,130 @@ class OptimizerDict(object):
         """
         return None if self._init_dyn is None else list(self._init_dyn.items())
 
-    def __lt__(self, other):  # make OptimizerDict sortable
-        # TODO be sure that this is consistent
+    @property
+    def index(self):
+        """
+        :return: the (increasing) index of creation of this object, used for ordering
+        """
+        return self._index
+
+    def __lt__(self, other):  # make OptimizerDict sortable (by order of creation)
         assert isinstance(other, OptimizerDict)
-        return hash(self) < hash(other)
+        return self._index < other._index
 
     def __len__(self):
         return len(self._dynamics)
 
 
+class MicroBatchOptimizerDict(OptimizerDict):
+    def __init__(self, ts, dynamics, objective, grads_and_vars, micro_grads_and_vars, accumulation_reset,
+                 accumulation_step):
+        """
+        Dynamics whose step is computed from the gradients of the inner objective accumulated over several
+        micro-batches (see `Optimizer.minimize` with `accumulate=True`). A step runs `accumulation_reset`, then
+        `accumulation_step` once for each micro-batch, each time with the feed dictionary of that micro-batch, and
+        finally `iteration`; so a single micro-batch is in memory at a time. The hypergradient classes do this
+        when the inner feed dictionary of a step is a list, with one entry per micro-batch, and `ReverseHG` replays
+        the same sub-steps in the reverse pass.
+
+        :param grads_and_vars: list of (accumulated gradient, variable) pairs, on which the dynamics is built
+        :param micro_grads_and_vars: list of (gradient on the fed micro-batch, variable) pairs
+        :param accumulation_reset: operation that sets the accumulated gradients and objective to zero
+        :param accumulation_step: operation that adds the gradients and the objective on the fed micro-batch
+        """
+        super(MicroBatchOptimizerDict, self).__init__(ts, dynamics, objective, grads_and_vars)
+        self.micro_grads_and_vars = micro_grads_and_vars
+        self.accumulation_reset = accumulation_reset
+        self.accumulation_step = accumulation_step
+
+
+def gradient_norm_criterion(tolerance):
+    """
+    Stopping criterion on the norm of the gradient of the inner objective, computed at the current iterate (before
+    the update). The gradients are those already used by the descent step, so no additional computation is needed.
+
+    :param tolerance: the dynamics is stopped when the (global) norm of the gradient is smaller than `tolerance`
+    :return: a criterion for `OptimizerDict.add_stopping_criterion`
+    """
+
+    def _criterion(optimizer_dict):
+        assert optimizer_dict.grads_and_vars is not None, 'Gradients not available for {}'.format(optimizer_dict)
+        with tf.name_scope('gradient_norm_criterion'):
+            gs = [g for g, _ in optimizer_dict.grads_and_vars if g is not None]
+            return tf.less_equal(tf.sqrt(utils.reduce_all_sums(gs, gs)), tolerance)
+
+    return _criterion
+
+
+def relative_change_criterion(tolerance):
+    """
+    Stopping criterion on the relative change of the inner objective between two consecutive iterations,
+    i.e. |f(w_k) - f(w_{k-1})| <= tolerance * |f(w_{k-1})|. The previous value is kept in an auxiliary variable
+    that is reset by `OptimizerDict.initialization`.
+
+    :param tolerance: relative tolerance
+    :return: a criterion for `OptimizerDict.add_stopping_criterion`
+    """
+
+    def _criterion(optimizer_dict):
+        obj = optimizer_dict.objective
+        with tf.name_scope('relative_change_criterion'):
+            previous = tf.Variable(tf.constant(float('inf'), dtype=obj.dtype), trainable=False,
+                                   name='previous_objective')
+            optimizer_dict._stopping_variables.append(previous)
+            previous_value = previous.read_value()
+            condition = tf.logical_and(tf.is_finite(previous_value),
+                                       tf.less_equal(tf.abs(obj - previous_value), tolerance * tf.abs(previous_value)))
+            with tf.control_dependencies([condition]):
+                update = previous.assign(obj)
+            with tf.control_dependencies([update]):
+                return tf.identity(condition)
+
+    return _criterion
+
+
+def _per_dtype(builder):
+    """
+    Memoizes the tensors built by `builder` for each data type, so that the (casted) coefficients of a dynamics
+    are created once, and not once per variable.
+
+    :param builder: a function dtype -> tensor or tuple of tensors
+    :return: a function with the same signature of `builder`
+    """
+    cache = {}
+
+    def _get(dtype):
+        dtype = tf.as_dtype(dtype).base_dtype
+        if dtype not in cache:
+            cache[dtype] = builder(dtype)
+        return cache[dtype]
+
+    return _get
+
+
+def assign_dynamics(dynamics, global_step=None, control_inputs=None, name=None):
+    """
+    Builds a descent step that assigns to each state variable its dynamics. All the dynamics are computed
+    (on the current state) before any of the assignments takes place.
+
+    :param dynamics: dictionary (state variable, tensor for the next value of the variable)
+    :param global_step: optional global step, incremented by the step
+    :param control_inputs: optional list of additional operations that must be executed before the assignments
+    :param name: optional name for the resulting operation
+    :return: the step operation
+    """
+    with tf.control_dependencies(list(dynamics.values()) + list(control_inputs or [])):
+        updates = [v.assign(vk1) for v, vk1 in dynamics.items()]
+        if global_step is not None:
+            updates.append(tf.assign_add(global_step, 1))
+    return tf.group(*updates, name=name)
+
+
 # noinspection PyAbstractClass,PyClassHasNoInit
 class Optimizer(tf.train.Optimizer):
     def minimize(self, loss, global_step=None, var_list=None, gate_gradients=tf.train.Optimizer.GATE_OP,
-                 aggregation_method=None, colocate_gradients_with_ops=False, name=None, grad_loss=None):
+                 aggregation_method=None, colocate_gradients_with_ops=False, name=None, grad_loss=None,
+                 ts_from_dynamics=False, accumulate=False):
         """
         Returns an `OptimizerDict` object relative to this minimization. See tf.train.Optimizer.minimize.
 
@@ -136,10 +290,127 @@ class Optimizer(tf.train.Optimizer):
         and a field `dynamics` for the optimization dynamics. The `dynamics` a list of
         var_and_dynamics where var are both variables in `var_list` and also
         additional state (auxiliary) variables, as needed.
+
+        The gradients are computed once and shared between `ts` and `dynamics`. If `ts_from_dynamics` is `True`
+        the training step assigns the dynamics to the state (see `apply_dynamics`) instead of running the native
+        kernels of tensorflow, so that the forward step and the step that is differentiated are the same.
+
+        `loss` can also be a list of losses on micro-batches (see `compute_micro_batch_gradients`). In this case
+        the objective is their sum.
+
+        If `accumulate` is `True`, `loss` is the objective on a single (fed) micro-batch and a step is computed from
+        the gradients accumulated over several micro-batches, each one fed and run separately: see
+        `MicroBatchOptimizerDict`, that is returned in this case.
         """
-        ts, dyn = super(Optimizer, self).minimize(loss, global_step, var_list, gate_gradients, aggregation_method,
-                                                  colocate_gradients_with_ops, name, grad_loss)
-        return OptimizerDict(ts=ts, dynamics=dyn, objective=loss)
+        if accumulate:
+            return self._minimize_accumulated(loss, global_step, var_list, gate_gradients, aggregation_method,
+                                              colocate_gradients_with_ops, name, grad_loss, ts_from_dynamics)
+        if isinstance(loss, (list, tuple)):
+            loss, grads_and_vars = self.compute_micro_batch_gradients(loss, var_list, gate_gradients,
+                                                                      aggregation_method, colocate_gradients_with_ops)
+        else:
+            grads_and_vars = self.compute_gradients(loss, var_list, gate_gradients, aggregation_method,
+                                                    colocate_gradients_with_ops, grad_loss)
+        # the gradients wait for the objective, so that the value of the objective computed in the same run of a
+        # step (e.g. by a stopping criterion) refers to the current iterate
+        with tf.control_dependencies([loss]):
+            grads_and_vars = [(tf.identity(g) if isinstance(g, tf.Tensor) else g, v) for g, v in grads_and_vars]
+        if ts_from_dynamics:
+            ts, dyn = self.apply_dynamics(grads_and_vars, global_step, name)
+        else:
+            ts, dyn = self.apply_gradients(grads_and_vars, global_step, name)
+        return OptimizerDict(ts=ts, dynamics=dyn, objective=loss, grads_and_vars=grads_and_vars)
+
+    def compute_micro_batch_gradients(self, losses, var_list=None, gate_gradients=tf.train.Optimizer.GATE_OP,
+                                      aggregation_method=None, colocate_gradients_with_ops=False):
+        """
+        Computes the gradients of the sum of `losses` (one for each micro-batch of a large batch) one micro-batch
+        after the other: the gradient ops of a micro-batch wait for the gradients of the previous one, so that the
+        memory used by a step of the inner dynamics (e.g. by the forward pass of `ReverseHG` or by `ForwardHG`) is
+        (roughly) that of a single micro-batch. The gradients are summed in the graph and remain differentiable.
+
+        Note that the reduction applies only to the inner steps: the reverse pass of `ReverseHG` differentiates
+        through the gradient subgraphs of all the micro-batches, which are not sequenced, and all the micro-batches
+        are still fed with a single feed dictionary, so its peak memory is not reduced. Use `minimize` with
+        `accumulate=True` to feed and run the micro-batches one at a time, also in the reverse pass.
+
+        :param losses: list of scalar tensors, or of callables () -> scalar tensor. The callables are called
+                        after the gradients of the previous micro-batch have been built, so that also the forward
+                        pass of each micro-batch (and not only the backward) waits for the previous one.
+        :return: a pair (objective, that is the sum of the losses, list of (summed gradient, variable) pairs)
+        """
+        built_losses, gradients, previous = [], None, []
+        for loss in losses:
+            with tf.control_dependencies(previous):
+                built_losses.append(utils.maybe_call(loss))
+                grads_and_vars = self.compute_gradients(built_losses[-1], var_list, gate_gradients,
+                                                        aggregation_method, colocate_gradients_with_ops)
+            previous = [g for g, v in grads_and_vars if g is not None]
+            gradients = [g for g, v in grads_and_vars] if gradients is None else [
+                g if acc is None else acc if g is None else tf.convert_to_tensor(acc) + tf.convert_to_tensor(g)
+                for (g, v), acc in zip(grads_and_vars, gradients)]  # (sparse gradients are densified)
+        with tf.name_scope('micro_batches'):
+            objective = tf.add_n(built_losses, name='objective')
+        return objective, list(zip(gradients, [v for g, v in grads_and_vars]))
+
+    def _minimize_accumulated(self, loss, global_step, var_list, gate_gradients, aggregation_method,
+                              colocate_gradients_with_ops, name, grad_loss, ts_from_dynamics):
+        """
+        Builds the dynamics on variables that accumulate the gradients (and the value) of `loss` over the
+        micro-batches fed to the sub-steps of an iteration (see `MicroBatchOptimizerDict`).
+        """
+        assert not isinstance(loss, (list, tuple)), 'With accumulate=True the loss is that of a single micro-batch'
+        micro_grads_and_vars = [(g, v) for g, v in self.compute_gradients(
+            loss, var_list, gate_gradients, aggregation_method, colocate_gradients_with_ops, grad_loss)
+                                if g is not None]
+        with tf.name_scope('micro_batches'):
+            accumulators = [slot_creator.create_zeros_slot(v, 'accumulated_gradient') for _, v in micro_grads_and_vars]
+            objective_accumulator = tf.Variable(tf.zeros((), loss.dtype.base_dtype), trainable=False, collections=[],
+                                                name='accumulated_objective')
+            utils.remove_from_collection(utils.GraphKeys.GLOBAL_VARIABLES, *accumulators)
+            accumulation_reset = tf.variables_initializer(accumulators + [objective_accumulator])
+            with tf.control_dependencies([loss]):  # (sparse gradients are densified)
+                accumulation_step = tf.group(objective_accumulator.assign_add(loss), *[
+                    acc.assign_add(tf.convert_to_tensor(g)) for acc, (g, _) in zip(accumulators, micro_grads_and_vars)])
+            grads_and_vars = [(acc.read_value(), v) for acc, (_, v) in zip(accumulators, micro_grads_and_vars)]
+            objective = objective_accumulator.read_value()
+        if ts_from_dynamics:
+            ts, dyn = self.apply_dynamics(grads_and_vars, global_step, name)
+        else:
+            ts, dyn = self.apply_gradients(grads_and_vars, global_step, name)
+        return MicroBatchOptimizerDict(ts, dyn, objective, grads_and_vars, micro_grads_and_vars, accumulation_reset,
+                                       accumulation_step)
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        """
+        Applies the gradients with the tensorflow optimizer and builds the optimization dynamics.
+
+        :return: a pair (training step, dictionary of dynamics)
+        """
+        ts = super(Optimizer, self).apply_gradients(grads_and_vars, global_step, name)
+        return ts, self._dynamics(grads_and_vars)
+
+    def apply_dynamics(self, grads_and_vars, global_step=None, name=None):
+        """
+        Like `apply_gradients`, but the training step is obtained by assigning the dynamics to the state variables,
+        without running the native update kernels.
+
+        :return: a pair (training step, dictionary of dynamics)
+        """
+        var_list = [v for g, v in grads_and_vars if g is not None]
+        with tf.control_dependencies(None):
+            self._create_slots(var_list)
+        with tf.name_scope(name, self.get_name()) as name:
+            self._prepare()
+            dynamics = self._dynamics(grads_and_vars)
+            return assign_dynamics(dynamics, global_step, name=name), dynamics
+
+    def _dynamics(self, grads_and_vars):
+        """
+        Builds the optimization dynamics, that is a dictionary (state variable, next value of the state variable).
+        Slots and hyperparameter tensors must be already created. To be implemented by subclasses.
+        """
+        raise NotImplementedError()
 
     def _tf_minimize(self, loss, global_step=None, var_list=None, gate_gradients=tf.train.Optimizer.GATE_OP,
                      aggregation_method=None, colocate_gradients_with_ops=False, name=None, grad_loss=None):
@@ -165,14 +436,14 @@ class Optimizer(tf.train.Optimizer):
 
 # noinspection PyClassHasNoInit,PyAbstractClass
 class GradientDescentOptimizer(Optimizer, tf.train.GradientDescentOptimizer):
-    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
-        ts = super(GradientDescentOptimizer, self).apply_gradients(grads_and_vars, global_step, name)
+    def _dynamics(self, grads_and_vars):
+        lr = _per_dtype(lambda dtype: tf.cast(self._learning_rate_tensor, dtype))
         dynamics = OrderedDict()
         for g, w in grads_and_vars:
             assert g is not None, GRADIENT_NONE_MESSAGE.format(w)
-            wk = w - tf.cast(self._learning_rate_tensor, g.dtype) * g
+            wk = w - lr(g.dtype) * g
             dynamics[w] = wk
-        return ts, dynamics
+        return dynamics
 
     def __str__(self):
         return '{}-lr={}'.format(self._name, self._learning_rate)
@@ -183,8 +454,25 @@ class GradientDescentOptimizer(Optimizer, tf.train.GradientDescentOptimizer):
 
 
 class BacktrackingOptimizerDict(OptimizerDict):
-    def __init__(self, dynamics, objective, objective_after_step, lr0, m, tau=0.5, c=0.5):
-        super(BacktrackingOptimizerDict, self).__init__(None, dynamics, objective)
+    def __init__(self, dynamics, objective, objective_after_step, lr0, m, tau=0.5, c=0.5, max_backtracks=None):
+        """
+        :param dynamics: dictionary (variable, (gradient, function (eta, variable, gradient) -> next value))
+        :param objective: value of the (inner) objective at the current point
+        :param objective_after_step: function eta -> value of the objective after a step of size eta
+        :param lr0: initial (largest) step size
+        :param m: directional derivative of the objective along the descent direction
+        :param tau: decrease factor of the step size
+        :param c: constant of the Armijo condition
+        :param max_backtracks: if `None` the step size is found with a `tf.while_loop` that evaluates the objective
+                                at lr0, lr0*tau, lr0*tau^2, ... until the Armijo condition is met. Otherwise the step
+                                size is found without a loop, with at most two evaluations of the objective: lr0 if
+                                it meets the condition, otherwise the minimizer of the quadratic that interpolates
+                                the objective at 0 (value and directional derivative) and at lr0, restricted to
+                                [lr0*tau^max_backtracks, lr0*tau], if it meets the condition, otherwise tau times
+                                this minimizer (within the same bounds).
+        """
+        super(BacktrackingOptimizerDict, self).__init__(None, dynamics, objective,
+                                                        [(g, v) for v, (g, _) in dynamics.items()])
         self.objective_after_step = objective_after_step
         # assert isinstance(learning_rate, (float, np.float32, np.float64)), 'learning rate must be a float'
         self.lr0 = lr0
@@ -196,14 +484,32 @@ class BacktrackingOptimizerDict(OptimizerDict):
 
         self.backtrack_body = lambda alpha: alpha * tau
 
-        self.eta_k = tf.while_loop(self.armillo_cond, self.backtrack_body, [self.lr0])
+        if max_backtracks is None:
+            self.eta_k = tf.while_loop(self.armillo_cond, self.backtrack_body, [self.lr0])
+        else:
+            self.eta_k = self._interpolated_step_size(max_backtracks)
 
-        self._dynamics = OrderedDict([(v, vk1(self.eta_k, v, g)) for v, g, vk1 in dynamics])
+        self._dynamics = OrderedDict([(v, vk1(self.eta_k, v, g)) for v, (g, vk1) in dynamics.items()])
+
+    def _interpolated_step_size(self, max_backtracks):
+        def _bounded(eta):
+            return tf.clip_by_value(eta, self.lr0 * self.tau ** max_backtracks, self.lr0 * self.tau)
+
+        def _interpolated():  # the objective is evaluated a second time only if lr0 is rejected
+            # when lr0 is rejected the curvature of the interpolating quadratic is positive
+            curvature = (objective_lr0 - self.objective - self.m * self.lr0) / self.lr0 ** 2
+            eta = _bounded(-self.m / (2. * curvature))
+            return tf.cond(tf.logical_not(self.armillo_cond(eta)), lambda: eta, lambda: _bounded(self.tau * eta))
+
+        with tf.name_scope('interpolated_step_size'):
+            objective_lr0 = self.objective_after_step(self.lr0)
+            return tf.cond(tf.less_equal(objective_lr0, self.objective + self.c * self.lr0 * self.m),
+                           lambda: tf.identity(self.lr0), _interpolated)
 
     @property
     def ts(self):
         if self._ts is None:
-            self._ts = tf.group(*[v.assign(vk1) for v, vk1 in self._dynamics.items()])
+            self._ts = assign_dynamics(self._dynamics)
         return self._ts
 
     @property
@@ -223,10 +529,18 @@ class BacktrackingOptimizerDict(OptimizerDict):
 
 # noinspection PyAbstractClass
 class BackTrackingGradientDescentOptimizer(GradientDescentOptimizer):
-    def __init__(self, learning_rate, c=0.5, tau=0.5, use_locking=False, name="GradientDescent"):
+    def __init__(self, learning_rate, c=0.5, tau=0.5, use_locking=False, name="GradientDescent", max_backtracks=None):
+        """
+        Gradient descent with Armijo backtracking line search. The objective passed to `minimize` must be a
+        callable (list of variables) -> scalar tensor.
+
+        :param max_backtracks: optional bound on the number of backtracking steps, that enables the loop-free line
+                                search by quadratic interpolation (see `BacktrackingOptimizerDict`)
+        """
         super(BackTrackingGradientDescentOptimizer, self).__init__(learning_rate, use_locking, name)
         self.c = c
         self.tau = tau
+        self.max_backtracks = max_backtracks
 
     def apply_gradients(self, grads_and_vars, global_step=None, name=None):
         super(BackTrackingGradientDescentOptimizer, self)._prepare()
@@ -258,10 +572,10 @@ class BackTrackingGradientDescentOptimizer(GradientDescentOptimizer):
                             self)._tf_minimize(curr_loss, global_step, var_list, gate_gradients, aggregation_method,
                                                colocate_gradients_with_ops, name, grad_loss)
 
-        loss_after_step = lambda eta: loss([dyn(eta, v, g) for v, g, dyn in dynamics])
+        loss_after_step = lambda eta: loss([dyn(eta, v, g) for v, (g, dyn) in dynamics.items()])
 
         return BacktrackingOptimizerDict(dynamics, curr_loss, loss_after_step, self._learning_rate_tensor,
-                                         m, self.tau, self.c)
+                                         m, self.tau, self.c, self.max_backtracks)
 
     @property
     def optimizer_params_tensor(self):
@@ -275,30 +589,32 @@ class BackTrackingGradientDescentOptimizer(GradientDescentOptimizer):
 class MomentumOptimizer(Optimizer, tf.train.MomentumOptimizer):
     def __init__(self, learning_rate, momentum, use_locking=False, name="Momentum",
                  use_nesterov=False):
-        assert use_nesterov is False, 'Nesterov momentum not implemented yet...'
         super(MomentumOptimizer, self).__init__(learning_rate, momentum, use_locking, name, use_nesterov)
 
-    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
-        #         filter_hypers
-
-        ts = super(MomentumOptimizer, self).apply_gradients(grads_and_vars, global_step, name)
-
+    def _dynamics(self, grads_and_vars):
         # builds up the dynamics here
         mn = self.get_slot_names()[0]
+        coefficients = _per_dtype(lambda dtype: (tf.cast(self._learning_rate_tensor, dtype),
+                                                 tf.cast(self._momentum_tensor, dtype)))
         dynamics = OrderedDict()
         for g, w in grads_and_vars:
             assert g is not None, GRADIENT_NONE_MESSAGE.format(w)
+            lr, mu = coefficients(g.dtype)
 
             m = self.get_slot(w, mn)
-            mk = tf.cast(self._momentum_tensor, m.dtype) * m + g
-            wk = w - tf.cast(self._learning_rate_tensor, mk.dtype) * mk
+            mk = mu * m + g
+            if self._use_nesterov:
+                wk = w - lr * (g + mu * mk)
+            else:
+                wk = w - lr * mk
             dynamics[w] = wk
             dynamics[m] = mk
 
-        return ts, dynamics
+        return dynamics
 
     def __str__(self):
-        return '{}-lr={}-m={}'.format(self._name, self._learning_rate, self._momentum)
+        return '{}-lr={}-m={}{}'.format(self._name, self._learning_rate, self._momentum,
+                                        '-nesterov' if self._use_nesterov else '')
 
     @property
     def optimizer_params_tensor(self):
@@ -315,33 +631,33 @@ class AdamOptimizer(Optimizer, tf.train.AdamOptimizer):
     def __init__(self, learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-5, use_locking=False, name="Adam"):
         super(AdamOptimizer, self).__init__(learning_rate, beta1, beta2, epsilon, use_locking, name)
 
-    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
-        ts = super(AdamOptimizer, self).apply_gradients(grads_and_vars, global_step, name)
-
+    def _dynamics(self, grads_and_vars):
         mn, vn = self.get_slot_names()
         dynamics = OrderedDict()
 
-        with tf.name_scope(name, 'Adam_Dynamics'):
+        with tf.name_scope('Adam_Dynamics'):
             try:
                 b1_pow, b2_pow = self._beta1_power, self._beta2_power
             except AttributeError:  # for newer versions of tensorflow..
                 b1_pow, b2_pow = self._get_beta_accumulators()
             lr_k = self._lr_t * tf.sqrt(1. - b2_pow) / (1. - b1_pow)
 
-            lr_k = tf.cast(lr_k, grads_and_vars[0][0].dtype)
-            self._beta1_t = tf.cast(self._beta1_t, grads_and_vars[0][0].dtype)
-            self._beta2_t = tf.cast(self._beta2_t, grads_and_vars[0][0].dtype)
-            self._epsilon_t = tf.cast(self._epsilon_t, grads_and_vars[0][0].dtype)
+            def _coefficients(dtype):
+                b1, b2 = tf.cast(self._beta1_t, dtype), tf.cast(self._beta2_t, dtype)
+                return tf.cast(lr_k, dtype), b1, 1. - b1, b2, 1. - b2, tf.square(tf.cast(self._epsilon_t, dtype))
+
+            coefficients = _per_dtype(_coefficients)
 
             for g, w in grads_and_vars:
                 assert g is not None, GRADIENT_NONE_MESSAGE.format(w)
+                _lr_k, b1, one_m_b1, b2, one_m_b2, eps_sq = coefficients(g.dtype)
 
                 m = self.get_slot(w, mn)
                 v = self.get_slot(w, vn)
-                mk = tf.add(self._beta1_t * m, (1. - self._beta1_t) * g, name=m.op.name)
-                vk = tf.add(self._beta2_t * v, (1. - self._beta2_t) * g * g, name=v.op.name)
+                mk = tf.add(b1 * m, one_m_b1 * g, name=m.op.name)
+                vk = tf.add(b2 * v, one_m_b2 * tf.square(g), name=v.op.name)
 
-                wk = tf.subtract(w, lr_k * mk / (tf.sqrt(vk + self._epsilon_t ** 2)), name=w.op.name)
+                wk = tf.subtract(w, _lr_k * mk * tf.rsqrt(vk + eps_sq), name=w.op.name)
                 # IMPORTANT NOTE: epsilon should be outside sqrt as from the original implementation,
                 # but this brings to numerical instability of the hypergradient.
 
@@ -349,13 +665,13 @@ class AdamOptimizer(Optimizer, tf.train.AdamOptimizer):
                 dynamics[m] = mk
                 dynamics[v] = vk
 
-            b1_powk = b1_pow * self._beta1_t
-            b2_powk = b2_pow * self._beta2_t
+            b1_powk = b1_pow * tf.cast(self._beta1_t, b1_pow.dtype.base_dtype)
+            b2_powk = b2_pow * tf.cast(self._beta2_t, b2_pow.dtype.base_dtype)
 
             dynamics[b1_pow] = b1_powk
             dynamics[b2_pow] = b2_powk
 
-        return ts, dynamics
+        return dynamics
 
     def __str__(self):
         return '{}-lr={}-b1={}-b=2{}-ep={}'.format(self._name, self._lr, self._beta1, self._beta2, self._epsilon)
@@ -375,3 +691,108 @@ class AdamOptimizer(Optimizer, tf.train.AdamOptimizer):
     @staticmethod
     def tf():
         return tf.train.AdamOptimizer
+
+
+# noinspection PyClassHasNoInit
+class AdamWOptimizer(AdamOptimizer):
+    """
+    Adam with decoupled weight decay (Loshchilov & Hutter, 2019): w_{k+1} = w_k - adam_step - weight_decay * w_k.
+    As in `tf.contrib.opt.AdamWOptimizer` the decay is not multiplied by the learning rate. Since there is no native
+    kernel for this update, the training step is always driven by the dynamics (see `Optimizer.apply_dynamics`).
+    """
+
+    def __init__(self, weight_decay, learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-5, use_locking=False,
+                 name="AdamW"):
+        super(AdamWOptimizer, self).__init__(learning_rate, beta1, beta2, epsilon, use_locking, name)
+        self._weight_decay = weight_decay
+        self._weight_decay_tensor = None
+
+    def _prepare(self):
+        super(AdamWOptimizer, self)._prepare()
+        self._weight_decay_tensor = tf.convert_to_tensor(self._weight_decay, name='weight_decay')
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        return self.apply_dynamics(grads_and_vars, global_step, name)
+
+    def _dynamics(self, grads_and_vars):
+        dynamics = super(AdamWOptimizer, self)._dynamics(grads_and_vars)
+        wd = _per_dtype(lambda dtype: tf.cast(self._weight_decay_tensor, dtype))
+        for g, w in grads_and_vars:
+            dynamics[w] = tf.subtract(dynamics[w], wd(g.dtype) * w, name=w.op.name + '_decayed')
+        return dynamics
+
+    def __str__(self):
+        return '{}-wd={}'.format(super(AdamWOptimizer, self).__str__(), self._weight_decay)
+
+    @property
+    def optimizer_params_tensor(self):
+        return super(AdamWOptimizer, self).optimizer_params_tensor + [self._weight_decay_tensor]
+
+    @staticmethod
+    def tf():
+        return None
+
+
+# noinspection PyClassHasNoInit,PyAbstractClass
+class RMSPropOptimizer(Optimizer, tf.train.RMSPropOptimizer):
+    def _dynamics(self, grads_and_vars):
+        coefficients = _per_dtype(lambda dtype: (
+            tf.cast(self._learning_rate_tensor, dtype), tf.cast(self._decay_tensor, dtype),
+            1. - tf.cast(self._decay_tensor, dtype), tf.cast(self._momentum_tensor, dtype),
+            tf.cast(self._epsilon_tensor, dtype)))
+        dynamics = OrderedDict()
+        with tf.name_scope('RMSProp_Dynamics'):
+            for g, w in grads_and_vars:
+                assert g is not None, GRADIENT_NONE_MESSAGE.format(w)
+                lr, rho, one_m_rho, mu, eps = coefficients(g.dtype)
+
+                ms = self.get_slot(w, 'rms')
+                mom = self.get_slot(w, 'momentum')
+                msk = rho * ms + one_m_rho * tf.square(g)
+                denominator = msk + eps
+                if self._centered:
+                    mg = self.get_slot(w, 'mg')
+                    mgk = rho * mg + one_m_rho * g
+                    denominator -= tf.square(mgk)
+                    dynamics[mg] = mgk
+                momk = mu * mom + lr * g * tf.rsqrt(denominator)
+
+                dynamics[w] = w - momk
+                dynamics[ms] = msk
+                dynamics[mom] = momk
+        return dynamics
+
+    def __str__(self):
+        return '{}-lr={}-rho={}-m={}-ep={}'.format(self._name, self._learning_rate, self._decay, self._momentum,
+                                                   self._epsilon)
+
+    @property
+    def optimizer_params_tensor(self):
+        return super(RMSPropOptimizer, self).optimizer_params_tensor + [self._decay_tensor, self._momentum_tensor]
+
+    @staticmethod
+    def tf():
+        return tf.train.RMSPropOptimizer
+
+
+# noinspection PyClassHasNoInit,PyAbstractClass
+class AdagradOptimizer(Optimizer, tf.train.AdagradOptimizer):
+    def _dynamics(self, grads_and_vars):
+        lr = _per_dtype(lambda dtype: tf.cast(self._learning_rate_tensor, dtype))
+        dynamics = OrderedDict()
+        with tf.name_scope('Adagrad_Dynamics'):
+            for g, w in grads_and_vars:
+                assert g is not None, GRADIENT_NONE_MESSAGE.format(w)
+
+                acc = self.get_slot(w, 'accumulator')
+                acck = acc + tf.square(g)
+                dynamics[w] = w - lr(g.dtype) * g * tf.rsqrt(acck)
+                dynamics[acc] = acck
+        return dynamics
+
+    def __str__(self):
+        return '{}-lr={}-acc0={}'.format(self._name, self._learning_rate, self._initial_accumulator_value)
+
+    @staticmethod
+    def tf():
+        return tf.train.AdagradOptimizer
@@ -0,0 +1,120 @@
+"""
+Optimizers for the outer problem (to be passed to `HyperOptimizer.outer_problem`). Unlike the optimizers in
+`far_ho.optimizer` they do not need to expose their dynamics.
+"""
+from __future__ import absolute_import, print_function, division
+
+import tensorflow as tf
+
+from far_ho import utils
+from far_ho.utils import dot
+
+
+class LBFGSOptimizer(tf.train.Optimizer):
+    """
+    Limited-memory BFGS for the outer problem. Each call of `apply_gradients` (i.e. each hyper-iteration) uses
+    the hypergradient to update a curvature estimate from the last `memory` pairs (hyperparameter difference,
+    hypergradient difference) and takes a quasi-Newton step. The state is held in graph variables, so a
+    hyper-iteration still costs a single `Session.run` for the update.
+
+    If `line_search_objective` (usually the outer objective) is given, a step is accepted only if the value of
+    the objective at the next hyper-iteration satisfies the Armijo condition; otherwise the hyperparameters are
+    brought back along the previous direction with a step reduced by `tau`. The check reuses the value of the
+    objective computed by that hyper-iteration (in the same run of the update), so no further inner
+    trajectories are needed.
+    """
+
+    def __init__(self, learning_rate=1., memory=5, initial_scale=1., line_search_objective=None, c=1.e-4,
+                 tau=.5, use_locking=False, name='LBFGS'):
+        """
+        :param learning_rate: step size along the quasi-Newton direction
+        :param memory: number of stored curvature pairs
+        :param initial_scale: scale of the initial inverse Hessian approximation, used until the first curvature
+                                pair is stored (the first step is a gradient step of size
+                                `learning_rate * initial_scale`)
+        :param line_search_objective: optional scalar tensor for the (retrospective) Armijo line search; must be
+                                        computable with the feed dictionary of the hyperparameter update
+        :param c: constant of the Armijo condition
+        :param tau: reduction of the step when the Armijo condition is not satisfied
+        """
+        super(LBFGSOptimizer, self).__init__(use_locking, name)
+        self._lr = learning_rate
+        self._memory = memory
+        self._initial_scale = initial_scale
+        self._objective = line_search_objective
+        self._c = c
+        self._tau = tau
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        hyper_list = [v for _, v in grads_and_vars]
+        dtype = hyper_list[0].dtype.base_dtype
+        n, m = sum(v.shape.num_elements() for v in hyper_list), self._memory
+
+        with tf.variable_scope(None, default_name=name or self.get_name()):
+            _var = lambda _name, shape, _dtype=dtype: tf.get_variable(
+                _name, shape, _dtype, tf.zeros_initializer(), trainable=False)
+            S, Y, rho = _var('S', (m, n)), _var('Y', (m, n)), _var('rho', (m,))  # rho = 0 for empty entries
+            head, k = _var('head', (), tf.int32), _var('k', (), tf.int32)
+            x_prev, g_prev, d_prev = _var('x_prev', (n,)), _var('g_prev', (n,)), _var('d_prev', (n,))
+            f_prev, t_prev = _var('f_prev', ()), _var('t_prev', ())
+
+            x = utils.vectorize_all(hyper_list)
+            g = tf.cast(utils.vectorize_all([g for g, _ in grads_and_vars]), dtype)
+            first = tf.equal(k, 0)
+
+            # update of the curvature pairs
+            s, y = x - x_prev, g - g_prev
+            sy = dot(s, y)
+            store = tf.logical_and(tf.logical_not(first), sy > 1.e-10)
+            mask = tf.one_hot(head, m, dtype=dtype) * tf.cast(store, dtype)
+            new_S = S + mask[:, None] * (s[None] - S)
+            new_Y = Y + mask[:, None] * (y[None] - Y)
+            new_rho = rho + mask * (1. / tf.maximum(sy, 1.e-10) - rho)
+            new_head = tf.mod(head + tf.cast(store, tf.int32), m)
+
+            # two-loop recursion, from the newest pair to the oldest one (empty entries have no effect)
+            order = [tf.mod(new_head - 1 - i, m) for i in range(m)]
+            pairs = [(tf.gather(new_S, j), tf.gather(new_Y, j), tf.gather(new_rho, j)) for j in order]
+            q, alphas = g, []
+            for s_i, y_i, rho_i in pairs:
+                alphas.append(rho_i * dot(s_i, q))
+                q -= alphas[-1] * y_i
+            _, y_new, rho_new = pairs[0]
+            gamma = tf.where(rho_new > 0., 1. / tf.maximum(rho_new * dot(y_new, y_new), 1.e-10),
+                             tf.constant(self._initial_scale, dtype))
+            r = gamma * q
+            for (s_i, y_i, rho_i), a_i in reversed(list(zip(pairs, alphas))):
+                r += (a_i - rho_i * dot(y_i, r)) * s_i
+            d = tf.cond(dot(g, r) > 0., lambda: -r, lambda: -self._initial_scale * g)  # gradient if not descent
+            t = tf.constant(self._lr, dtype)
+
+            # accepted step: (new pair,) new direction from the current hyperparameters
+            state = [S, Y, rho, head, x_prev, g_prev, d_prev, t_prev]
+            new_values = [x + t * d, new_S, new_Y, new_rho, new_head, x, g, d, t]
+            if self._objective is not None:
+                f = tf.cast(self._objective, dtype)
+                accept = tf.logical_or(first, f <= f_prev + self._c * t_prev * dot(g_prev, d_prev))
+                # rejected step: back along the previous direction with a shorter step, memory unchanged
+                t_back = self._tau * t_prev
+                rejected = [tf.identity(v) for v in [x_prev + t_back * d_prev, S, Y, rho, head, x_prev, g_prev,
+                                                     d_prev, t_back, f_prev]]
+                accepted = new_values + [f]
+                new_values = tf.cond(accept, lambda: accepted, lambda: rejected)
+                state.append(f_prev)
+
+            with tf.control_dependencies(new_values):  # all the reads happen before any write
+                new_x = new_values[0]
+                assigns, offset = [], 0
+                for v in hyper_list:
+                    size = v.shape.num_elements()
+                    assigns.append(v.assign(tf.reshape(new_x[offset:offset + size], v.shape),
+                                            use_locking=self._use_locking))
+                    offset += size
+                assigns += [var.assign(val, use_locking=self._use_locking) for var, val in zip(state, new_values[1:])]
+                assigns.append(k.assign_add(1))
+            update = tf.group(*assigns)
+            if global_step is not None:
+                with tf.control_dependencies([update]):
+                    update = tf.assign_add(global_step, 1).op
+            return update
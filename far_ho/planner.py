@@ -0,0 +1,120 @@
+"""
+Planner that chooses the hypergradient method (and its memory mode) from the size of the state of the inner
+dynamics, the number of (scalar) hyperparameters, the number of iterations T and a memory budget.
+
+Time is estimated in units of one step of the inner dynamics (a gradient evaluation), memory in bytes.
+"""
+from __future__ import absolute_import, print_function, division
+
+from collections import namedtuple
+
+import numpy as np
+
+from far_ho import utils
+from far_ho.hyper_gradients import ReverseHG, ForwardHG, RandomizedForwardHG, ImplicitHG
+
+MethodEstimate = namedtuple('MethodEstimate', ['name', 'memory', 'time', 'exact', 'feasible', 'note', 'builder'])
+
+
+def tensors_bytes(tensors):
+    """
+    Total size in bytes of a list of tensors or variables (with fully defined shapes).
+    """
+    return sum(int(np.prod(t.shape.as_list())) * t.dtype.base_dtype.size for t in tensors)
+
+
+def _size(t):
+    return int(np.prod(t.shape.as_list()))
+
+
+class HypergradientPlan(object):
+    def __init__(self, choice, estimates, memory_budget):
+        self.choice = choice
+        self.estimates = estimates
+        self.memory_budget = memory_budget
+        self._hypergradient = None
+
+    @property
+    def hypergradient(self):
+        """
+        :return: the `HyperGradient` object of the chosen method (created at the first access)
+        """
+        if self._hypergradient is None:
+            self._hypergradient = self.choice.builder()
+        return self._hypergradient
+
+    @property
+    def explanation(self):
+        lines = ['Memory budget: {:.4g} MB'.format(self.memory_budget / 2. ** 20)]
+        for est in sorted(self.estimates, key=lambda e: e.time):
+            lines.append('{} {:30} memory {:10.4g} MB   time {:10.4g} steps   {}{}{}'.format(
+                '*' if est is self.choice else ' ', est.name, est.memory / 2. ** 20, est.time,
+                'exact' if est.exact else 'approximate', '' if est.feasible else ', exceeds budget',
+                ', ' + est.note if est.note else ''))
+        lines.append('Chosen: {} ({}).'.format(
+            self.choice.name, 'cheapest exact method within budget' if self.choice.exact and self.choice.feasible
+            else 'no exact method within budget, cheapest approximate one' if self.choice.feasible
+            else 'no method within budget, the one with the smallest memory'))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.explanation
+
+
+def plan_hypergradient(optimizer_dict, T, memory_budget, hyper_list=None, reverse_step_cost=2.,
+                       tangent_step_cost=2., allow_approximate=True, n_probes=8, implicit_iterations=100):
+    """
+    Estimates time and memory of `ReverseHG`, `ForwardHG`, and (if `allow_approximate`) truncated `ReverseHG`,
+    `RandomizedForwardHG` and `ImplicitHG` for the given inner dynamics, and chooses the fastest exact method
+    within the memory budget or, if there is none, the fastest approximate one.
+
+    :param optimizer_dict: `OptimizerDict` of the inner problem (if a list, the states are summed up)
+    :param T: number of iterations of the inner dynamics
+    :param memory_budget: available memory in bytes (for state history, multipliers, tangents, ...)
+    :param hyper_list: optional list of hyperparameters (default all hyperparameters in the current scope)
+    :param reverse_step_cost: cost of a reverse iteration (a vector-Jacobian product) in units of inner steps
+    :param tangent_step_cost: cost of the update of one tangent (a Jacobian-vector product) in units of inner
+                                steps
+    :param allow_approximate: if `True` also considers truncated, randomized and implicit methods
+    :param n_probes: number of probes of `RandomizedForwardHG`
+    :param implicit_iterations: number of iterations of the linear system solver of `ImplicitHG`
+    :return: a `HypergradientPlan`; the chosen `HyperGradient` is in `plan.hypergradient`
+    """
+    if hyper_list is None:
+        hyper_list = utils.hyperparameters()
+    state = [v for od in utils.as_list(optimizer_dict) for v in od.state]
+    state_size = tensors_bytes(state)
+    hyper_size = tensors_bytes(hyper_list)
+    n_hyper = sum(_size(h) for h in hyper_list)
+    scalar_hypers = all(h.shape.ndims == 0 for h in hyper_list)
+
+    estimates = [
+        MethodEstimate('ReverseHG', (T + 2) * state_size + hyper_size, T * (1. + reverse_step_cost), True,
+                       None, 'stores the whole trajectory', ReverseHG),
+        MethodEstimate('ForwardHG', (n_hyper + 1) * state_size + hyper_size,
+                       T * (1. + n_hyper * tangent_step_cost), True, None,
+                       '' if scalar_hypers else 'requires scalar hyperparameters '
+                                                '(get_hyperparameter(..., scalar=True))', ForwardHG)
+    ]
+    if allow_approximate:
+        K = int(memory_budget - hyper_size) // state_size - 2 if state_size else T
+        if 0 < K < T:
+            estimates.append(MethodEstimate(
+                'ReverseHG.truncated({})'.format(K), (K + 2) * state_size + hyper_size,
+                T + K * reverse_step_cost, False, None, 'reverse pass truncated to the last {} steps'.format(K),
+                lambda: ReverseHG.truncated(K)))
+        estimates.append(MethodEstimate(
+            'RandomizedForwardHG({})'.format(n_probes), (n_probes + 1) * state_size + (n_probes + 1) * hyper_size,
+            T * (1. + n_probes * tangent_step_cost), False, None, 'unbiased stochastic estimate',
+            lambda: RandomizedForwardHG(n_probes)))
+        estimates.append(MethodEstimate(
+            'ImplicitHG', 4 * state_size + hyper_size, T + implicit_iterations * reverse_step_cost, False, None,
+            'assumes the inner dynamics converged', ImplicitHG))
+
+    # feasibility: memory within budget (and scalar hyperparameters for ForwardHG)
+    estimates = [e._replace(feasible=e.memory <= memory_budget and (e.builder is not ForwardHG or scalar_hypers))
+                 for e in estimates]
+    candidates = [e for e in estimates if e.feasible and e.exact] or [e for e in estimates if e.feasible]
+    choice = min(candidates, key=lambda e: e.time) if candidates else min(
+        [e for e in estimates if e.builder is not ForwardHG or scalar_hypers], key=lambda e: e.memory)
+    return HypergradientPlan(choice, estimates, memory_budget)
@@ -0,0 +1,122 @@
+"""
+Telemetry: recording of the values of tensors along the inner (or reverse) iterations without additional
+`Session.run` calls. The tensors registered in a `Recorder` are fetched in the same calls that perform the
+iterations (see `HyperGradient.add_recorder` and `HyperOptimizer.record`).
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from far_ho import utils
+
+
+class Recorder(object):
+    def __init__(self, tensors, every=1, capacity=1000, filename=None):
+        """
+        Records the values of some tensors every `every` iterations, in preallocated numpy arrays (that double
+        their size when full) or, if `filename` is given, in an append-only binary file (see `Recorder.load`).
+
+        The tensors are evaluated in the same `Session.run` of the iteration: those on which the iteration
+        depends (e.g. the inner objective, for the inner iterations) take the value before the iteration, while
+        the value of the others (e.g. reads of the state) may be read before or after it.
+
+        :param tensors: a tensor, a list of tensors or a dictionary (name, tensor). If not a dictionary the names
+                        are the names of the tensors
+        :param every: number of iterations between two records (records the iterations t with t % every == 0)
+        :param capacity: initial number of records of the arrays
+        :param filename: optional file to which the records are appended (nothing is kept in memory)
+        """
+        if not isinstance(tensors, dict):
+            tensors = OrderedDict([(t.name, t) for t in utils.as_list(tensors)])
+        self.tensors = OrderedDict(tensors)
+        self.every = every
+        self.filename = filename
+        self._file = None
+
+        self._n = 0
+        self._steps = np.empty(capacity, np.int64)
+        self._values = None
+
+    def due(self, step):
+        """
+        :return: `True` if the iteration `step` should be recorded
+        """
+        return step is not None and step % self.every == 0
+
+    def record(self, step, values):
+        """
+        Records the values (as fetched by `Session.run` for `self.tensors`) of the iteration `step`.
+        """
+        if self.filename is not None:
+            self._write(step, values)
+            return
+        if self._values is None:
+            self._values = OrderedDict([(n, np.empty((len(self._steps),) + np.shape(v), np.asarray(v).dtype))
+                                        for n, v in values.items()])
+        if self._n == len(self._steps):
+            self._steps = np.concatenate([self._steps, np.empty_like(self._steps)])
+            self._values = OrderedDict([(n, np.concatenate([v, np.empty_like(v)])) for n, v in self._values.items()])
+        self._steps[self._n] = step
+        for n, v in values.items():
+            self._values[n][self._n] = v
+        self._n += 1
+
+    def _write(self, step, values):
+        if self._file is None:
+            self._file = open(self.filename, 'ab')
+            if self._file.tell() == 0:  # new file: the header is the list of names
+                np.save(self._file, np.array(list(self.tensors)))
+        np.save(self._file, np.array(step, np.int64))
+        [np.save(self._file, np.asarray(values[n])) for n in self.tensors]
+
+    @property
+    def steps(self):
+        """
+        :return: the array of the recorded iterations (only for records kept in memory)
+        """
+        return self._steps[:self._n]
+
+    def values(self, name=None):
+        """
+        :param name: optional name (or tensor) of a recorded tensor
+        :return: the array of the recorded values of `name` (first axis is the record), or a dictionary
+                    (name, array) with all of them (only for records kept in memory)
+        """
+        if self._values is None:
+            return OrderedDict() if name is None else np.empty((0,))
+        if name is None:
+            return OrderedDict([(n, v[:self._n]) for n, v in self._values.items()])
+        if name not in self._values:  # a tensor
+            name = [n for n, t in self.tensors.items() if t is name][0]
+        return self._values[name][:self._n]
+
+    def __len__(self):
+        return self._n
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def load(filename):
+        """
+        Reads a file written by a `Recorder`.
+
+        :return: a pair (array of recorded iterations, dictionary (name, array of values))
+        """
+        size = os.path.getsize(filename)
+        with open(filename, 'rb') as f:
+            names = [str(n) for n in np.load(f)]
+            steps, values = [], OrderedDict([(n, []) for n in names])
+            while f.tell() < size:
+                steps.append(np.load(f))
+                [values[n].append(np.load(f)) for n in names]
+        return np.array(steps, np.int64), OrderedDict([(n, np.array(v)) for n, v in values.items()])
@@ -0,0 +1,160 @@
+"""
+Multi-fidelity scheduling of many hyperparameter configurations (successive halving over the inner horizon T):
+all the configurations run a few hyper-iterations with a short horizon, and only the best ones (according to the
+outer objective) are promoted to longer horizons and more hyper-iterations.
+
+The graph and the session are built once in each process (by a `builder` function) and reused for all the
+configurations assigned to it: switching configuration only loads the values of the variables. The
+configurations of a rung can be spread across a local pool of processes.
+"""
+from __future__ import absolute_import, print_function, division
+
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+from far_ho import utils
+
+_WORKER = {}  # graph, session and HyperOptimizer of this process
+
+
+def _init_worker(builder, session_config=None):
+    """
+    Builds the graph and the session of this process (pool initializer).
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        hyper_optimizer, outer_objective, run_kwargs = builder()
+        variables = hyper_optimizer.checkpoint_variables
+        _WORKER.update(
+            graph=graph, hyper_optimizer=hyper_optimizer, outer_objective=outer_objective,
+            run_kwargs=run_kwargs or {}, variables=OrderedDict([(v.op.name, v) for v in variables]),
+            hyperparameters=OrderedDict([(v.op.name, v) for v in utils.hyperparameters()]),
+            initializer=tf.variables_initializer(variables))
+    _WORKER['session'] = tf.Session(graph=graph, config=session_config)
+
+
+def _outer_objective_value(ss, hyper_optimizer, outer_objective, outer_objective_feed_dicts):
+    # noinspection PyProtectedMember
+    fds = utils.maybe_call(outer_objective_feed_dicts, utils.maybe_eval(hyper_optimizer._global_step, ss))
+    return float(np.mean([ss.run(outer_objective, fd) for fd in utils.feed_dicts_stream(fds)]))
+
+
+def _run_configuration(task):
+    """
+    Runs `hyper_iterations` hyper-iterations with horizon `T` for a configuration, starting from its initial
+    hyperparameters or from the snapshot of the variables taken at the end of the previous rung.
+
+    :return: a pair (value of the outer objective, snapshot of the variables)
+    """
+    hyperparameters, snapshot, T, hyper_iterations, online = task
+    ss, farho, run_kwargs = _WORKER['session'], _WORKER['hyper_optimizer'], _WORKER['run_kwargs']
+    with _WORKER['graph'].as_default():  # some operations are created at the first run
+        if snapshot is None:
+            ss.run(_WORKER['initializer'])
+            [_WORKER['hyperparameters'][name].load(value, ss) for name, value in hyperparameters.items()]
+        else:
+            [_WORKER['variables'][name].load(value, ss) for name, value in snapshot.items()]
+        for k in range(hyper_iterations):
+            # with `online` the inner dynamics continues from the state of the previous rung (warm start)
+            farho.run(T, session=ss, online=online and (snapshot is not None or k > 0), **run_kwargs)
+        value = _outer_objective_value(ss, farho, _WORKER['outer_objective'],
+                                       run_kwargs.get('outer_objective_feed_dicts'))
+        return value, OrderedDict(zip(_WORKER['variables'], ss.run(list(_WORKER['variables'].values()))))
+
+
+class SuccessiveHalving(object):
+    def __init__(self, builder, configurations, min_T, max_T, eta=3, hyper_iterations=1, online=False,
+                 n_workers=None, session_config=None):
+        """
+        Successive halving over the inner horizon: at rung r every surviving configuration runs
+        `hyper_iterations * eta ** r` hyper-iterations with horizon `min(min_T * eta ** r, max_T)`; then the
+        configurations are ranked by the value of the outer objective and the best `1 / eta` of them (at least
+        one) is promoted to the next rung, starting from the values of the variables at the end of the rung.
+        The schedule ends when the horizon `max_T` has been run or a single configuration is left.
+
+        :param builder: function without arguments that builds in the default graph (without resetting it) a finalized
+                            `HyperOptimizer` and returns a triple (hyper_optimizer, outer objective, dictionary
+                            of keyword arguments for `HyperOptimizer.run`, e.g. the feed dictionaries, or `None`).
+                            With `n_workers` it is called once in each process (and must be picklable, e.g.
+                            a function defined at module level)
+        :param configurations: list of dictionaries (name of the hyperparameter variable, initial value)
+        :param min_T: horizon of the first rung
+        :param max_T: horizon of the last rung
+        :param eta: reduction factor of the number of configurations (and growth factor of the resources)
+        :param hyper_iterations: number of hyper-iterations of the first rung
+        :param online: if `True` the promoted configurations continue the inner dynamics of the previous rung
+                        (`HyperOptimizer.run` with `online=True`) instead of restarting it at each hyper-iteration
+        :param n_workers: optional number of processes of the local pool (default: all runs in this process)
+        :param session_config: optional `tf.ConfigProto` for the sessions
+        """
+        assert eta > 1, 'eta must be greater than 1, found {}'.format(eta)
+        self.builder = builder
+        self.configurations = list(configurations)
+        self.min_T, self.max_T, self.eta = min_T, max_T, eta
+        self.hyper_iterations = hyper_iterations
+        self.online = online
+        self.n_workers = n_workers
+        self.session_config = session_config
+
+        self.rungs = []  # list of (T, hyper_iterations, OrderedDict (configuration index, outer objective))
+        self.snapshots = {}  # configuration index -> values of the variables at the end of its last rung
+
+    def _map(self):
+        if not self.n_workers:
+            if _WORKER.get('builder') is not self.builder:
+                if 'session' in _WORKER: _WORKER['session'].close()  # graph of another builder
+                _WORKER.clear()
+                _init_worker(self.builder, self.session_config)
+                _WORKER['builder'] = self.builder
+            return map, None
+        try:
+            context = multiprocessing.get_context('spawn')  # tensorflow does not like forked processes
+        except AttributeError:  # python 2
+            context = multiprocessing
+        pool = context.Pool(self.n_workers, _init_worker, (self.builder, self.session_config))
+        return pool.map, pool
+
+    def run(self):
+        """
+        Runs the whole schedule.
+
+        :return: a pair (index of the best configuration, value of its outer objective at the last rung)
+        """
+        _map, pool = self._map()
+        try:
+            alive, rung = list(range(len(self.configurations))), 0
+            while True:
+                T = min(self.min_T * self.eta ** rung, self.max_T)
+                hyper_iterations = self.hyper_iterations * self.eta ** rung
+                results = list(_map(_run_configuration, [
+                    (self.configurations[c], self.snapshots.get(c), T, hyper_iterations, self.online)
+                    for c in alive]))
+                values = OrderedDict([(c, v) for c, (v, _) in zip(alive, results)])
+                self.snapshots.update([(c, s) for c, (_, s) in zip(alive, results)])
+                self.rungs.append((T, hyper_iterations, values))
+                if T >= self.max_T or len(alive) == 1: break
+                alive = sorted(alive, key=lambda _c: values[_c])[:max(1, len(alive) // self.eta)]
+                rung += 1
+        finally:
+            if pool is not None:  # (the results have been collected, or there was an error)
+                pool.terminate()
+                pool.join()
+        return self.best
+
+    @property
+    def best(self):
+        """
+        :return: a pair (index of the best configuration of the last rung, value of its outer objective)
+        """
+        values = self.rungs[-1][2]
+        best = min(values, key=lambda c: values[c])
+        return best, values[best]
+
+    def hyperparameters(self, configuration):
+        """
+        :return: the values, at the end of its last rung, of the hyperparameters set by a configuration
+        """
+        return OrderedDict([(n, self.snapshots[configuration][n]) for n in self.configurations[configuration]])
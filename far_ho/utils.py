@@ -1,7 +1,9 @@
 from __future__ import absolute_import, print_function, division
 
 import sys
+from contextlib import contextmanager
 
+import numpy as np
 import tensorflow as tf
 
 # noinspection PyUnresolvedReferences
@@ -115,6 +117,112 @@ def reduce_all_sums(lst1, lst2, name=None):
         return tf.add_n([tf.reduce_sum(v1*v2) for v1, v2 in zip(lst1, lst2)], name=scope)
 
 
+@contextmanager
+def _no_scope():
+    yield
+
+
+def jit_scope(compile_ops=True):
+    """
+    Context manager that marks the operations created inside it for just-in-time compilation with XLA
+    (see `tf.contrib.compiler.jit.experimental_jit_scope`), so that chains of element-wise kernels are fused.
+    Operations that XLA cannot compile (e.g. reference variables) are simply not compiled.
+
+    :param compile_ops: if `False` returns a context manager that does nothing
+    :return: a context manager
+    """
+    if not compile_ops:
+        return _no_scope()
+    try:
+        from tensorflow.contrib.compiler import jit
+    except ImportError as e:
+        print('WARNING: XLA not available, operations will not be compiled.', e, file=sys.stderr)
+        return _no_scope()
+    return jit.experimental_jit_scope(compile_ops=True)
+
+
+def feed_dicts_stream(feed_dicts):
+    """
+    Iterator over a stream of feed dictionaries. A single feed dictionary (or `None`) is a stream with one element,
+    any other object should be an iterable (e.g. a generator) of feed dictionaries.
+    """
+    return iter([feed_dicts]) if feed_dicts is None or isinstance(feed_dicts, dict) else iter(feed_dicts)
+
+
+def structural_dependencies(tensors, sources):
+    """
+    Dependency analysis on the computational graph: for each tensor in `tensors` finds which of the `sources`
+    (tensors or variables) are among its ancestors (following the inputs of the operations). A source that
+    is not an ancestor of a tensor has structurally zero derivative w.r.t. it. Graphs with cycles (while loops)
+    are treated conservatively.
+
+    :param tensors: list of tensors (or `None`)
+    :param sources: list of tensors or variables
+    :return: a list of sets of indices of `sources`, one for each tensor
+    """
+    source_masks = {}
+    for k, s in enumerate(sources):
+        source_masks[s.op] = source_masks.get(s.op, 0) | (1 << k)
+    all_sources = (1 << len(sources)) - 1
+    memo, visiting = {}, set()
+
+    def _mask(op):  # iterative post-order visit (graphs can be very deep)
+        stack = [op]
+        while stack:
+            o = stack[-1]
+            if o in memo:
+                stack.pop()
+                continue
+            visiting.add(o)
+            pending = [i.op for i in o.inputs if i.op not in memo and i.op not in visiting]
+            if pending:
+                stack.extend(pending)
+                continue
+            mask = source_masks.get(o, 0)
+            for i in o.inputs:
+                mask |= memo[i.op] if i.op in memo else all_sources  # back edge of a cycle: depends on everything
+            memo[o] = mask
+            visiting.discard(o)
+            stack.pop()
+        return memo[op]
+
+    return [set() if t is None else {k for k in range(len(sources)) if _mask(t.op) >> k & 1} for t in tensors]
+
+
+def read_after(tensors, op):
+    """
+    Copies the subgraph that computes `tensors` replacing every read of a variable with a read that waits for the
+    execution of `op`, so that the copies see the values of the variables after `op`, when they are fetched
+    in the same `Session.run` (operations already in the graph would read them in any order with respect to
+    `op`). Subgraphs with control flow (e.g. while loops) are not supported.
+
+    :param tensors: list of tensors
+    :param op: an operation (e.g. a training step)
+    :return: the list of the copies of `tensors`
+    """
+    from tensorflow.contrib import graph_editor as ge
+    from tensorflow.python.ops import gen_resource_variable_ops
+
+    reads, visited, stack = [], set(), [t.op for t in tensors]
+    # noinspection PyProtectedMember
+    while stack:
+        o = stack.pop()
+        if o in visited: continue
+        visited.add(o)
+        if o.type == 'ReadVariableOp' or (o.type == 'Identity' and o.inputs[0].dtype._is_ref_dtype):
+            reads.append(o)
+        else:
+            stack.extend(i.op for i in o.inputs)
+    if not reads: return list(tensors)
+    with tf.control_dependencies([op]):
+        replacements = {r.outputs[0]: tf.identity(r.inputs[0]) if r.type == 'Identity' else
+                        gen_resource_variable_ops.read_variable_op(r.inputs[0], r.get_attr('dtype'))
+                        for r in reads}
+    targets = [t for t in tensors if t not in replacements]
+    copies = dict(zip(targets, ge.graph_replace(targets, replacements))) if targets else {}
+    return [replacements[t] if t in replacements else copies[t] for t in tensors]
+
+
 def maybe_call(obj, *args, **kwargs):
     """
     Calls obj with args and kwargs and return its result if obj is callable, otherwise returns obj.
@@ -0,0 +1,103 @@
+"""
+Times the inner step (`iteration`), with native kernels and driven by the dynamics, and the reverse step of
+`ReverseHG` for the optimizers in far_ho.optimizer, on a small feed-forward network with random data.
+`benchmark_xla` compares the uncompiled and XLA-compiled steps (also of `ForwardHG`) for Adam and Momentum.
+"""
+from __future__ import absolute_import, print_function, division
+
+import time
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+OPTIMIZERS = [
+    ('GD', lambda: far.GradientDescentOptimizer(.01)),
+    ('Momentum', lambda: far.MomentumOptimizer(.01, .9)),
+    ('Nesterov', lambda: far.MomentumOptimizer(.01, .9, use_nesterov=True)),
+    ('Adam', lambda: far.AdamOptimizer(.001)),
+    ('AdamW', lambda: far.AdamWOptimizer(1.e-4, .001)),
+    ('RMSProp', lambda: far.RMSPropOptimizer(.001, momentum=.9)),
+    ('Adagrad', lambda: far.AdagradOptimizer(.01)),
+]
+
+
+def _build(optimizer_builder, ts_from_dynamics, dims=(784, 512, 512, 10), batch_size=256, xla=False,
+           hypergradient=far.ReverseHG):
+    tf.reset_default_graph()
+    x = tf.constant(np.random.randn(batch_size, dims[0]), tf.float32)
+    y = tf.one_hot(np.random.randint(0, dims[-1], batch_size), dims[-1])
+    lmbd = far.get_hyperparameter('lmbd', 1.e-4)
+
+    net = x
+    weights = []
+    for k, (d_in, d_out) in enumerate(zip(dims, dims[1:])):
+        weights.append(tf.get_variable('w%d' % k, (d_in, d_out)))
+        net = tf.matmul(net, weights[-1])
+        if k < len(dims) - 2:
+            net = tf.nn.relu(net)
+    loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=y, logits=net))
+    inner_obj = loss + lmbd * tf.add_n([tf.reduce_sum(w ** 2) for w in weights])
+
+    hg = hypergradient()
+    with far.utils.jit_scope(xla):
+        optim_dict = optimizer_builder().minimize(inner_obj, var_list=weights, ts_from_dynamics=ts_from_dynamics)
+        hg.compute_gradients(loss, optim_dict, hyper_list=[lmbd])
+    return hg
+
+
+def _time(ss, op, n, feed_dict=None):
+    ss.run(op, feed_dict)  # warm up
+    start = time.time()
+    for _ in range(n):
+        ss.run(op, feed_dict)
+    return (time.time() - start) / n * 1000.
+
+
+def benchmark(n=50, config=None):
+    print('{:10} {:>14} {:>14} {:>14}'.format('optimizer', 'native (ms)', 'dynamics (ms)', 'reverse (ms)'))
+    for name, builder in OPTIMIZERS:
+        times = []
+        for ts_from_dynamics in (False, True):
+            rhg = _build(builder, ts_from_dynamics)
+            with tf.Session(config=config) as ss:
+                tf.global_variables_initializer().run(session=ss)
+                state = ss.run(rhg.initialization)
+                times.append(_time(ss, rhg.iteration, n))
+                ss.run(rhg._reverse_initializer)
+                state_fd = far.utils.merge_dicts(*[od.state_feed_dict(h) for od, h in
+                                                   zip(rhg.optimizer_dicts, state)])
+                reverse_time = _time(ss, rhg._alpha_iter, n, state_fd)
+        print('{:10} {:14.3f} {:14.3f} {:14.3f}'.format(name, times[0], times[1], reverse_time))
+
+
+def benchmark_xla(n=50, config=None):
+    print('{:10} {:>8} {:>14} {:>14} {:>14}'.format('optimizer', 'xla', 'step (ms)', 'reverse (ms)',
+                                                    'tangent (ms)'))
+    for name, builder in OPTIMIZERS:
+        if name not in ('Momentum', 'Adam'):
+            continue
+        for xla in (False, True):
+            rhg = _build(builder, True, xla=xla)
+            with tf.Session(config=config) as ss:
+                tf.global_variables_initializer().run(session=ss)
+                state = ss.run(rhg.initialization)
+                step_time = _time(ss, rhg.iteration, n)
+                ss.run(rhg._reverse_initializer)
+                state_fd = far.utils.merge_dicts(*[od.state_feed_dict(h) for od, h in
+                                                   zip(rhg.optimizer_dicts, state)])
+                reverse_time = _time(ss, rhg._alpha_iter, n, state_fd)
+
+            fhg = _build(builder, True, xla=xla, hypergradient=far.ForwardHG)
+            with tf.Session(config=config) as ss:
+                tf.global_variables_initializer().run(session=ss)
+                ss.run(fhg.initialization)
+                ss.run(fhg._forward_initializer)
+                tangent_time = _time(ss, fhg._z_iter, n)
+            print('{:10} {:>8} {:14.3f} {:14.3f} {:14.3f}'.format(name, str(xla), step_time, reverse_time,
+                                                                  tangent_time))
+
+
+if __name__ == '__main__':
+    benchmark()
+    benchmark_xla()
@@ -0,0 +1,56 @@
+"""
+Times the inner step of `far_ho.BackTrackingGradientDescentOptimizer` with the backtracking `tf.while_loop` and with
+the loop-free line search by quadratic interpolation (`max_backtracks`), on a small feed-forward network with random
+data, and reports the value of the objective reached by each after the same number of steps.
+"""
+from __future__ import absolute_import, print_function, division
+
+import time
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+LINE_SEARCHES = [
+    ('while_loop', None),
+    ('interpolation', 10),
+]
+
+
+def _build(max_backtracks, dims=(784, 256, 256, 10), batch_size=256, learning_rate=10.):
+    tf.reset_default_graph()
+    rnd = np.random.RandomState(0)
+    x = tf.constant(rnd.randn(batch_size, dims[0]), tf.float32)
+    y = tf.one_hot(rnd.randint(0, dims[-1], batch_size), dims[-1])
+    weights = [tf.get_variable('w%d' % k, (d_in, d_out)) for k, (d_in, d_out) in enumerate(zip(dims, dims[1:]))]
+
+    def _loss(var_list):
+        net = x
+        for k, w in enumerate(var_list):
+            net = tf.matmul(net, w)
+            if k < len(var_list) - 1:
+                net = tf.nn.relu(net)
+        return tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(labels=y, logits=net))
+
+    return far.BackTrackingGradientDescentOptimizer(tf.constant(learning_rate), max_backtracks=max_backtracks
+                                                    ).minimize(_loss, var_list=weights)
+
+
+def benchmark(n=50, config=None):
+    print('{:15} {:>14} {:>14} {:>16}'.format('line search', 'step (ms)', 'mean eta', 'final objective'))
+    for name, max_backtracks in LINE_SEARCHES:
+        optim_dict = _build(max_backtracks)
+        with tf.Session(config=config) as ss:
+            tf.global_variables_initializer().run(session=ss)
+            ss.run(optim_dict.iteration)  # warm up
+            etas = []
+            start = time.time()
+            for _ in range(n):
+                etas.append(ss.run(optim_dict.iteration)[-1])
+            step_time = (time.time() - start) / n * 1000.
+            print('{:15} {:14.3f} {:14.4f} {:16.4f}'.format(name, step_time, np.mean(etas),
+                                                            ss.run(optim_dict.objective)))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,92 @@
+"""
+Number of hyper-iterations needed to reach a target value of the outer objective with `far_ho.LBFGSOptimizer`
+(with and without line search) and with `tf.train.AdamOptimizer`, on small synthetic versions of the examples:
+weighting of (partly corrupted) training examples and learning of a (linear) hyper-representation shared by
+a set of regression tasks.
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+T = 50
+
+
+def weighting_problem(n_train=100, n_val=200, dim=20, corrupted=.4, seed=0):
+    rnd = np.random.RandomState(seed)
+    w_true = rnd.randn(dim)
+    x_tr, x_val = rnd.randn(n_train, dim), rnd.randn(n_val, dim)
+    y_tr, y_val = x_tr.dot(w_true), x_val.dot(w_true)
+    flip = rnd.rand(n_train) < corrupted
+    y_tr[flip] = rnd.randn(flip.sum()) * 5.
+    x_tr, x_val, y_tr, y_val = [a.astype(np.float32) for a in (x_tr, x_val, y_tr, y_val)]
+
+    w = tf.get_variable('w', initializer=tf.zeros(dim))
+    gamma = far.get_hyperparameter('gamma', tf.zeros(n_train))
+    inner = tf.reduce_mean(tf.sigmoid(gamma) * (tf.tensordot(x_tr, w, 1) - y_tr) ** 2)
+    outer = tf.reduce_mean((tf.tensordot(x_val, w, 1) - y_val) ** 2)
+    return inner, outer, [w], far.GradientDescentOptimizer(.05)
+
+
+def hyper_representation_problem(n_tasks=10, n_examples=20, dim=20, rep_dim=3, seed=0):
+    rnd = np.random.RandomState(seed)
+    basis = rnd.randn(dim, rep_dim)
+    h = far.get_hyperparameter('h', (.1 * rnd.randn(dim, rep_dim)).astype(np.float32))
+    heads, inner, outer = [], [], []
+    for k in range(n_tasks):
+        head_true = rnd.randn(rep_dim)
+        x_tr, x_val = rnd.randn(n_examples, dim).astype(np.float32), rnd.randn(n_examples, dim).astype(np.float32)
+        heads.append(tf.get_variable('head%d' % k, initializer=tf.zeros(rep_dim)))
+        _loss = lambda x: tf.reduce_mean(
+            (tf.tensordot(tf.matmul(x, h), heads[-1], 1) - x.dot(basis).dot(head_true).astype(np.float32)) ** 2)
+        inner.append(_loss(x_tr))
+        outer.append(_loss(x_val))
+    return tf.add_n(inner), tf.add_n(outer), heads, far.GradientDescentOptimizer(.01)
+
+
+def outer_objective_values(problem, outer_optimizer_builder, hyper_iterations=100):
+    """
+    :return: the values of the outer objective at each hyper-iteration (before the update of the hyperparameters)
+    """
+    tf.reset_default_graph()
+    inner, outer, var_list, inner_optimizer = problem()
+    farho = far.HyperOptimizer()
+    optim_dict = farho.inner_problem(inner, inner_optimizer, var_list=var_list)
+    farho.outer_problem(outer, optim_dict, outer_optimizer_builder(outer))
+    farho.finalize()
+    values = []
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        for _ in range(hyper_iterations):
+            farho.run(T, session=ss, _skip_hyper_ts=True)
+            values.append(ss.run(outer))
+            farho.run(T, session=ss, _only_hyper_ts=True)
+    return values
+
+
+OUTER_OPTIMIZERS = [
+    ('Adam(.01)', lambda _: tf.train.AdamOptimizer(.01)),
+    ('Adam(.1)', lambda _: tf.train.AdamOptimizer(.1)),
+    ('LBFGS', lambda _: far.LBFGSOptimizer(1., initial_scale=.1)),
+    ('LBFGS + line search', lambda outer: far.LBFGSOptimizer(1., initial_scale=.1, line_search_objective=outer)),
+]
+
+
+def benchmark(fraction=.2, hyper_iterations=100):
+    """
+    Prints the number of hyper-iterations needed to bring the outer objective below `fraction` of its initial
+    value (- if not reached within `hyper_iterations`).
+    """
+    print('{:25} {:>22} {:>22}'.format('outer optimizer', 'weighting', 'hyper-representation'))
+    for name, builder in OUTER_OPTIMIZERS:
+        its = []
+        for problem in (weighting_problem, hyper_representation_problem):
+            values = outer_objective_values(problem, builder, hyper_iterations)
+            reached = [k for k, v in enumerate(values) if v <= fraction * values[0]]
+            its.append(str(reached[0]) if reached else '-')
+        print('{:25} {:>22} {:>22}'.format(name, *its))
+
+
+if __name__ == '__main__':
+    benchmark()
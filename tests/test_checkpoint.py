@@ -0,0 +1,80 @@
+"""
+Checks that a hyper-iteration interrupted during the forward pass and resumed from a checkpoint
+(`HyperOptimizer.save`, `HyperOptimizer.restore`) gives the same hypergradient of an uninterrupted one.
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+T = 20
+
+
+class _Preempted(Exception):
+    pass
+
+
+def _build(hypergradient_builder):
+    tf.reset_default_graph()
+    x = tf.placeholder(tf.float32, (None, 3))
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3.]))
+    lmbd = far.get_hyperparameter('lmbd', .1)
+
+    inner_obj = tf.reduce_mean(tf.reduce_sum((x - w) ** 2, 1)) + lmbd * tf.reduce_sum(w ** 2)
+    outer_obj = tf.reduce_sum(w ** 2)
+
+    farho = far.HyperOptimizer(hypergradient_builder())
+    optim_dict = farho.inner_problem(inner_obj, far.MomentumOptimizer(.05, .5), var_list=[w])
+    farho.outer_problem(outer_obj, optim_dict, tf.train.GradientDescentOptimizer(0.), hyper_list=[lmbd])
+    farho.finalize()
+    return farho, x, far.hypergradients()[0]
+
+
+def test_resume_from_checkpoint():
+    data = [np.random.RandomState(t).randn(8, 3) for t in range(T)]
+    tmp = tempfile.mkdtemp()
+    try:
+        for hg_class in (far.ReverseHG, lambda: far.ReverseHG.truncated(5), far.ForwardHG,
+                         lambda: far.RandomizedForwardHG(n_probes=2)):  # (exact with scalar hyperparameters)
+            farho, x, hg = _build(hg_class)
+            with tf.Session() as ss:
+                tf.global_variables_initializer().run(session=ss)
+                farho.run(T, lambda t: {x: data[t]}, _skip_hyper_ts=True, session=ss)
+                reference = ss.run(hg)
+
+            path = os.path.join(tmp, 'ckpt')
+            farho, x, hg = _build(hg_class)
+            save = farho.checkpoint_fc(path, every=7)
+
+            def _preempt(t, fd, ss):
+                save(t, fd, ss)
+                if t == 10: raise _Preempted()
+
+            with tf.Session() as ss:
+                tf.global_variables_initializer().run(session=ss)
+                try:
+                    farho.run(T, lambda t: {x: data[t]}, _skip_hyper_ts=True, session=ss, callback=_preempt)
+                except _Preempted:
+                    pass
+                # noinspection PyProtectedMember
+                assert farho.hypergradient._inner_step is None  # no stale step after the interruption
+
+            farho, x, hg = _build(hg_class)
+            with tf.Session() as ss:
+                tf.global_variables_initializer().run(session=ss)
+                assert farho.restore(path, ss) == 7
+                farho.run(T, lambda t: {x: data[t]}, _skip_hyper_ts=True, session=ss)
+                resumed = ss.run(hg)
+            assert np.allclose(resumed, reference, rtol=1.e-5), (hg_class, resumed, reference)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test_resume_from_checkpoint()
+    print('OK')
@@ -0,0 +1,136 @@
+"""
+Checks of the datasets of the examples: columnar per-example information and redivision of datasets (views), that
+must give the same results as copying the concatenated examples.
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from far_ho.examples.datasets import Dataset, SampleInfo
+from far_ho.examples.utils import redivide_data, save_cache, load_cache, CACHE_MANIFEST
+
+
+def _datasets():
+    rnd = np.random.RandomState(0)
+    d1 = Dataset(rnd.randn(6, 2), np.eye(6)[rnd.randint(6, size=6)],
+                 sample_info=[{'id': k} for k in range(6)], info={'a': 1})
+    d2 = Dataset(rnd.randn(4, 2), np.eye(6)[rnd.randint(6, size=4)], sample_info={'src': 'b'})
+    infos = [{'id': k} for k in range(6)] + [{'src': 'b'}] * 4
+    return [d1, d2], infos
+
+
+def _copied_redivision(datasets, infos, proportions, shuffle, seed):
+    """
+    Redivision that copies the examples (as `redivide_data` did before using views)
+    """
+    data = np.vstack([d.data for d in datasets])
+    target = np.vstack([d.target for d in datasets])
+    n = data.shape[0]
+    infos = np.array(infos)
+    if shuffle:
+        permutation = np.arange(n)
+        np.random.RandomState(seed).shuffle(permutation)
+        data, target, infos = data[permutation], target[permutation], infos[permutation]
+    bounds = [0]
+    for p in proportions:
+        bounds.append(bounds[-1] + int(n * p))
+    bounds[-1] = n
+    return [(data[a:b], target[a:b], list(infos[a:b])) for a, b in zip(bounds, bounds[1:])]
+
+
+def test_sample_info():
+    info = SampleInfo.build([{'id': 0, 'w': 1.}, {'id': 1}, {'id': 2, 'w': 3.}], 3)
+    assert info[1] == {'id': 1}
+    assert np.array_equal(info.column('id'), [0, 1, 2])
+    assert list(info.column('w')) == [1., None, 3.]
+    view = info.take(np.array([2, 0]))
+    assert len(view) == 2 and view[0] == {'id': 2, 'w': 3.}
+    assert view.take(slice(1, 2))[0] == {'id': 0, 'w': 1.}
+
+    shared = SampleInfo.build({'src': 'b'}, 2)
+    assert shared[1] == {'src': 'b'}
+    both = SampleInfo.concatenate([info, shared])
+    assert len(both) == 5
+    assert [both[k] for k in range(5)] == [info[0], info[1], info[2], {'src': 'b'}, {'src': 'b'}]
+    assert SampleInfo.concatenate([shared, shared]).constants == {'src': 'b'}
+
+
+def _check_redivision(shuffle, memmap_path=None):
+    datasets, infos = _datasets()
+    expected = _copied_redivision(datasets, infos, [.5, .3, .2], shuffle, seed=1)
+    new = redivide_data(datasets, [.5, .3], shuffle=shuffle, seed=1, memmap_path=memmap_path)
+    assert len(new) == len(expected)
+    for d, (data, target, info) in zip(new, expected):
+        assert d.num_examples == len(data)
+        assert np.array_equal(d.data, data) and np.array_equal(d.target, target)
+        assert [d.sample_info[k] for k in range(d.num_examples)] == info
+        batch_data, batch_target = d.take([1, 0])
+        assert np.array_equal(batch_data, data[[1, 0]]) and np.array_equal(batch_target, target[[1, 0]])
+    # redividing views of the same arrays does not copy them
+    again = redivide_data(new, [.5], shuffle=shuffle, seed=2)
+    # noinspection PyProtectedMember
+    assert all(d._data is new[0]._data for d in again)
+
+    def _rows(_datasets):
+        rows = np.vstack([_d.data for _d in _datasets])
+        return np.sort(rows, 0) if shuffle else rows
+
+    assert np.array_equal(_rows(again), _rows(new))
+    return new
+
+
+def test_redivide_data():
+    new = _check_redivision(False)
+    # noinspection PyProtectedMember
+    assert all(isinstance(d._indices, slice) for d in new)
+    _check_redivision(True)
+
+
+def test_redivide_data_memmap():
+    folder = tempfile.mkdtemp()
+    try:
+        new = _check_redivision(True, os.path.join(folder, 'data.npy'))
+        # noinspection PyProtectedMember
+        assert isinstance(new[0]._data, np.memmap)
+        del new
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_cache():
+    folder = tempfile.mkdtemp()
+    try:
+        for shuffle in [False, True]:
+            parameters = {'partitions': (.5, .3), 'shuffle': shuffle}
+            new = redivide_data(_datasets()[0], [.5, .3], shuffle=shuffle, seed=1)
+            save_cache(new, folder, parameters)
+            loaded = load_cache(folder, parameters)
+            assert len(loaded) == len(new)
+            for d, l in zip(new, loaded):
+                assert np.array_equal(d.data, l.data) and np.array_equal(d.target, l.target)
+                assert l.info['a'] == 1
+                # noinspection PyProtectedMember
+                assert isinstance(l._data, np.memmap)
+                if not shuffle:  # contiguous datasets are slices of the arrays
+                    # noinspection PyProtectedMember
+                    assert isinstance(l._indices, slice)
+            del loaded
+
+        assert load_cache(folder, {'partitions': (.5, .3), 'shuffle': False}) is None  # other parameters
+        # an interrupted save leaves no manifest (and possibly a temporary one)
+        os.rename(os.path.join(folder, CACHE_MANIFEST), os.path.join(folder, CACHE_MANIFEST + '.tmp'))
+        assert load_cache(folder, {'partitions': (.5, .3), 'shuffle': True}) is None
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    test_sample_info()
+    test_redivide_data()
+    test_redivide_data_memmap()
+    test_cache()
+    print('OK')
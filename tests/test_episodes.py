@@ -0,0 +1,56 @@
+"""
+Checks of the multi-process episode sampler (`far_ho.examples.EpisodeSampler`).
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import tensorflow as tf
+
+from far_ho.examples.episodes import EpisodeSampler
+
+N_CLASSES, N_TRAIN, N_TEST, MBS = 3, 2, 4, 5
+
+
+def test_episode_sampler():
+    labels = np.repeat(np.arange(10), 8)
+    data = np.stack([labels, np.arange(len(labels))], 1).astype(np.float32)  # first feature is the class
+    with EpisodeSampler(data, labels, N_CLASSES, N_TRAIN, N_TEST, MBS, n_workers=2, queue_size=3) as sampler:
+        addresses = set()
+        for _ in range(10):
+            x_train, y_train, x_test, y_test = sampler.next_meta_batch()
+            assert x_train.shape == (MBS, N_CLASSES * N_TRAIN, 2) and y_train.shape == (MBS, N_CLASSES * N_TRAIN, 3)
+            assert x_test.shape == (MBS, N_CLASSES * N_TEST, 2) and y_test.shape == (MBS, N_CLASSES * N_TEST, 3)
+            for task in range(MBS):
+                classes = []
+                for c in range(N_CLASSES):
+                    # the examples with target c come from a single class of the pool, the same in both sets
+                    original = np.concatenate([x_train[task][y_train[task].argmax(1) == c, 0],
+                                               x_test[task][y_test[task].argmax(1) == c, 0]])
+                    assert len(original) == N_TRAIN + N_TEST and np.all(original == original[0])
+                    classes.append(original[0])
+                assert len(set(classes)) == N_CLASSES
+                # no repeated examples in an episode
+                ids = np.concatenate([x_train[task, :, 1], x_test[task, :, 1]])
+                assert len(set(ids)) == len(ids)
+            addresses.add(x_train.__array_interface__['data'][0])
+        assert len(addresses) <= 3  # the buffers are reused
+
+        xs = [tf.placeholder(tf.float32, (None, 2)) for _ in range(MBS)]
+        ys = [tf.placeholder(tf.float32, (None, N_CLASSES)) for _ in range(MBS)]
+        train_fd, test_fd = sampler.feed_dicts(xs, ys)
+        assert len(train_fd) == len(test_fd) == 2 * MBS
+        assert train_fd[xs[0]].shape == (N_CLASSES * N_TRAIN, 2)
+        try:
+            sampler.feed_dicts(xs[1:], ys[1:])
+            assert False, 'missing placeholders must be detected'
+        except AssertionError as e:
+            assert 'episodes' in str(e)
+        # noinspection PyProtectedMember
+        workers = sampler._workers
+    assert not any(w.is_alive() for w in workers)
+    sampler.close()  # closing again has no effect
+
+
+if __name__ == '__main__':
+    test_episode_sampler()
+    print('OK')
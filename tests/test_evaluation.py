@@ -0,0 +1,48 @@
+"""
+Checks of the meta-test evaluation with `far_ho.MetaEvaluator`.
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+N_EPISODES, T = 3, 5
+
+
+def test_meta_evaluator():
+    tf.reset_default_graph()
+    h = far.get_hyperparameter('h', tf.ones(3))  # a (diagonal) hyper-representation
+    xs, errors = [], []
+    farho = far.HyperOptimizer()
+    for k in range(N_EPISODES):
+        x = tf.placeholder(tf.float32, (None, 3))
+        w = tf.get_variable('w%d' % k, initializer=tf.zeros(3))
+        errors.append(tf.reduce_mean(tf.reduce_sum((x - h * w) ** 2, 1)))
+        optim_dict = farho.inner_problem(errors[-1], far.GradientDescentOptimizer(.1), var_list=[w])
+        farho.outer_problem(errors[-1], optim_dict, tf.train.GradientDescentOptimizer(.1))
+        xs.append(x)
+    farho.finalize()
+
+    rnd = np.random.RandomState(0)
+    meta_batches = [[(rnd.randn(4, 3), rnd.randn(4, 3)) for _ in range(N_EPISODES)] for _ in range(2)]
+    fds = [({x: tr for x, (tr, _) in zip(xs, mb)}, {x: ts for x, (_, ts) in zip(xs, mb)}) for mb in meta_batches]
+
+    evaluator = far.MetaEvaluator(farho, {'error': errors}, T)
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        n_ops = len(tf.get_default_graph().get_operations())
+        values = evaluator.evaluate(fds, ss, per_episode=True)['error']
+        assert np.isclose(evaluator.evaluate(fds, ss)['error'], np.mean(values))
+        assert len(tf.get_default_graph().get_operations()) == n_ops  # the graph does not grow
+
+        expected = []
+        for train_fd, test_fd in fds:
+            farho.run(T, train_fd, _skip_hyper_ts=True, session=ss)
+            expected.extend(ss.run(errors, test_fd))
+    assert np.allclose(values, expected, rtol=1.e-5), (values, expected)
+
+
+if __name__ == '__main__':
+    test_meta_evaluator()
+    print('OK')
@@ -0,0 +1,53 @@
+"""
+Checks that hoisting a loop-invariant hyper-representation (`far_ho.HyperOptimizer.hoist`) does not change the
+hypergradients.
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+T = 6
+
+
+def _hypergradients(hoist, hypergradient_class=far.ReverseHG):
+    tf.reset_default_graph()
+    rnd = np.random.RandomState(0)
+    x = tf.placeholder(tf.float32, (None, 3))
+    y = tf.placeholder(tf.float32, (None,))
+    h = far.get_hyperparameter('h', rnd.randn(3, 2).astype(np.float32),
+                               scalar=hypergradient_class.need_scalar_hyperparameters())
+    lr = far.get_hyperparameter('lr', .1)
+    representation = tf.tanh(tf.matmul(x, h))  # depends only on the hyperparameters and on the data
+    w = tf.get_variable('w', initializer=tf.zeros(2))
+    error = tf.reduce_mean((tf.reduce_sum(representation * w, 1) - y) ** 2)
+
+    farho = far.HyperOptimizer(hypergradient_class())
+    if hoist: farho.hoist(representation)
+    farho.minimize(error, tf.train.GradientDescentOptimizer(.1), error, far.GradientDescentOptimizer(lr),
+                   var_list=[w])
+    train_fd = {x: rnd.randn(5, 3), y: rnd.randn(5)}
+    valid_fd = {x: rnd.randn(4, 3), y: rnd.randn(4)}
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        farho.run(T, train_fd, valid_fd, session=ss, _skip_hyper_ts=True)
+        return ss.run(far.utils.hypergradients(), valid_fd)  # (forward) hypergradients depend on the outer feed
+
+
+def test_hoisting_reverse():
+    expected, hoisted = _hypergradients(False), _hypergradients(True)
+    for e, v in zip(expected, hoisted):
+        assert np.allclose(e, v, rtol=1.e-4, atol=1.e-6), (e, v)
+
+
+def test_hoisting_forward():
+    expected, hoisted = _hypergradients(False, far.ForwardHG), _hypergradients(True, far.ForwardHG)
+    for e, v in zip(expected, hoisted):
+        assert np.allclose(e, v, rtol=1.e-4, atol=1.e-6), (e, v)
+
+
+if __name__ == '__main__':
+    test_hoisting_reverse()
+    test_hoisting_forward()
+    print('OK')
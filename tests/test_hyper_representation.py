@@ -0,0 +1,74 @@
+"""
+Smoke test of the graph of the hyper-representation example (`far_ho.examples.hyper_representation`) with a
+meta-batch of two episodes: hoisting the representations of the episodes does not change the hypergradients.
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import pytest
+import tensorflow as tf
+import far_ho as far
+
+pytest.importorskip('experiment_manager')  # required by the example module
+from far_ho.examples import hyper_representation  # noqa: E402
+
+MBS, N_CLASSES, T = 2, 3, 4
+
+
+class _Net(object):
+    def __init__(self, out, var_list=()):
+        self.out, self.var_list = out, list(var_list)
+
+
+class _HyperRepresentation(object):
+    def __init__(self):
+        self.h = far.get_hyperparameter('h', np.random.RandomState(0).randn(3, 2).astype(np.float32))
+
+    def for_input(self, x):
+        return _Net(tf.tanh(tf.matmul(x, self.h)))
+
+
+class _Episode(object):
+    def __init__(self):
+        self.x = tf.placeholder(tf.float32, (None, 3))
+        self.y = tf.placeholder(tf.float32, (None, N_CLASSES))
+        self.model, self.errors, self.scores = None, {}, {}
+
+
+def _linear_classifier(inp, name):
+    w = tf.get_variable(name + '/w', initializer=tf.zeros((2, N_CLASSES)))
+    return _Net(tf.matmul(inp, w), [w])
+
+
+def _hypergradients(hoist):
+    tf.reset_default_graph()
+    exs = [_Episode() for _ in range(MBS)]
+    farho = far.HyperOptimizer()
+    # noinspection PyProtectedMember
+    hyper_representation._build_episodes(exs, _HyperRepresentation(), _linear_classifier, farho,
+                                         far.GradientDescentOptimizer(.5), tf.train.GradientDescentOptimizer(.1),
+                                         None, ('/cpu:0',), hoist)
+    farho.finalize()
+
+    rnd = np.random.RandomState(1)
+
+    def _fd(n):
+        return far.utils.merge_dicts(*[{ex.x: rnd.randn(n, 3), ex.y: np.eye(N_CLASSES)[rnd.randint(N_CLASSES, size=n)]}
+                                       for ex in exs])
+
+    train_fd, valid_fd = _fd(4), _fd(6)  # the validation examples have other representations
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        farho.run(T, train_fd, valid_fd, session=ss, _skip_hyper_ts=True)
+        return ss.run(far.hypergradients())
+
+
+def test_build_episodes():
+    expected, hoisted = _hypergradients(False), _hypergradients(True)
+    for e, v in zip(expected, hoisted):
+        assert np.allclose(e, v, rtol=1.e-4, atol=1.e-6), (e, v)
+
+
+if __name__ == '__main__':
+    test_build_episodes()
+    print('OK')
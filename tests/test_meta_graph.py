@@ -0,0 +1,70 @@
+"""
+Checks that a `HyperOptimizer` exported with `far_ho.export_hyper_optimizer` and restored with
+`far_ho.import_hyper_optimizer` computes the same hypergradients and hyperparameter updates.
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+T = 10
+
+
+def _build(hypergradient_builder):
+    tf.reset_default_graph()
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3., .5]))
+    lmbd = far.get_hyperparameter('lmbd', .1)
+
+    inner_obj = tf.reduce_sum((w - .5) ** 2 * [1., 2., 3., 4.]) + lmbd * tf.reduce_sum(w ** 2)
+    outer_obj = tf.reduce_sum((w - 1.) ** 2)
+
+    farho = far.HyperOptimizer(hypergradient_builder())
+    optim_dict = farho.inner_problem(inner_obj, far.AdamOptimizer(.05), var_list=[w])
+    farho.outer_problem(outer_obj, optim_dict, tf.train.GradientDescentOptimizer(.01), hyper_list=[lmbd])
+    farho.finalize()
+    return farho
+
+
+def _run(farho):
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        farho.run(T, session=ss)
+        hypergradients = ss.run(far.hypergradients())
+        farho.run(T, session=ss)
+        return hypergradients + ss.run(far.hyperparameters())
+
+
+def test_export_import():
+    filename = os.path.join(tempfile.mkdtemp(), 'farho.meta')
+    for hg_class in (far.ReverseHG, far.ForwardHG):
+        farho = _build(hg_class)
+        reference = _run(farho)
+        n_ops = len(tf.get_default_graph().get_operations())
+        meta_graph = far.export_hyper_optimizer(farho, filename)
+        assert len(tf.get_default_graph().get_operations()) == n_ops  # exporting does not build lazy operations
+
+        tf.reset_default_graph()
+        restored, _ = far.import_hyper_optimizer(filename)
+        assert isinstance(restored.hypergradient, hg_class)
+        exported = {node.name for node in meta_graph.graph_def.node}
+        # no orphan operations from the constructors (the saver, if not exported, is built by the import)
+        assert all(op.name in exported or op.name.startswith('save')
+                   for op in tf.get_default_graph().get_operations())
+        assert np.allclose(_run(restored), reference), hg_class
+
+        tf.reset_default_graph()
+        try:
+            far.import_hyper_optimizer(filename, import_scope='imported')
+            rejected = False
+        except AssertionError as e:
+            rejected = 'import_scope' in str(e)
+        assert rejected, 'import_scope must be rejected'
+
+
+if __name__ == '__main__':
+    test_export_import()
+    print('OK')
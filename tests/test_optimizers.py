@@ -0,0 +1,322 @@
+"""
+Finite-difference checks of the hypergradients computed through the dynamics of the optimizers in far_ho.optimizer.
+The training steps are driven by the dynamics (`ts_from_dynamics=True`), so that the trajectory that is
+differentiated is exactly the one that is executed.
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+T = 15
+
+
+def _check_hypergradient(optimizer_builder, hypergradient_builder=far.ReverseHG, eps=1.e-4, rtol=1.e-3):
+    tf.reset_default_graph()
+    ss = tf.InteractiveSession()
+
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3., .5], dtype=tf.float64))
+    lmbd = far.get_hyperparameter('lmbd', tf.constant(.1, dtype=tf.float64))
+
+    inner_obj = tf.reduce_sum((w - .5) ** 2 * [1., 2., 3., 4.]) + lmbd * tf.reduce_sum(w ** 2)
+    outer_obj = tf.reduce_sum((w - 1.) ** 2)
+
+    farho = far.HyperOptimizer(hypergradient_builder())
+    optim_dict = farho.inner_problem(inner_obj, optimizer_builder(), var_list=[w], ts_from_dynamics=True)
+    farho.outer_problem(outer_obj, optim_dict, tf.train.GradientDescentOptimizer(0.), hyper_list=[lmbd])
+    farho.finalize()
+
+    tf.global_variables_initializer().run()
+    farho.run(T, _skip_hyper_ts=True)
+    hypergradient = ss.run(far.hypergradients())[0]
+
+    def _outer_objective_after_T(value):
+        lmbd.load(value, ss)
+        ss.run(farho.hypergradient.initialization)
+        for _ in range(T):
+            ss.run(farho.hypergradient.ts)
+        return ss.run(outer_obj)
+
+    fd_hypergradient = (_outer_objective_after_T(.1 + eps) - _outer_objective_after_T(.1 - eps)) / (2 * eps)
+    ss.close()
+
+    assert np.allclose(hypergradient, fd_hypergradient, rtol=rtol), (hypergradient, fd_hypergradient)
+
+
+def test_gradient_descent():
+    _check_hypergradient(lambda: far.GradientDescentOptimizer(.05))
+
+
+def test_momentum():
+    _check_hypergradient(lambda: far.MomentumOptimizer(.05, .5))
+
+
+def test_nesterov_momentum():
+    _check_hypergradient(lambda: far.MomentumOptimizer(.05, .5, use_nesterov=True))
+
+
+def test_adam():
+    _check_hypergradient(lambda: far.AdamOptimizer(.05))
+
+
+def test_adamw():
+    _check_hypergradient(lambda: far.AdamWOptimizer(.01, .05))
+
+
+def test_rmsprop():
+    _check_hypergradient(lambda: far.RMSPropOptimizer(.01, momentum=.5, epsilon=1.e-6))
+
+
+def test_centered_rmsprop():
+    _check_hypergradient(lambda: far.RMSPropOptimizer(.01, momentum=.5, epsilon=1.e-6, centered=True))
+
+
+def test_adagrad():
+    _check_hypergradient(lambda: far.AdagradOptimizer(.1))
+
+
+def test_forward_adam():
+    _check_hypergradient(lambda: far.AdamOptimizer(.05), far.ForwardHG)
+
+
+def _mixed_precision_hypergradient(dtype, hypergradient_builder):
+    tf.reset_default_graph()
+    ss = tf.InteractiveSession()
+
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3., .5], dtype=dtype))
+    lmbd = far.get_hyperparameter('lmbd', .1)
+
+    inner_obj = tf.reduce_sum((w - .5) ** 2 * [1., 2., 3., 4.]) + tf.cast(lmbd, dtype) * tf.reduce_sum(w ** 2)
+    outer_obj = tf.reduce_sum((tf.cast(w, tf.float32) - 1.) ** 2)
+
+    farho = far.HyperOptimizer(hypergradient_builder())
+    optim_dict = farho.inner_problem(inner_obj, far.MomentumOptimizer(.05, .5), var_list=[w], ts_from_dynamics=True)
+    farho.outer_problem(outer_obj, optim_dict, tf.train.GradientDescentOptimizer(0.), hyper_list=[lmbd])
+    farho.finalize()
+
+    tf.global_variables_initializer().run()
+    farho.run(T, _skip_hyper_ts=True)
+    hypergradient = ss.run(far.hypergradients())[0]
+    ss.close()
+    return hypergradient
+
+
+def test_mixed_precision():
+    for hg_class in (far.ReverseHG, far.ForwardHG):
+        reference = _mixed_precision_hypergradient(tf.float32, hg_class)
+        mixed = _mixed_precision_hypergradient(tf.float16, lambda: hg_class(dtype=tf.float32, loss_scale=128.))
+        assert mixed.dtype == np.float32
+        assert np.allclose(mixed, reference, rtol=1.e-2), (mixed, reference)
+
+
+def _micro_batch_hypergradient(n_micro_batches):
+    tf.reset_default_graph()
+    ss = tf.InteractiveSession()
+
+    x = tf.constant(np.random.RandomState(0).randn(8, 4))
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3., .5], dtype=tf.float64))
+    lmbd = far.get_hyperparameter('lmbd', tf.constant(.1, dtype=tf.float64))
+
+    def _inner_obj(_x):
+        return tf.reduce_sum((_x - w) ** 2) / 8. + lmbd * tf.reduce_sum(w ** 2) / n_micro_batches
+
+    inner_obj = [lambda _x=_x: _inner_obj(_x) for _x in tf.split(x, n_micro_batches)]
+    outer_obj = tf.reduce_sum((w - 1.) ** 2)
+
+    farho = far.HyperOptimizer(far.ReverseHG())
+    optim_dict = farho.inner_problem(inner_obj, far.MomentumOptimizer(.05, .5), var_list=[w], ts_from_dynamics=True)
+    farho.outer_problem(outer_obj, optim_dict, tf.train.GradientDescentOptimizer(0.), hyper_list=[lmbd])
+    farho.finalize()
+
+    tf.global_variables_initializer().run()
+    farho.run(T, _skip_hyper_ts=True)
+    hypergradient = ss.run(far.hypergradients())[0]
+    ss.close()
+    return hypergradient
+
+
+def test_micro_batches():
+    assert np.allclose(_micro_batch_hypergradient(4), _micro_batch_hypergradient(1))
+
+
+def _accumulated_hypergradient(ts_from_dynamics, n_micro_batches=4):
+    tf.reset_default_graph()
+    ss = tf.InteractiveSession()
+
+    data = np.random.RandomState(0).randn(8, 4)
+    x = tf.placeholder(tf.float64, (8 // n_micro_batches, 4))  # only one micro-batch can be fed at a time
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3., .5], dtype=tf.float64))
+    lmbd = far.get_hyperparameter('lmbd', tf.constant(.1, dtype=tf.float64))
+
+    inner_obj = tf.reduce_sum((x - w) ** 2) / 8. + lmbd * tf.reduce_sum(w ** 2) / n_micro_batches
+    outer_obj = tf.reduce_sum((w - 1.) ** 2)
+
+    farho = far.HyperOptimizer(far.ReverseHG())
+    optim_dict = farho.inner_problem(inner_obj, far.MomentumOptimizer(.05, .5), var_list=[w],
+                                     ts_from_dynamics=ts_from_dynamics, accumulate=True)
+    assert isinstance(optim_dict, far.MicroBatchOptimizerDict)
+    farho.outer_problem(outer_obj, optim_dict, tf.train.GradientDescentOptimizer(0.), hyper_list=[lmbd])
+    farho.finalize()
+
+    fed = []
+
+    def _micro_batch(i):
+        def _fd(step):
+            fed.append((step, i))
+            return {x: np.split(data, n_micro_batches)[i]}
+        return _fd
+
+    tf.global_variables_initializer().run()
+    farho.run(T, [_micro_batch(i) for i in range(n_micro_batches)], _skip_hyper_ts=True)
+    hypergradient = ss.run(far.hypergradients())[0]
+    ss.close()
+    return hypergradient, fed
+
+
+def test_accumulated_micro_batches():
+    expected = _micro_batch_hypergradient(1)
+    for ts_from_dynamics in (True, False):
+        hypergradient, fed = _accumulated_hypergradient(ts_from_dynamics)
+        assert np.allclose(hypergradient, expected), (hypergradient, expected)
+        # one sub-step per micro-batch, in the forward and (replayed) in the reverse pass
+        assert sorted(fed) == sorted(2 * [(t, i) for t in range(T) for i in range(4)])
+
+
+def _build_stochastic(hypergradient_builder):
+    tf.reset_default_graph()
+    x = tf.placeholder(tf.float64, (None, 4))
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3., .5], dtype=tf.float64))
+    lmbd = far.get_hyperparameter('lmbd', tf.constant(.1, dtype=tf.float64))
+
+    inner_obj = tf.reduce_mean(tf.reduce_sum((x - w) ** 2, 1)) + lmbd * tf.reduce_sum(w ** 2)
+    outer_obj = tf.reduce_sum((w - 1.) ** 2)
+
+    hypergradient = hypergradient_builder()
+    optim_dict = far.MomentumOptimizer(.05, .5).minimize(inner_obj, var_list=[w], ts_from_dynamics=True)
+    hypergradient.compute_gradients(outer_obj, optim_dict, hyper_list=[lmbd])
+    return hypergradient, x, lmbd
+
+
+def test_multi_horizon():
+    data = np.random.RandomState(0).randn(T, 8, 4)
+    horizons = [3, 7, T]
+    for hg_class in (far.ReverseHG, far.ForwardHG):
+        references = []
+        for horizon in horizons:
+            hypergradient, x, lmbd = _build_stochastic(hg_class)
+            with tf.Session() as ss:
+                tf.global_variables_initializer().run(session=ss)
+                hypergradient.run(horizon, lambda t: {x: data[t]}, session=ss)
+                references.append(ss.run(hypergradient.hgrads_hvars()[0][0]))
+
+        hypergradient, x, lmbd = _build_stochastic(hg_class)
+        with tf.Session() as ss:
+            tf.global_variables_initializer().run(session=ss)
+            multi = hypergradient.run_multi_horizon(horizons, lambda t: {x: data[t]}, session=ss)
+        assert list(multi.keys()) == horizons
+        for horizon, reference in zip(horizons, references):
+            assert np.allclose(multi[horizon][lmbd][0], reference), (hg_class, horizon)
+
+
+def _per_layer_hypergradients(hypergradient_class):
+    tf.reset_default_graph()
+    hypergradient = hypergradient_class()  # its constructor creates operations in the (new) default graph
+    w1 = tf.get_variable('w1', initializer=tf.constant([1., -2.], dtype=tf.float64))
+    w2 = tf.get_variable('w2', initializer=tf.constant([3., .5], dtype=tf.float64))
+    lmbd1 = far.get_hyperparameter('lmbd1', tf.constant(.1, dtype=tf.float64))
+    lmbd2 = far.get_hyperparameter('lmbd2', tf.constant(.2, dtype=tf.float64))
+
+    inner_obj = tf.reduce_sum((w1 - .5) ** 2) + lmbd1 * tf.reduce_sum(w1 ** 2) + \
+        tf.reduce_sum((w2 + .5) ** 2) + lmbd2 * tf.reduce_sum(w2 ** 2)
+    outer_obj = tf.reduce_sum((w1 + w2 - 1.) ** 2)
+
+    optim_dict = far.MomentumOptimizer(.05, .5).minimize(inner_obj, var_list=[w1, w2], ts_from_dynamics=True)
+    hypergradient.compute_gradients(outer_obj, optim_dict, hyper_list=[lmbd1, lmbd2])
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        hypergradient.run(T, session=ss)
+        return hypergradient, ss.run([hg for hg, _ in hypergradient.hgrads_hvars()])
+
+
+def test_structural_zero_tangents():
+    forward, forward_hgs = _per_layer_hypergradients(far.ForwardHG)
+    # each hyperparameter affects only its own layer (weights and momentum)
+    assert all(len([z for z in zs if z is not None]) == 2 for zs in forward._zs.values())
+    assert np.allclose(forward_hgs, _per_layer_hypergradients(far.ReverseHG)[1])
+
+
+def _per_feature_problem(hypergradient):
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3., .5], dtype=tf.float64))
+    lmbd = far.get_hyperparameter('lmbd', tf.constant([.1, .2, .3, .4], dtype=tf.float64))
+
+    inner_obj = tf.reduce_sum((w - .5) ** 2 * [1., 2., 3., 4.]) + tf.reduce_sum(lmbd * w ** 2)
+    outer_obj = tf.reduce_sum((w - 1.) ** 2)
+
+    optim_dict = far.MomentumOptimizer(.05, .5).minimize(inner_obj, var_list=[w], ts_from_dynamics=True)
+    hypergradient.compute_gradients(outer_obj, optim_dict, hyper_list=[lmbd])
+    return lmbd, optim_dict
+
+
+def _per_feature_hypergradient(hypergradient_builder, n_runs=1):
+    tf.reset_default_graph()
+    tf.set_random_seed(0)
+    hypergradient = hypergradient_builder()
+    _per_feature_problem(hypergradient)
+    hg = hypergradient.hgrads_hvars()[0][0]
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        values = []
+        for _ in range(n_runs):
+            hypergradient.run(T, session=ss)
+            values.append(ss.run(hg))
+        return np.mean(values, axis=0)
+
+
+def test_randomized_forward():
+    exact = _per_feature_hypergradient(far.ReverseHG)
+    estimate = _per_feature_hypergradient(lambda: far.RandomizedForwardHG(n_probes=20), n_runs=20)
+    assert np.linalg.norm(estimate - exact) < .2 * np.linalg.norm(exact), (estimate, exact)
+
+
+def test_randomized_forward_tangents():
+    tf.reset_default_graph()
+    hypergradient = far.RandomizedForwardHG(n_probes=3)
+    lmbd, optim_dict = _per_feature_problem(hypergradient)
+    # the projected tangents of all the probes are the tangents of the hyperparameter (weights and momentum)
+    # noinspection PyProtectedMember
+    zs = hypergradient._zs[lmbd]
+    assert len(zs) == 3 * len(list(optim_dict.state))
+    assert set(z for z in zs if z is not None) <= set(tf.get_collection(far.GraphKeys.ZS))
+    assert len(hypergradient.w_dots) == 3
+
+
+def _backtracking_steps(max_backtracks, steps=5):
+    tf.reset_default_graph()
+    w = tf.get_variable('w', initializer=tf.constant([4., -3.]))
+    objective = lambda var_list: tf.reduce_sum(tf.constant([1., 10.]) * (var_list[0] - 1.) ** 2)
+    optim_dict = far.BackTrackingGradientDescentOptimizer(tf.constant(1.), c=.25, max_backtracks=max_backtracks
+                                                          ).minimize(objective, var_list=[w])
+    values = []
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        for _ in range(steps):
+            eta, _ = ss.run([optim_dict.eta_k, optim_dict.ts])
+            values.append((eta, ss.run(optim_dict.objective)))
+    return values
+
+
+def test_backtracking_interpolation():
+    # the objective is quadratic, so the interpolation is exact: the first step is the minimizer along the gradient
+    g, a = np.array([6., -80.]), np.array([1., 10.])
+    steps = _backtracking_steps(10)
+    assert np.isclose(steps[0][0], g.dot(g) / (2. * (a * g).dot(g)), rtol=1.e-4), steps[0]
+    objectives = [a.dot((np.array([4., -3.]) - 1.) ** 2)] + [f for _, f in steps]
+    assert all(f1 < f0 for f0, f1 in zip(objectives, objectives[1:])), objectives
+
+
+if __name__ == '__main__':
+    for _name, _test in sorted(globals().items()):
+        if _name.startswith('test_'):
+            _test()
+            print(_name, 'OK')
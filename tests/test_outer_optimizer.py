@@ -0,0 +1,31 @@
+"""
+Checks of `far_ho.LBFGSOptimizer` on a quadratic problem.
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+
+def test_lbfgs_quadratic():
+    rnd = np.random.RandomState(0)
+    q = rnd.randn(5, 5)
+    a, b = (q.dot(q.T) + np.eye(5)).astype(np.float32), rnd.randn(5).astype(np.float32)
+    solution = np.linalg.solve(a, b)
+    for line_search in (False, True):
+        tf.reset_default_graph()
+        x = tf.get_variable('x', initializer=tf.zeros(5))
+        f = .5 * tf.reduce_sum(x * tf.tensordot(a, x, 1)) - tf.reduce_sum(b * x)
+        step = far.LBFGSOptimizer(1., memory=5, initial_scale=.05,
+                                  line_search_objective=f if line_search else None).minimize(f, var_list=[x])
+        with tf.Session() as ss:
+            tf.global_variables_initializer().run(session=ss)
+            for _ in range(30):
+                ss.run(step)
+            assert np.allclose(ss.run(x), solution, atol=1.e-3), (line_search, ss.run(x), solution)
+
+
+if __name__ == '__main__':
+    test_lbfgs_quadratic()
+    print('OK')
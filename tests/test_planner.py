@@ -0,0 +1,38 @@
+"""
+Checks of the choices of `far_ho.plan_hypergradient` for different memory budgets.
+"""
+from __future__ import absolute_import, print_function, division
+
+import tensorflow as tf
+import far_ho as far
+
+
+def _problem(scalar):
+    tf.reset_default_graph()
+    w = tf.get_variable('w', shape=(1000,))  # 4000 bytes of state (8000 with momentum)
+    lmbd = far.get_hyperparameter('lmbd', tf.constant([.1, .2]), scalar=scalar)
+    inner_obj = tf.reduce_sum(w ** 2 * lmbd[0]) + lmbd[1] * tf.reduce_sum(w)
+    optim_dict = far.MomentumOptimizer(.1, .9).minimize(inner_obj, var_list=[w])
+    return optim_dict, far.hyperparameters()
+
+
+def test_planner_choices():
+    optim_dict, hyper_list = _problem(scalar=True)
+    # enough memory for everything: reverse mode is faster than forward mode with 2 hyperparameters
+    assert isinstance(far.plan_hypergradient(optim_dict, 1000, 2 ** 30, hyper_list).hypergradient, far.ReverseHG)
+    # the trajectory does not fit, but the tangents do
+    plan = far.plan_hypergradient(optim_dict, 1000, 100000, hyper_list)
+    assert plan.choice.name == 'ForwardHG', plan
+
+    optim_dict, hyper_list = _problem(scalar=False)
+    assert far.plan_hypergradient(optim_dict, 1000, 2 ** 30, hyper_list).choice.name == 'ReverseHG'
+    # neither the trajectory fits nor forward mode is applicable: truncated reverse mode
+    plan = far.plan_hypergradient(optim_dict, 1000, 100000, hyper_list)
+    assert plan.choice.name.startswith('ReverseHG.truncated'), plan
+    assert plan.choice.memory <= 100000
+    print(plan)
+
+
+if __name__ == '__main__':
+    test_planner_choices()
+    print('OK')
@@ -0,0 +1,51 @@
+"""
+Checks of the telemetry recorded along the iterations with `far_ho.Recorder` (`HyperOptimizer.record`).
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+T = 10
+
+
+def test_recorder():
+    tf.reset_default_graph()
+    x = tf.constant(np.random.RandomState(0).randn(8, 3), tf.float32)
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3.]))
+    lmbd = far.get_hyperparameter('lmbd', .1)
+    inner_obj = tf.reduce_mean(tf.reduce_sum((x - w) ** 2, 1)) + lmbd * tf.reduce_sum(w ** 2)
+
+    farho = far.HyperOptimizer()
+    farho.minimize(tf.reduce_sum(w ** 2), tf.train.GradientDescentOptimizer(0.), inner_obj,
+                   far.GradientDescentOptimizer(.1), hyper_list=[lmbd])
+
+    tmp = tempfile.mkdtemp()
+    try:
+        forward = farho.record(inner_obj, every=3, capacity=2)  # grows while recording
+        reverse = farho.record({'hg': far.hypergradients()[0]}, reverse=True, filename=os.path.join(tmp, 'rec'))
+        objectives, callback = farho.track_inner_objectives_fc()
+        with tf.Session() as ss:
+            tf.global_variables_initializer().run(session=ss)
+            farho.run(T, callback=callback, session=ss)
+        reverse.close()
+
+        assert list(forward.steps) == [0, 3, 6, 9]
+        # recorded objectives are evaluated before the iteration, those of the callback after it
+        assert np.allclose(forward.values(inner_obj)[1:], np.array(objectives)[[2, 5, 8], 0])
+
+        steps, values = far.Recorder.load(os.path.join(tmp, 'rec'))
+        assert list(steps) == list(range(T - 1, -1, -1)), steps
+        assert values['hg'].shape == (T,)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    test_recorder()
+    print('OK')
@@ -0,0 +1,48 @@
+"""
+The order in which `HyperOptimizer` registers inner problems, outer optimizers and hyperparameters is the order of
+the calls of `inner_problem` and `outer_problem`, and does not change from one construction of the graph to another.
+"""
+from __future__ import absolute_import, print_function, division
+
+import tensorflow as tf
+import far_ho as far
+
+N_PROBLEMS = 20
+
+
+def _register():
+    tf.reset_default_graph()
+    farho = far.HyperOptimizer()
+    outer_optimizers = [tf.train.GradientDescentOptimizer(.1), tf.train.AdamOptimizer(.1)]
+    shared = far.get_hyperparameter('shared', 1.)
+    objectives, optim_dicts, hypers = [], [], []
+    for k in reversed(range(N_PROBLEMS)):
+        w = tf.get_variable('w%d' % k, initializer=tf.ones(3))
+        hypers.append(far.get_hyperparameter('lmbd%d' % k, .1))
+        objectives.append(tf.reduce_sum(w ** 2) * hypers[-1] + shared * tf.reduce_sum(w))
+        optim_dicts.append(farho.inner_problem(objectives[-1], far.GradientDescentOptimizer(.1), var_list=[w]))
+        farho.outer_problem(tf.reduce_sum((w - 1.) ** 2), optim_dicts[-1], outer_optimizers[k % 2],
+                            hyper_list=[hypers[-1], shared])
+    farho.finalize()
+    return farho, objectives, optim_dicts, hypers, outer_optimizers, shared
+
+
+def _registered_hyperparameters(farho):
+    # noinspection PyProtectedMember
+    return [[v.op.name for _, v in hgs_hvs] for _, hgs_hvs in farho._hyper_grads_and_vars]
+
+
+def test_registration_order():
+    farho, objectives, optim_dicts, hypers, outer_optimizers, shared = _register()
+    assert farho.inner_objectives == objectives
+    assert farho.hypergradient.optimizer_dicts == optim_dicts
+    # noinspection PyProtectedMember
+    assert [opt for opt, _ in farho._hyper_grads_and_vars] == [outer_optimizers[1], outer_optimizers[0]]
+    assert _registered_hyperparameters(farho) == [[h.op.name for h in hypers[::2][:1] + [shared] + hypers[2::2]],
+                                                  [h.op.name for h in hypers[1:2] + [shared] + hypers[3::2]]]
+    assert _registered_hyperparameters(_register()[0]) == _registered_hyperparameters(farho)
+
+
+if __name__ == '__main__':
+    test_registration_order()
+    print('OK')
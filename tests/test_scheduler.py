@@ -0,0 +1,49 @@
+"""
+Checks of the successive halving scheduler (`far_ho.SuccessiveHalving`).
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+
+def _builder():
+    x = tf.constant(np.random.RandomState(0).randn(16, 3) + 1., tf.float32)
+    w = tf.get_variable('w', initializer=tf.zeros(3))
+    lmbd = far.get_hyperparameter('lmbd', 0.)
+    inner_obj = tf.reduce_mean(tf.reduce_sum((x - w) ** 2, 1)) + tf.exp(lmbd) * tf.reduce_sum(w ** 2)
+    outer_obj = tf.reduce_sum((w - 1.) ** 2)
+
+    farho = far.HyperOptimizer()
+    farho.minimize(outer_obj, tf.train.GradientDescentOptimizer(.01), inner_obj, far.GradientDescentOptimizer(.1),
+                   hyper_list=[lmbd])
+    return farho, outer_obj, None
+
+
+CONFIGURATIONS = [{'lmbd': v} for v in (3., 2., -4., 1., 0., -1., -2., 4., -3.)]
+
+
+def test_successive_halving():
+    configurations = CONFIGURATIONS
+    scheduler = far.SuccessiveHalving(_builder, configurations, min_T=5, max_T=45, eta=3)
+    best, value = scheduler.run()
+    assert [len(r[2]) for r in scheduler.rungs] == [9, 3, 1]
+    assert [r[0] for r in scheduler.rungs] == [5, 15, 45]
+    assert configurations[best]['lmbd'] < -2., (best, value)  # small regularization is better
+    assert scheduler.hyperparameters(best)['lmbd'] != configurations[best]['lmbd']  # the hyperparameter is updated
+
+
+def test_successive_halving_pool():
+    single = far.SuccessiveHalving(_builder, CONFIGURATIONS, min_T=5, max_T=45, eta=3)
+    pool = far.SuccessiveHalving(_builder, CONFIGURATIONS, min_T=5, max_T=45, eta=3, n_workers=2)
+    best, value = single.run()
+    best_pool, value_pool = pool.run()
+    assert best == best_pool and np.isclose(value, value_pool), (best, value, best_pool, value_pool)
+    assert [list(r[2]) for r in single.rungs] == [list(r[2]) for r in pool.rungs]
+
+
+if __name__ == '__main__':
+    test_successive_halving()
+    test_successive_halving_pool()
+    print('OK')
@@ -0,0 +1,114 @@
+"""
+Checks of the streaming real-time hyperparameter optimization (`HyperOptimizer.stream`) against the online
+`HyperOptimizer.run` with `ForwardHG`, and of the outer objective evaluated on a stream of minibatches.
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import tensorflow as tf
+import far_ho as far
+
+T = 20
+
+
+def _build(hyper_lr=0., hypergradient_builder=far.ForwardHG):
+    tf.reset_default_graph()
+    x = tf.placeholder(tf.float32, (None, 3))
+    w = tf.get_variable('w', initializer=tf.constant([1., -2., 3.]))
+    lmbd = far.get_hyperparameter('lmbd', .1)
+
+    inner_obj = tf.reduce_mean(tf.reduce_sum((x - w) ** 2, 1)) + lmbd * tf.reduce_sum(w ** 2)
+    outer_obj = tf.reduce_mean(tf.reduce_sum((x - w) ** 2, 1))
+
+    farho = far.HyperOptimizer(hypergradient_builder())
+    optim_dict = farho.inner_problem(inner_obj, far.MomentumOptimizer(.05, .5), var_list=[w], ts_from_dynamics=True)
+    farho.outer_problem(outer_obj, optim_dict, tf.train.GradientDescentOptimizer(hyper_lr), hyper_list=[lmbd])
+    farho.finalize()
+    return farho, x, lmbd
+
+
+def _data(seed=0):
+    rnd = np.random.RandomState(seed)
+    return [rnd.randn(8, 3) for _ in range(T)]
+
+
+def test_stream_same_hypergradient():
+    data = _data()
+
+    farho, x, _ = _build()
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        farho.run(T, lambda t: {x: data[t]}, _skip_hyper_ts=True, session=ss)
+        reference = ss.run(far.hypergradients()[0], {x: data[-1]})
+
+    farho, x, _ = _build()
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        steps = farho.stream(({x: d} for d in data), hyper_update_every=T + 1, session=ss)
+        streamed = ss.run(far.hypergradients()[0], {x: data[-1]})
+
+    assert steps == T
+    assert np.allclose(streamed, reference, rtol=1.e-5), (streamed, reference)
+
+
+def test_stream_updates_hyperparameters():
+    data = _data(1)
+    farho, x, lmbd = _build(hyper_lr=.01)
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        values = []
+        farho.stream(({x: d} for d in data), hyper_update_every=5, session=ss,
+                     callback=lambda t, fd, _ss: values.append(_ss.run(lmbd)))
+    assert len(set(values)) == T // 5 + 1, values
+
+
+def test_stream_single_call_update():
+    # the update in the same call of the inner step gives the same hyperparameters of a separate call after it
+    data = _data(2)
+    farho, x, lmbd = _build(hyper_lr=.01)
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        farho.stream(({x: d} for d in data), hyper_update_every=4, session=ss)
+        streamed = ss.run(lmbd)
+
+    farho, x, lmbd = _build(hyper_lr=.01)
+    hypergradient = farho.hypergradient
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        # noinspection PyProtectedMember
+        hypergradient._run_batch_initialization(ss, None)
+        for t, d in enumerate(data, 1):
+            ss.run(hypergradient.fused_step, {x: d})
+            if t % 4 == 0:
+                # noinspection PyProtectedMember
+                ss.run(farho._hyperit, {x: d})
+        reference = ss.run(lmbd)
+    assert not np.isclose(reference, .1)
+    assert np.allclose(streamed, reference, rtol=1.e-5), (streamed, reference)
+
+
+def _hypergradient_after_update(hypergradient_builder, inner_data, outer_fds):
+    farho, x, lmbd = _build(1., hypergradient_builder)
+    with tf.Session() as ss:
+        tf.global_variables_initializer().run(session=ss)
+        farho.run(T, lambda t: {x: inner_data[t]}, outer_fds(x), session=ss)
+        return .1 - ss.run(lmbd)  # the hyper-learning rate is 1
+
+
+def test_outer_objective_stream():
+    inner_data = _data(2)
+    validation = np.random.RandomState(3).randn(4, 16, 3)
+    for hg_class in (far.ReverseHG, far.ForwardHG):
+        reference = _hypergradient_after_update(hg_class, inner_data,
+                                                lambda x: {x: validation.reshape((-1, 3))})
+        streamed = _hypergradient_after_update(hg_class, inner_data,
+                                               lambda x: ({x: v} for v in validation))
+        assert np.allclose(streamed, reference, rtol=1.e-4), (hg_class, streamed, reference)
+
+
+if __name__ == '__main__':
+    test_stream_same_hypergradient()
+    test_stream_updates_hyperparameters()
+    test_stream_single_call_update()
+    test_outer_objective_stream()
+    print('OK')